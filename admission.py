@@ -0,0 +1,290 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+"""Bulk patient admission from census files
+
+Census files, such as ADT feed exports, are CSV (with a header row) or JSON lines, one
+patient per row with the columns name_last, name_first, age, bed, and provider_id unless
+every patient is admitted to one provider. Each row is checked against an in-memory index
+of patients keyed like the unique ix_patients_identity index (provider, name, age, and
+bed), so a patient already admitted is skipped without a query, and a known patient in a
+new bed is transferred by updating their bed rather than admitted twice. Admissions and
+transfers are written in one transaction, so a census is applied completely or not at
+all, and applying it again changes nothing.
+"""
+
+import logging
+import time
+
+from extensions import db
+from helpers import batch_weight_check
+from models import MonthlyWeights, Patient, PatientSummary, User, WeightCheck
+from weight_import import AMBIGUOUS, field, import_format, read_records
+
+logger = logging.getLogger(__name__)
+
+# Rejected census rows listed in an admission report; any more are only counted
+MAX_ERRORS = 1000
+
+
+class CensusIndex:
+    """Patients keyed by every column of the identity index, and by all but bed
+
+    A patient's identity without their bed finds the patient to transfer when a census
+    lists them in a new bed. Identities shared by patients in several beds are marked
+    ambiguous, as the census can't say which of them moved.
+    """
+
+    __slots__ = ("patients", "identities", "providers")
+
+    def __init__(self, rows, providers):
+        self.patients = {}
+        self.identities = {}
+        self.providers = set(providers)
+
+        for row in rows:
+            self.add(
+                row.id, row.provider_id, row.name_last, row.name_first, row.age, row.bed
+            )
+
+    @classmethod
+    def load(cls, provider_id=None):
+        """Build an index of every patient, or those of one provider"""
+        query = db.select(
+            Patient.id,
+            Patient.provider_id,
+            Patient.name_last,
+            Patient.name_first,
+            Patient.age,
+            Patient.bed,
+        )
+        providers = db.select(User.id)
+        if provider_id is not None:
+            query = query.filter(Patient.provider_id == provider_id)
+            providers = providers.filter(User.id == provider_id)
+
+        return cls(db.session.execute(query), db.session.scalars(providers))
+
+    def add(self, patient_id, provider_id, name_last, name_first, age, bed):
+        """Index a patient, as loaded or as admitted"""
+        self.patients[(provider_id, name_last, name_first, age, bed)] = patient_id
+
+        identity = (provider_id, name_last, name_first, age)
+        self.identities[identity] = (
+            AMBIGUOUS if identity in self.identities else (patient_id, bed)
+        )
+
+    def move(self, patient_id, provider_id, name_last, name_first, age, bed, new_bed):
+        """Reindex a transferred patient under their new bed"""
+        del self.patients[(provider_id, name_last, name_first, age, bed)]
+        self.patients[(provider_id, name_last, name_first, age, new_bed)] = patient_id
+        self.identities[(provider_id, name_last, name_first, age)] = (patient_id, new_bed)
+
+
+def validate_census(records, provider_id=None):
+    """Stream (line number, patient values, error) from census records, with either values or an error
+
+    Applies the patient entry form's rules: a last name, first name, whole number age, and
+    bed are required. With provider_id, rows are admitted to that provider, and rows naming
+    another provider are rejected.
+    """
+    for line_number, record in records:
+        if record is None:
+            yield line_number, None, "Line is not a JSON object"
+            continue
+
+        try:
+            name_last = field(record, "name_last")
+            name_first = field(record, "name_first")
+            bed = field(record, "bed")
+            if not (name_last and name_first and bed):
+                raise ValueError("Row needs name_last, name_first, age, and bed")
+
+            try:
+                age = int(field(record, "age"))
+            except ValueError:
+                raise ValueError("Age must be a whole number")
+            if age <= 0:
+                raise ValueError("Age must be greater than 0")
+
+            row_provider = field(record, "provider_id")
+            if row_provider:
+                try:
+                    row_provider = int(row_provider)
+                except ValueError:
+                    raise ValueError("Provider id must be a whole number")
+                if provider_id is not None and row_provider != provider_id:
+                    raise ValueError("Patients can only be admitted to your own care")
+            elif provider_id is not None:
+                row_provider = provider_id
+            else:
+                raise ValueError("Row needs provider_id")
+        except ValueError as e:
+            yield line_number, None, str(e)
+        else:
+            yield line_number, (row_provider, name_last, name_first, age, bed), None
+
+
+def admit_patients(path, provider_id=None, file_format=None, max_errors=MAX_ERRORS):
+    """Admit every new patient of a census file and transfer known patients to their listed beds
+
+    Rows matching a patient on every identity column are counted as already admitted.
+    Returns a report with counts of rows read, patients admitted, transferred, already
+    admitted, and rejected, and the line and reason of up to max_errors rejected rows.
+    """
+    file_format = import_format(path, file_format)
+    index = CensusIndex.load(provider_id)
+
+    report = {
+        "rows": 0,
+        "admitted": 0,
+        "transferred": 0,
+        "existing": 0,
+        "rejected": 0,
+        "errors": [],
+        "errors_truncated": False,
+    }
+    # Beds of new patients, keyed by identity without bed
+    admissions = {}
+    # New and original beds of transferred patients, keyed by patient id
+    transfers = {}
+    original_beds = {}
+    start = time.perf_counter()
+
+    def reject(line_number, error):
+        report["rejected"] += 1
+        if len(report["errors"]) < max_errors:
+            report["errors"].append({"line": line_number, "error": error})
+        else:
+            report["errors_truncated"] = True
+
+    with open(path, newline="", encoding="utf-8-sig") as file:
+        for line_number, values, error in validate_census(
+            read_records(file, file_format), provider_id
+        ):
+            report["rows"] += 1
+            if error is not None:
+                reject(line_number, error)
+                continue
+
+            row_provider, name_last, name_first, age, bed = values
+            if row_provider not in index.providers:
+                reject(line_number, f"No provider with id {row_provider}")
+                continue
+
+            # Already admitted in this bed, or listed twice in the census
+            if values in index.patients:
+                report["existing"] += 1
+                continue
+
+            known = index.identities.get(values[:4])
+            if known is AMBIGUOUS:
+                reject(
+                    line_number,
+                    f"More than one patient named {name_last}, {name_first} aged {age}",
+                )
+            elif known is None:
+                # Admissions get their ids on insert, so None holds their place in the index
+                index.add(None, *values)
+                admissions[values[:4]] = bed
+            else:
+                # Transfers of patients admitted by this census update the admission instead
+                patient_id, old_bed = known
+                index.move(patient_id, *values[:4], old_bed, bed)
+                if patient_id is None:
+                    admissions[values[:4]] = bed
+                else:
+                    # A patient listed in several beds ends up in the last one
+                    original_beds.setdefault(patient_id, old_bed)
+                    transfers[patient_id] = bed
+                    if bed == original_beds[patient_id]:
+                        del transfers[patient_id]
+
+    with db.engine.begin() as connection:
+        if admissions:
+            connection.execute(
+                db.insert(Patient),
+                [
+                    {
+                        "provider_id": row_provider,
+                        "name_last": name_last,
+                        "name_first": name_first,
+                        "age": age,
+                        "bed": bed,
+                    }
+                    for (row_provider, name_last, name_first, age), bed in admissions.items()
+                ],
+            )
+        if transfers:
+            connection.execute(
+                db.update(Patient)
+                .where(Patient.id == db.bindparam("patient_id"))
+                .values(bed=db.bindparam("new_bed")),
+                [
+                    {"patient_id": patient_id, "new_bed": bed}
+                    for patient_id, bed in transfers.items()
+                ],
+            )
+
+    report["admitted"] = len(admissions)
+    report["transferred"] = len(transfers)
+
+    elapsed = time.perf_counter() - start
+    report["seconds"] = round(elapsed, 3)
+    logger.info(
+        "Census %s: %d admitted, %d transferred, %d already admitted, %d rejected in %.2fs",
+        path,
+        report["admitted"],
+        report["transferred"],
+        report["existing"],
+        report["rejected"],
+        elapsed,
+    )
+
+    return report
+
+
+def duplicate_patients():
+    """Return groups of ids of patients sharing every identity column, lowest id first"""
+    identity = (
+        Patient.provider_id,
+        Patient.name_last,
+        Patient.name_first,
+        Patient.age,
+        Patient.bed,
+    )
+    groups = db.session.execute(
+        db.select(db.func.group_concat(Patient.id))
+        .group_by(*identity)
+        .having(db.func.count() > 1)
+    ).scalars()
+    return [sorted(int(patient_id) for patient_id in group.split(",")) for group in groups]
+
+
+def merge_duplicate_patients():
+    """Merge patients entered more than once into the first entry, so the identity index can be created
+
+    Weights of the later entries are moved to the first, the later entries and their
+    weight checks and summaries are removed, and the first entry's weight check is
+    recalculated. Returns the number of patients removed.
+    """
+    groups = duplicate_patients()
+    if not groups:
+        return 0
+
+    for kept, *removed in groups:
+        db.session.execute(
+            db.update(MonthlyWeights)
+            .where(MonthlyWeights.patient_id.in_(removed))
+            .values(patient_id=kept)
+        )
+        db.session.execute(
+            db.delete(WeightCheck).where(WeightCheck.patient_id.in_(removed))
+        )
+        db.session.execute(
+            db.delete(PatientSummary).where(PatientSummary.patient_id.in_(removed))
+        )
+        db.session.execute(db.delete(Patient).where(Patient.id.in_(removed)))
+    db.session.commit()
+
+    batch_weight_check(patient_ids=[kept for kept, *removed in groups])
+    return sum(len(group) - 1 for group in groups)
@@ -0,0 +1,558 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+"""Versioned JSON API for machine clients, such as EHR bridges
+
+Every route under /api/v1 takes an API token in an `Authorization: Bearer <token>` header
+instead of a login session, so clients skip the login page, CSRF tokens, and template
+rendering. Tokens belong to a user, made with `flask create-api-token`, and reach only that
+user's patients. Responses are built from queries selecting only the columns they return,
+rather than full ORM objects, and list routes take many patient ids per call.
+"""
+
+import hashlib
+import secrets
+
+from datetime import datetime
+from functools import wraps
+
+from flask import Blueprint, g, jsonify, request, session
+from sqlalchemy.exc import IntegrityError
+
+from admission import validate_census
+from catalog import get_catalog
+from exports import plain
+from extensions import db
+from helpers import (
+    HISTORY_ORDER,
+    MAX_PAGE_SIZE,
+    ROSTER_ORDER,
+    WEIGHT_CHECK_COLUMNS,
+    batch_weight_check,
+    history_query,
+    keyset_page,
+    page_size_arg,
+)
+from models import ApiToken, MonthlyWeights, Patient, PatientSummary
+from needs import evaluate_needs, needs_options
+from regimens import NUTRITION_COLUMNS, evaluate_request
+from weight_import import BATCH_SIZE, PatientIndex, validate_records
+
+api = Blueprint("api", __name__, url_prefix="/api/v1")
+
+# Columns of each patient in API responses
+PATIENT_COLUMNS = (
+    Patient.id,
+    Patient.name_last,
+    Patient.name_first,
+    Patient.age,
+    Patient.bed,
+)
+
+# Fields of a patient entered through the API, as validate_census() returns them
+PATIENT_FIELDS = ("provider_id", "name_last", "name_first", "age", "bed")
+
+# Columns of each patient's weight check, from their dashboard summary
+SUMMARY_COLUMNS = (
+    PatientSummary.current_weight,
+    PatientSummary.weight_date,
+    *(getattr(PatientSummary, column) for column in WEIGHT_CHECK_COLUMNS.values()),
+    PatientSummary.flagged,
+    PatientSummary.timestamp,
+)
+
+# Columns of each weight in API responses
+WEIGHT_COLUMNS = (
+    MonthlyWeights.id,
+    MonthlyWeights.patient_id,
+    MonthlyWeights.user_id,
+    MonthlyWeights.weight_date,
+    MonthlyWeights.patient_weight,
+    MonthlyWeights.timestamp,
+)
+
+
+def hash_token(token):
+    """Return the SHA-256 hash under which a token is stored
+
+    Tokens are random, so a fast hash is enough; bcrypt would slow every API call.
+    """
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+
+def create_token(user_id, name):
+    """Store a new API token for a user and return it; only its hash is kept"""
+    token = secrets.token_urlsafe(32)
+    db.session.add(
+        ApiToken(
+            user_id=user_id,
+            name=name,
+            token_hash=hash_token(token),
+            created=datetime.now(),
+        )
+    )
+    db.session.commit()
+    return token
+
+
+def error(message, status=400, **details):
+    """Return a JSON error response"""
+    return jsonify(error=message, **details), status
+
+
+def to_dict(row):
+    """Convert a result row to a dict, writing dates and times in ISO 8601"""
+    return {key: plain(value) for key, value in row._mapping.items()}
+
+
+def patient_dict(row):
+    """Convert a row of patient and summary columns to a patient with its weight check (or null)"""
+    patient = to_dict(row)
+    weight_check = {column.key: patient.pop(column.key) for column in SUMMARY_COLUMNS}
+    patient["weight_check"] = (
+        weight_check if weight_check["current_weight"] is not None else None
+    )
+    return patient
+
+
+def ids_arg(name, limit=MAX_PAGE_SIZE):
+    """Read a comma-separated list of ids from a query parameter, raising ValueError if malformed"""
+    value = request.args.get(name, "")
+    try:
+        ids = [int(part) for part in value.split(",") if part.strip()]
+    except ValueError:
+        raise ValueError(f"{name} must be comma-separated whole numbers")
+    if len(ids) > limit:
+        raise ValueError(f"Cannot request more than {limit} ids at once")
+    return ids
+
+
+def indexed(records):
+    """Pair each record of a JSON list with its index, as None if it isn't an object"""
+    for index, record in enumerate(records):
+        yield index, record if isinstance(record, dict) else None
+
+
+def json_body():
+    """Return the request's JSON object, raising ValueError if it isn't one"""
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        raise ValueError("Request body must be a JSON object")
+    return payload
+
+
+def own_patients(user_id):
+    """Select the ids of an API user's patients"""
+    return db.select(Patient.id).filter_by(provider_id=user_id)
+
+
+def patients_query(user_id):
+    """Query an API user's patients with their weight check summaries"""
+    return (
+        db.session.query(*PATIENT_COLUMNS, *SUMMARY_COLUMNS)
+        .outerjoin(PatientSummary, PatientSummary.patient_id == Patient.id)
+        .filter(Patient.provider_id == user_id)
+    )
+
+
+def weights_query(user_id, patient_ids, start=None, end=None):
+    """Select weights of an API user's patients with patient_ids, from start to end"""
+    query = (
+        db.select(*WEIGHT_COLUMNS)
+        .filter(
+            MonthlyWeights.patient_id.in_(patient_ids),
+            MonthlyWeights.patient_id.in_(own_patients(user_id)),
+        )
+        .order_by(
+            MonthlyWeights.patient_id, MonthlyWeights.weight_date, MonthlyWeights.id
+        )
+    )
+    if start is not None:
+        query = query.filter(MonthlyWeights.weight_date >= start)
+    if end is not None:
+        query = query.filter(MonthlyWeights.weight_date <= end)
+    return query
+
+
+def token_query(token_hash):
+    """Select the user id of the API token stored under token_hash"""
+    return db.select(ApiToken.user_id).filter_by(token_hash=token_hash)
+
+
+def token_user_id():
+    """Return the id of the user of the request's API token, or None"""
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    if scheme.lower() != "bearer" or not token.strip():
+        return None
+    return db.session.scalar(token_query(hash_token(token.strip())))
+
+
+def token_required(message="A valid API token is required"):
+    """Return a 401 response asking for an API token"""
+    response = jsonify(error=message)
+    response.status_code = 401
+    response.headers["WWW-Authenticate"] = 'Bearer realm="api"'
+    return response
+
+
+@api.before_request
+def authenticate_token():
+    """Identify the user of the request's API token, or answer 401"""
+    user_id = token_user_id()
+    if user_id is None:
+        return token_required()
+
+    g.api_user_id = user_id
+
+
+def login_or_token_required(f):
+    """Decorate JSON routes outside /api/v1 to take either a login session or an API token
+
+    Only for routes without side effects, as they are exempt from CSRF protection so
+    token clients can call them.
+    """
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if session.get("user_id") is None and token_user_id() is None:
+            return token_required("Log in or send a valid API token")
+        return f(*args, **kwargs)
+
+    return decorated_function
+
+
+@api.route("/patients")
+def list_patients():
+    """Return the API user's patients with their weight checks
+
+    With ids=1,2,3, returns those patients, listing any that aren't found. Otherwise returns
+    one page of the roster in name order, with page_size and cursor query parameters.
+    """
+    try:
+        ids = ids_arg("ids")
+    except ValueError as e:
+        return error(str(e))
+
+    if ids:
+        rows = patients_query(g.api_user_id).filter(Patient.id.in_(ids)).all()
+        found = {row.id for row in rows}
+        return jsonify(
+            patients=[patient_dict(row) for row in rows],
+            not_found=[patient_id for patient_id in ids if patient_id not in found],
+        )
+
+    try:
+        rows, next_cursor = keyset_page(
+            patients_query(g.api_user_id),
+            ROSTER_ORDER,
+            cursor=request.args.get("cursor"),
+            page_size=page_size_arg(request.args),
+        )
+    except ValueError as e:
+        return error(str(e))
+
+    return jsonify(patients=[patient_dict(row) for row in rows], next_cursor=next_cursor)
+
+
+@api.route("/patients", methods=["POST"])
+def create_patients():
+    """Enter patients under care of the API user
+
+    Body: {"patients": [{"name_last": ..., "name_first": ..., "age": ..., "bed": ...}, ...]}
+    Every patient is entered, or none if any is invalid or already entered.
+    """
+    try:
+        records = json_body()["patients"]
+        if not isinstance(records, list) or len(records) > BATCH_SIZE:
+            raise ValueError(f"patients must be a list of up to {BATCH_SIZE} patients")
+    except KeyError:
+        return error("Missing field: patients")
+    except ValueError as e:
+        return error(str(e))
+
+    patients = []
+    errors = []
+    for index, values, message in validate_census(
+        indexed(records),
+        provider_id=g.api_user_id,
+    ):
+        if message is not None:
+            errors.append({"index": index, "error": message})
+        else:
+            patients.append(dict(zip(PATIENT_FIELDS, values)))
+    if errors:
+        return error("Invalid patients", errors=errors)
+
+    new_patients = [Patient(**values) for values in patients]
+    db.session.add_all(new_patients)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        return error("A patient with this name, age, and bed is already entered", 409)
+
+    return (
+        jsonify(
+            patients=[
+                {"id": patient.id, **values}
+                for patient, values in zip(new_patients, patients)
+            ]
+        ),
+        201,
+    )
+
+
+@api.route("/weights")
+def list_weights():
+    """Return the weights of many patients, oldest first, grouped by patient id
+
+    Query parameters: patient_ids=1,2,3, and optional start and end (YYYY-MM-DD, inclusive).
+    """
+    try:
+        patient_ids = ids_arg("patient_ids")
+    except ValueError as e:
+        return error(str(e))
+    if not patient_ids:
+        return error("Missing query parameter: patient_ids")
+
+    try:
+        start, end = (
+            datetime.strptime(request.args[name], "%Y-%m-%d").date()
+            if request.args.get(name)
+            else None
+            for name in ("start", "end")
+        )
+    except ValueError:
+        return error("Dates must be formatted YYYY-MM-DD")
+
+    weights = {patient_id: [] for patient_id in patient_ids}
+    for row in db.session.execute(
+        weights_query(g.api_user_id, patient_ids, start, end)
+    ):
+        weights[row.patient_id].append(to_dict(row))
+
+    return jsonify(weights={str(patient_id): rows for patient_id, rows in weights.items()})
+
+
+@api.route("/weights", methods=["POST"])
+def create_weights():
+    """Enter weights of the API user's patients, and bring their weight checks up to date
+
+    Body: {"weights": [{"patient_id": ..., "weight": ..., "weight_date": "YYYY-MM-DD"}, ...]}
+    Every weight is entered, or none if any is invalid.
+    """
+    try:
+        records = json_body()["weights"]
+        if not isinstance(records, list) or len(records) > BATCH_SIZE:
+            raise ValueError(f"weights must be a list of up to {BATCH_SIZE} weights")
+    except KeyError:
+        return error("Missing field: weights")
+    except ValueError as e:
+        return error(str(e))
+
+    # Weights can only be entered for the user's own patients
+    patients = PatientIndex(
+        db.session.execute(
+            db.select(Patient.id, Patient.name_last, Patient.name_first, Patient.bed)
+            .filter_by(provider_id=g.api_user_id)
+        )
+    )
+
+    rows = []
+    errors = []
+    timestamp = datetime.now()
+    for index, values, message in validate_records(
+        indexed(records),
+        patients,
+    ):
+        if message is not None:
+            errors.append({"index": index, "error": message})
+            continue
+
+        patient_id, weight, weight_date = values
+        rows.append(
+            {
+                "user_id": g.api_user_id,
+                "patient_id": patient_id,
+                "patient_weight": weight,
+                "weight_date": weight_date,
+                "timestamp": timestamp,
+            }
+        )
+    if errors:
+        return error("Invalid weights", errors=errors)
+
+    # The weights, weight checks, and summaries are committed together
+    patient_ids = sorted({row["patient_id"] for row in rows})
+    if rows:
+        db.session.execute(db.insert(MonthlyWeights), rows)
+        batch_weight_check(patient_ids=patient_ids)
+
+    return jsonify(entered=len(rows), patient_ids=patient_ids), 201
+
+
+@api.route("/history")
+def history():
+    """Return one page of the weights entered by the API user, newest weight date first"""
+    try:
+        rows, next_cursor = keyset_page(
+            history_query(g.api_user_id).with_entities(*WEIGHT_COLUMNS),
+            HISTORY_ORDER,
+            cursor=request.args.get("cursor"),
+            page_size=page_size_arg(request.args),
+            descending=True,
+        )
+    except ValueError as e:
+        return error(str(e))
+
+    return jsonify(weights=[to_dict(row) for row in rows], next_cursor=next_cursor)
+
+
+@api.route("/weight_checks", methods=["POST"])
+def weight_checks():
+    """Recalculate weight checks of some or all of the API user's patients, and return them
+
+    Body: {"patient_ids": [...]}, or {} for every patient of the user.
+    """
+    try:
+        patient_ids = json_body().get("patient_ids")
+        if patient_ids is not None and (
+            not isinstance(patient_ids, list)
+            or len(patient_ids) > MAX_PAGE_SIZE
+            or not all(isinstance(patient_id, int) for patient_id in patient_ids)
+        ):
+            raise ValueError(f"patient_ids must be a list of up to {MAX_PAGE_SIZE} ids")
+    except ValueError as e:
+        return error(str(e))
+
+    if patient_ids is None:
+        updated = batch_weight_check(provider_id=g.api_user_id)
+        query = patients_query(g.api_user_id)
+    else:
+        # Only the user's own patients are recalculated
+        patient_ids = db.session.scalars(
+            own_patients(g.api_user_id).filter(Patient.id.in_(patient_ids))
+        ).all()
+        updated = batch_weight_check(patient_ids=patient_ids)
+        query = patients_query(g.api_user_id).filter(Patient.id.in_(patient_ids))
+
+    return jsonify(
+        updated=updated,
+        patients=[patient_dict(row) for row in query.order_by(Patient.id)],
+    )
+
+
+@api.route("/needs", methods=["POST"])
+def needs():
+    """Estimate the needs of many of the API user's patients from their latest weights
+
+    Body: {"equation": ..., "condition": ..., "patients": [{"patient_id": ..., "sex": ...,
+    "height_in": ..., "minute_ventilation": ..., "max_temp": ...}, ...]}, with the patient
+    values the equation needs. Patients without a weight get null needs.
+    """
+    try:
+        payload = json_body()
+        options = needs_options(payload)
+        records = payload["patients"]
+        if (
+            not isinstance(records, list)
+            or len(records) > MAX_PAGE_SIZE
+            or not all(isinstance(record, dict) for record in records)
+        ):
+            raise ValueError(f"patients must be a list of up to {MAX_PAGE_SIZE} patients")
+        values = [needs_options(record) for record in records]
+        patient_ids = [int(record["patient_id"]) for record in records]
+    except KeyError as e:
+        return error(f"Missing field: {e.args[0]}")
+    except (TypeError, ValueError) as e:
+        return error(f"Invalid needs request: {e}")
+
+    # Ages and latest weights of every patient in one query
+    rows = {
+        row.id: row
+        for row in db.session.execute(
+            db.select(
+                Patient.id,
+                Patient.age,
+                PatientSummary.current_weight,
+                PatientSummary.weight_date,
+            )
+            .outerjoin(PatientSummary, PatientSummary.patient_id == Patient.id)
+            .filter(Patient.id.in_(patient_ids), Patient.provider_id == g.api_user_id)
+        )
+    }
+    missing = [patient_id for patient_id in patient_ids if patient_id not in rows]
+    if missing:
+        return error("Patients not found", 404, not_found=missing)
+
+    patients = [rows[patient_id] for patient_id in patient_ids]
+    columns = {}
+    for column, name in (
+        ("heights_in", "height_in"),
+        ("sexes", "sex"),
+        ("minute_ventilation", "minute_ventilation"),
+        ("max_temps", "max_temp"),
+    ):
+        column_values = [patient_values.get(name) for patient_values in values]
+        if None not in column_values:
+            columns[column] = column_values
+
+    try:
+        needs = evaluate_needs(
+            [patient.current_weight for patient in patients],
+            options["equation"],
+            options["condition"],
+            ages=[patient.age for patient in patients],
+            **columns,
+        )
+    except ValueError as e:
+        return error(f"Invalid needs request: {e}")
+
+    return jsonify(
+        equation=options["equation"],
+        condition=options["condition"],
+        patients=[
+            {
+                "patient_id": patient.id,
+                "current_weight": patient.current_weight,
+                "weight_date": plain(patient.weight_date),
+                **{name: [low[index], high[index]] for name, (low, high) in needs.items()},
+            }
+            for index, patient in enumerate(patients)
+        ],
+    )
+
+
+@api.route("/formulas")
+def formulas():
+    """Return every tube feed formula with its category and kcal/mL"""
+    return jsonify(
+        formulas=[
+            {
+                "id": formula.id,
+                "name": formula.name,
+                "category_id": formula.category_id,
+                "category": formula.category,
+                "kcal_per_ml": formula.kcal_per_ml,
+            }
+            for formula in get_catalog()
+        ]
+    )
+
+
+@api.route("/tubefeed/regimens", methods=["POST"])
+def tubefeed_regimens():
+    """Evaluate nutrition provided by many tube feed regimens, as /api/tubefeed/regimens does"""
+    try:
+        results = evaluate_request(get_catalog(), json_body())
+    except KeyError as e:
+        return error(f"Missing field: {e.args[0]}")
+    except (TypeError, ValueError) as e:
+        return error(f"Invalid regimen request: {e}")
+
+    return jsonify(columns=NUTRITION_COLUMNS, regimens=results)
+
+
+def init_api(app):
+    """Serve the API, exempt from CSRF protection, as its clients authenticate with tokens rather than cookies"""
+    app.extensions["csrf"].exempt(api)
+    app.register_blueprint(api)
@@ -1,87 +1,225 @@
 # Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
 
-import bcrypt
+import click
+import math
+import os
 import re
 import secrets
+import time
 
 from datetime import datetime
-from flask import Flask, flash, redirect, render_template, request, session
-from flask_session import Session
+from flask import (
+    Flask,
+    Response,
+    flash,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    session,
+    stream_with_context,
+    url_for,
+)
 from flask_wtf.csrf import CSRFProtect
+from sqlalchemy.engine import make_url
 from sqlalchemy.exc import IntegrityError
-from tempfile import mkdtemp
 
-from extensions import db
+from admission import admit_patients, merge_duplicate_patients
+from api import create_token, init_api, login_or_token_required
+from auth import authenticate, get_role, hash_password, init_auth
+from caching import (
+    cached,
+    catalog_fingerprint,
+    init_caching,
+    patient_fingerprint,
+    set_cache_headers,
+)
+from catalog import get_catalog, load_catalog
+from exports import EXPORT_DATASETS, EXPORT_FORMATS, export
+from extensions import POOL_OPTIONS, db
 from forms import (
+    CensusImportForm,
     LoginForm,
     PatientEntryForm,
     PatientInfoForm,
+    RegimenGridForm,
     RegistrationForm,
     TubeFeedForm,
     WeightForm,
+    WeightImportForm,
 )
-from helpers import login_required, weight_change
+from helpers import (
+    HISTORY_ORDER,
+    MAX_ROUNDS_PATIENTS,
+    ROSTER_ORDER,
+    ROUNDS_WEIGHTS,
+    WEIGHT_CHANGE_LIMITS,
+    WEIGHT_CHECK_COLUMNS,
+    batch_weight_check,
+    dashboard_counts_query,
+    dashboard_query,
+    history_query,
+    keyset_page,
+    login_required,
+    own_patient,
+    page_size_arg,
+    patient_search_query,
+    refresh_patient_summaries,
+    roster_query,
+    rounds_query,
+    update_weight_check,
+    weight_changes,
+    weight_check_query,
+)
+from instrumentation import init_instrumentation
+from jobs import enqueue, init_jobs, job, job_status
 from models import (
+    ApiToken,
     User,
-    Role,
     Patient,
     MonthlyWeights,
+    PatientSummary,
     WeightCheck,
-    Formula,
-    Category,
-    Nutrients,
-    Minerals,
-    Fluids,
+    create_missing_indexes,
+)
+from needs import (
+    CONDITIONS,
+    EQUATIONS,
+    SEXES,
+    estimate_needs,
+    evaluate_needs,
+    needs_options,
 )
-from csv_to_db import load_data_from_csv
+from query_plans import check_query_plans
+from regimens import (
+    DIET_FILTERS,
+    NUTRITION_COLUMNS,
+    evaluate_grid,
+    evaluate_request,
+    rate_range,
+    recommend_formulas,
+)
+from sessions import init_session
+from weight_import import import_format, import_weights
+from weight_series import weight_series
 
 
 # Configure application
-def create_app():
+def create_app(config=None):
+    """Create and configure the app
+
+    Startup does no database work, so workers boot quickly. Tables, indexes, and reference
+    data are set up once with the `flask init-db` command.
+    """
     app = Flask(__name__)
 
-    # Configure session to use filesystem (instead of signed cookies)
-    app.config["SESSION_FILE_DIR"] = mkdtemp()
+    # Configure server-side sessions, kept in memory unless another backend is chosen
+    app.config["SESSION_BACKEND"] = "memory"
     app.config["SESSION_PERMANENT"] = False
-    app.config["SESSION_TYPE"] = "filesystem"
-
-    # Set the secret key in the app's configuration
-    app.config["SECRET_KEY"] = secrets.token_hex(32)
 
     # Configure SQLAlchemy database
     app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///diet.db"
 
-    db.init_app(app)
+    # Read settings from FLASK_ environment variables, e.g. FLASK_SECRET_KEY and FLASK_SESSION_BACKEND
+    app.config.from_prefixed_env()
 
-    with app.app_context():
-        db.create_all()
+    # Apply any overrides, e.g. a scratch database for benchmarks
+    if config is not None:
+        app.config.update(config)
+
+    # Without a configured secret key, CSRF tokens and cookie sessions only work in this process
+    if not app.config["SECRET_KEY"]:
+        app.config["SECRET_KEY"] = secrets.token_hex(32)
+
+    # Size the connection pool for threaded workers, unless set in SQLALCHEMY_ENGINE_OPTIONS
+    # In-memory SQLite databases share a single connection, so take no pool options
+    if make_url(app.config["SQLALCHEMY_DATABASE_URI"]).database not in (None, "", ":memory:"):
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+            **POOL_OPTIONS,
+            **app.config.get("SQLALCHEMY_ENGINE_OPTIONS", {}),
+        }
+
+    db.init_app(app)
 
     # Initialize CSRF protection
     csrf = CSRFProtect(app)
 
-    # Initialize the session with the Flask app
-    Session(app)
+    # Serve the JSON API at /api/v1, authenticated by tokens rather than sessions and CSRF
+    init_api(app)
+
+    # Install the configured session backend
+    init_session(app)
+
+    # Set up password hashing; worker processes start with the first login
+    init_auth(app)
+
+    # Version static file URLs for long-lived caching and track flashes for caching headers
+    init_caching(app)
+
+    # Set up the background job queue; worker threads start with the first job
+    init_jobs(app)
+
+    # Record per-route timings and SQL counts, served at /metrics, when INSTRUMENTATION is set
+    if app.config.get("INSTRUMENTATION"):
+        init_instrumentation(app)
 
     return app
 
 
 app = create_app()
 
-# Load data from CSV files if not loaded into database
-load_data_from_csv("data/formulas.csv", Formula, "id")
-load_data_from_csv("data/categories.csv", Category, "id")
-load_data_from_csv("data/nutrients.csv", Nutrients, "formula_id")
-load_data_from_csv("data/minerals.csv", Minerals, "formula_id")
-load_data_from_csv("data/fluids.csv", Fluids, "formula_id")
+
+@app.cli.command("init-db")
+@click.option(
+    "--upsert",
+    is_flag=True,
+    help="Reload every reference data file over existing rows.",
+)
+@click.option(
+    "--merge-duplicates",
+    is_flag=True,
+    help="Merge patients entered more than once, so the unique patient index can be created.",
+)
+def init_db_command(upsert, merge_duplicates):
+    """Create tables and indexes and load reference data from CSV files
+
+    Safe to run repeatedly: existing tables and indexes are kept, and reference data is
+    only loaded into empty tables unless --upsert is given.
+    """
+
+    # Imported here so the web workers don't load the CSV tooling
+    from csv_to_db import seed_reference_data
+
+    db.create_all()
+
+    if merge_duplicates:
+        click.echo(f"Merged {merge_duplicate_patients()} duplicate patients")
+
+    # Bring databases created before indexes were declared up to date
+    for name in create_missing_indexes():
+        click.echo(
+            f"Skipped unique index {name}, as existing rows are duplicates;"
+            " run again with --merge-duplicates to merge them",
+            err=True,
+        )
+
+    # Summarize weight checks made before the dashboard summaries existed
+    if db.session.scalar(db.select(PatientSummary.patient_id).limit(1)) is None:
+        summaries = refresh_patient_summaries()
+        db.session.commit()
+        if summaries:
+            click.echo(f"Summarized {summaries} patients for the dashboard")
+
+    # Load data from CSV files if not loaded into database
+    seed_reference_data(upsert=upsert)
+
+    click.echo(f"Database ready with {len(load_catalog())} formulas")
 
 
 @app.after_request
 def after_request(response):
-    """Ensure responses aren't cached"""
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Expires"] = 0
-    response.headers["Pragma"] = "no-cache"
-    return response
+    """Ensure responses aren't cached unless their route has a caching policy"""
+    return set_cache_headers(response)
 
 
 @app.route("/login", methods=["GET", "POST"])
@@ -96,29 +234,25 @@ def login():
 
     # User reached route via POST (as by submitting a form via POST)
     if request.method == "POST":
-        if form.validate_on_submit():
+        if not form.validate_on_submit():
             # Ensure username was submitted
             if not form.username.data:
                 flash("Must provide username")
-                return render_template("login_user.html", form=form)
 
             # Ensure password was submitted
             elif not form.password.data:
                 flash("Must provide password")
-                return render_template("login_user.html", form=form)
 
-        # Query database for username
-        user = User.query.filter_by(username=form.username.data).first()
+            return render_template("login_user.html", form=form)
 
-        # Ensure username exists and password is correct
-        if not user or not bcrypt.checkpw(
-            form.password.data.encode("utf-8"), user.hash
-        ):
+        # Ensure username exists and password is correct, checked off the request thread
+        user_id = authenticate(form.username.data, form.password.data)
+        if user_id is None:
             flash("Invalid username and/or password")
             return render_template("login_user.html", form=form)
 
         # Remember which user has logged in
-        session["user_id"] = user.id
+        session["user_id"] = user_id
 
         # Redirect user to home page
         return redirect("/")
@@ -192,34 +326,21 @@ def register():
                 return render_template("register_user.html", form=form)
             else:
                 # If not, hash password using hashing algorithm
-                hashed_password = bcrypt.hashpw(
-                    password.encode("utf-8"), bcrypt.gensalt()
-                )
+                hashed_password = hash_password(password)
 
                 # Insert new user with hashed password into database
                 new_user = User(username=username, hash=hashed_password)
                 db.session.add(new_user)
 
-                # Get the default role object
-                role = Role.query.filter_by(name="user").first()
-
-                # Create the default role if it doesn't exist
-                if role is None:
-                    role = Role(name="user")
-                    db.session.add(role)
-
-                # Add the default role to the user's roles
-                new_user.roles.append(role)
+                # Add the default role, created if it doesn't exist, to the user's roles
+                new_user.roles.append(get_role("user"))
 
                 try:
                     db.session.commit()
                     flash("Registration successful!", "success")
 
-                    # If successful, fetch new user from the database
-                    user = User.query.filter_by(username=username).first()
-
                     # Login in the new user and redirect to home page
-                    session["user_id"] = user.id
+                    session["user_id"] = new_user.id
                     return redirect("/")
 
                 # If insert fails, provide error message
@@ -243,12 +364,55 @@ def index():
     """Show roster of patients"""
 
     form = PatientInfoForm()
-
-    # Query database for all patients under care of the user
-    patients = Patient.query.filter_by(provider_id=session["user_id"]).all()
+    page_size = page_size_arg(request.args)
+
+    # Query database for one page of patients under care of the user, in name order
+    try:
+        patients, next_cursor = keyset_page(
+            roster_query(session["user_id"]),
+            ROSTER_ORDER,
+            cursor=request.args.get("cursor"),
+            page_size=page_size,
+        )
+    except ValueError as e:
+        flash(str(e))
+        return redirect("/")
 
     # Render index template, passing in the necessary data
-    return render_template("index.html", patients=patients, form=form)
+    return render_template(
+        "index.html",
+        patients=patients,
+        form=form,
+        next_cursor=next_cursor,
+        page_size=page_size,
+    )
+
+
+@app.route("/dashboard")
+@login_required
+def dashboard():
+    """Show the user's patients with a clinically significant weight change, or every patient with show=all"""
+
+    show_all = request.args.get("show") == "all"
+
+    # Count patients, patients with a weight check, and flagged patients in one query
+    patients, summarized, flagged = db.session.execute(
+        dashboard_counts_query(session["user_id"])
+    ).one()
+
+    # Query the summaries of flagged patients, or of every patient with show=all
+    rows = db.session.execute(dashboard_query(session["user_id"], show_all)).all()
+
+    return render_template(
+        "dashboard.html",
+        rows=rows,
+        show_all=show_all,
+        patients=patients,
+        summarized=summarized,
+        flagged=flagged,
+        columns=WEIGHT_CHECK_COLUMNS,
+        limits=WEIGHT_CHANGE_LIMITS,
+    )
 
 
 @app.route("/patient_entry", methods=["GET", "POST"])
@@ -289,7 +453,14 @@ def patient_entry():
                     provider_id=session["user_id"],
                 )
                 db.session.add(new_patient)
-                db.session.commit()
+
+                # Another request may have entered the same patient since the check
+                try:
+                    db.session.commit()
+                except IntegrityError:
+                    db.session.rollback()
+                    flash("Patient already exists")
+                    return redirect("/patient_entry")
 
                 flash("Patient successfully added!")
                 return redirect("/")
@@ -304,8 +475,107 @@ def patient_entry():
         return render_template("patient_entry.html", form=form)
 
 
+@app.route("/patient_admission", methods=["GET", "POST"])
+@login_required
+def patient_admission():
+    """Queue admission of the patients of a census file, such as an ADT feed export"""
+
+    form = CensusImportForm()
+
+    # User reached route via POST (as by submitting a form via POST)
+    if request.method == "POST":
+        if form.validate_on_submit():
+            upload = form.file.data
+
+            try:
+                file_format = import_format(upload.filename or "")
+            except ValueError as e:
+                flash(str(e))
+                return render_template("patient_admission.html", form=form)
+
+            # Save the upload, so the admission job can stream it from disk
+            directory = os.path.join(app.instance_path, "imports")
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(
+                directory, f"{secrets.token_hex(16)}.{file_format}"
+            )
+            upload.save(path)
+
+            # A census is admitted in one transaction, so a failed attempt is safely retried
+            job_id = enqueue(
+                "patient_admission",
+                user_id=session["user_id"],
+                path=path,
+                provider_id=session["user_id"],
+                file_format=file_format,
+            )
+
+            if request.accept_mimetypes.best == "application/json":
+                return (
+                    jsonify(job_id=job_id, status_url=url_for("job_detail", job_id=job_id)),
+                    202,
+                )
+
+            flash(
+                f"Patients are being admitted in the background (job {job_id}), see /jobs/{job_id} for the report"
+            )
+            return redirect("/")
+
+        else:
+            for field, errors in form.errors.items():
+                for error in errors:
+                    flash(error)
+
+    return render_template("patient_admission.html", form=form)
+
+
+@job("patient_admission")
+def patient_admission_job(path, provider_id, file_format=None):
+    """Admit the patients of a saved census file, removing it once admitted
+
+    The file is kept for retries, and in instance/imports for inspection if every attempt fails.
+    """
+
+    report = admit_patients(path, provider_id=provider_id, file_format=file_format)
+    os.remove(path)
+    return report
+
+
+@app.cli.command("admit-patients")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--provider-id",
+    type=int,
+    help="Provider admitting every patient, if the file has no provider_id column.",
+)
+@click.option(
+    "--format",
+    "file_format",
+    type=click.Choice(["csv", "jsonl"]),
+    help="File format, if not given by the file extension.",
+)
+def admit_patients_command(path, provider_id, file_format):
+    """Admit the patients of a CSV or JSON lines census file, moving known patients to new beds"""
+
+    try:
+        report = admit_patients(path, provider_id=provider_id, file_format=file_format)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    for error in report["errors"]:
+        click.echo(f"line {error['line']}: {error['error']}", err=True)
+    if report["errors_truncated"]:
+        click.echo("... more errors not listed", err=True)
+
+    click.echo(
+        f"Admitted {report['admitted']} and transferred {report['transferred']} of {report['rows']} patients"
+        f" in {report['seconds']:.2f}s, {report['existing']} already admitted, {report['rejected']} rejected"
+    )
+
+
 @app.route("/patient_info/<int:patient_id>", methods=["GET", "POST"])
 @login_required
+@cached("revalidate", patient_fingerprint)
 def patient_info(patient_id):
     """Show patient information"""
 
@@ -314,45 +584,38 @@ def patient_info(patient_id):
 
     if patient is None:
         flash("Patient not found")
+        return redirect("/")
 
     # Query the patient's most recent weight check from the database
-    weight_check_row = WeightCheck.query.filter_by(patient_id=patient_id).first()
+    weight_check_row = weight_check_query(patient_id).first()
 
-    # Query the patient's monthly weights from the database
-    monthly_weights = (
-        MonthlyWeights.query.filter_by(patient_id=patient_id)
-        .order_by(MonthlyWeights.weight_date.desc())
-        .all()
-    )
+    # Read the patient's weights from the weight series, newest first
+    series = weight_series.get(patient_id)
+    monthly_weights = series.rows(descending=True)
 
     # Grab timestamp for calculation
     timestamp = datetime.now()
 
-    # Get the current weight and convert it to kgs for calculations
-    weight_query = (
-        MonthlyWeights.query.filter_by(patient_id=patient_id)
-        .order_by(MonthlyWeights.weight_date.desc())
-        .first()
-    )
+    # Get the current weight for calculations
+    latest_weight = series.latest()
 
-    if weight_query is not None:
-        current_weight = weight_query.patient_weight
-        current_weight_kg = current_weight / 2.2
+    if latest_weight is not None:
+        current_weight = latest_weight.patient_weight
     else:
         current_weight = 0.0
-        current_weight_kg = 0.0
 
-    # Calculate low and high limits for kcals
-    kcals_low = "{:.1f}".format(current_weight_kg * 25)
-    kcals_high = "{:.1f}".format(current_weight_kg * 30)
-
-    # Calculate low and high limits for Protein
-    protein_low = "{:.1f}".format(current_weight_kg * 1.2)
-    protein_high = "{:.1f}".format(current_weight_kg * 1.5)
-
-    # Calculate low and high limits for Fluids
-    fluids_low = "{:.1f}".format(current_weight_kg * 30)
-    fluids_high = "{:.1f}".format(current_weight_kg * 35)
+    # Calculate low and high limits for kcals, protein, and fluids, by the equation and
+    # condition chosen on the page, or kcal/kg for a general condition
+    try:
+        options = needs_options(request.args)
+        needs = estimate_needs(current_weight, age=patient.age, **options)
+    except ValueError as e:
+        flash(f"{e}. Showing needs by kcal/kg instead.")
+        options = {"equation": "weight", "condition": "general"}
+        needs = estimate_needs(current_weight)
+    kcals_low, kcals_high = ("{:.1f}".format(value) for value in needs["kcals"])
+    protein_low, protein_high = ("{:.1f}".format(value) for value in needs["protein_g"])
+    fluids_low, fluids_high = ("{:.1f}".format(value) for value in needs["fluids_ml"])
 
     return render_template(
         "patient_info.html",
@@ -367,6 +630,95 @@ def patient_info(patient_id):
         protein_high=protein_high,
         fluids_low=fluids_low,
         fluids_high=fluids_high,
+        equation=EQUATIONS[options["equation"]].label,
+        condition=CONDITIONS[options["condition"]].label,
+        equations=EQUATIONS,
+        conditions=CONDITIONS,
+        sexes=SEXES,
+    )
+
+
+@app.route("/rounds")
+@login_required
+def rounds():
+    """Show one report of many patients for rounds, from a fixed number of queries
+
+    Patients on the user's roster are chosen by ids (ids=1,2,3, or one ids parameter per
+    patient) and listed in that order, with needs estimated by kcal/kg for an optional
+    condition.
+    """
+
+    try:
+        patient_ids = list(
+            dict.fromkeys(
+                int(part)
+                for value in request.args.getlist("ids")
+                for part in value.split(",")
+                if part.strip()
+            )
+        )
+    except ValueError:
+        flash("Patient ids must be whole numbers")
+        return redirect("/")
+
+    if not patient_ids:
+        flash("Select patients for rounds")
+        return redirect("/")
+    if len(patient_ids) > MAX_ROUNDS_PATIENTS:
+        flash(f"Rounds can include up to {MAX_ROUNDS_PATIENTS} patients")
+        return redirect("/")
+
+    condition = request.args.get("condition") or "general"
+    if condition not in CONDITIONS:
+        flash(f"Unknown condition {condition!r}. Showing needs for a general condition.")
+        condition = "general"
+
+    # Query every patient on the user's roster with their weight check in one query
+    patients = {
+        patient.id: (patient, weight_check_row)
+        for patient, weight_check_row in db.session.execute(
+            rounds_query(patient_ids, session["user_id"])
+        )
+    }
+
+    missing = [patient_id for patient_id in patient_ids if patient_id not in patients]
+    if missing:
+        flash(f"No patient with id {', '.join(map(str, missing))}")
+    patient_ids = [patient_id for patient_id in patient_ids if patient_id in patients]
+
+    # Read every patient's weights from the weight series, in at most three queries
+    series = weight_series.get_many(patient_ids)
+    latest_weights = [series[patient_id].latest() for patient_id in patient_ids]
+
+    # Calculate needs of every patient in one batch
+    needs = evaluate_needs(
+        [None if latest is None else latest.patient_weight for latest in latest_weights],
+        condition=condition,
+    )
+
+    reports = [
+        {
+            "patient": patients[patient_id][0],
+            "weight_check_row": patients[patient_id][1],
+            "latest": latest,
+            "monthly_weights": series[patient_id].recent(ROUNDS_WEIGHTS),
+            "weight_count": len(series[patient_id]),
+            "needs": {
+                name: (low[index], high[index]) for name, (low, high) in needs.items()
+            },
+        }
+        for index, (patient_id, latest) in enumerate(zip(patient_ids, latest_weights))
+    ]
+
+    return render_template(
+        "rounds.html",
+        reports=reports,
+        patient_ids=patient_ids,
+        condition=condition,
+        conditions=CONDITIONS,
+        columns=WEIGHT_CHECK_COLUMNS,
+        limits=WEIGHT_CHANGE_LIMITS,
+        timestamp=datetime.now(),
     )
 
 
@@ -378,14 +730,15 @@ def weight_entry():
     # Create an instance of WeightForm
     form = WeightForm()
 
-    patients = Patient.query.all()
-
     choices = [("", "Select a patient...")]
 
-    for patient in patients:
-        choice = (patient.id, patient.name_last + ", " + patient.name_first)
+    # Only the submitted or preselected patient is loaded; others are found with the patient search
+    patient_id = request.values.get("patient", type=int)
+    patient = db.session.get(Patient, patient_id) if patient_id is not None else None
 
-        choices.append(choice)
+    if patient is not None:
+        choices.append((patient.id, patient.name_last + ", " + patient.name_first))
+        form.patient.data = str(patient.id)
 
     # Populate the patient dropdown menu
     form.patient.choices = choices
@@ -411,6 +764,10 @@ def weight_entry():
             # Commit changes to database
             db.session.commit()
 
+            # Recalculate the weight check intervals the new weight affects
+            update_weight_check(int(patient), new_weight.id)
+            db.session.commit()
+
             flash("Weight entry added successfully!")
             return redirect("/patient_info/" + str(patient))
 
@@ -427,47 +784,218 @@ def weight_entry():
         return render_template("weight_entry.html", form=form)
 
 
+@app.route("/weight_import", methods=["GET", "POST"])
+@login_required
+def weight_import():
+    """Queue an import of a file of patient weights, such as a bed scale export"""
+
+    form = WeightImportForm()
+
+    # User reached route via POST (as by submitting a form via POST)
+    if request.method == "POST":
+        if form.validate_on_submit():
+            upload = form.file.data
+
+            try:
+                file_format = import_format(upload.filename or "")
+            except ValueError as e:
+                flash(str(e))
+                return render_template("weight_import.html", form=form)
+
+            # Save the upload in chunks, so the import job can stream it from disk
+            directory = os.path.join(app.instance_path, "imports")
+            os.makedirs(directory, exist_ok=True)
+            path = os.path.join(
+                directory, f"{secrets.token_hex(16)}.{file_format}"
+            )
+            upload.save(path)
+
+            # A failed import may have committed some batches, so it isn't retried
+            job_id = enqueue(
+                "weight_import",
+                user_id=session["user_id"],
+                max_attempts=1,
+                path=path,
+                importer_id=session["user_id"],
+                file_format=file_format,
+            )
+
+            if request.accept_mimetypes.best == "application/json":
+                return (
+                    jsonify(job_id=job_id, status_url=url_for("job_detail", job_id=job_id)),
+                    202,
+                )
+
+            flash(
+                f"Weights are being imported in the background (job {job_id}), see /jobs/{job_id} for the report"
+            )
+            return redirect("/")
+
+        else:
+            for field, errors in form.errors.items():
+                for error in errors:
+                    flash(error)
+
+    return render_template("weight_import.html", form=form)
+
+
+@job("weight_import")
+def weight_import_job(path, importer_id, file_format=None):
+    """Import a saved weight file, removing it once imported"""
+
+    try:
+        return import_weights(path, importer_id, file_format=file_format)
+    finally:
+        os.remove(path)
+
+
+@app.cli.command("import-weights")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--user-id", type=int, required=True, help="User recorded as entering the weights."
+)
+@click.option(
+    "--format",
+    "file_format",
+    type=click.Choice(["csv", "jsonl"]),
+    help="File format, if not given by the file extension.",
+)
+def import_weights_command(path, user_id, file_format):
+    """Import a CSV or JSON lines file of patient weights"""
+
+    try:
+        report = import_weights(path, user_id, file_format=file_format)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+
+    for error in report["errors"]:
+        click.echo(f"line {error['line']}: {error['error']}", err=True)
+    if report["errors_truncated"]:
+        click.echo("... more errors not listed", err=True)
+
+    click.echo(
+        f"Imported {report['imported']} of {report['rows']} rows for {report['patients']} patients"
+        f" in {report['seconds']:.2f}s, {report['rejected']} rejected"
+    )
+
+
+@app.route("/export/<dataset>")
+@login_required
+def export_data(dataset):
+    """Stream the user's patients' weights, weight checks, or nutritional needs as a file
+
+    Optional query parameters: format (csv, jsonl, or columnar; default csv) and patient_id.
+    """
+
+    file_format = request.args.get("format", "csv")
+
+    # Only patients under care of the user are exported
+    try:
+        chunks = export(
+            dataset,
+            file_format,
+            provider_id=session["user_id"],
+            patient_id=request.args.get("patient_id", type=int),
+        )
+    except ValueError as e:
+        return jsonify(error=str(e)), 404 if dataset not in EXPORT_DATASETS else 400
+
+    extension = "csv" if file_format == "csv" else "jsonl"
+    return Response(
+        stream_with_context(chunks),
+        mimetype=EXPORT_FORMATS[file_format],
+        headers={
+            "Content-Disposition": f"attachment; filename={dataset}.{extension}"
+        },
+    )
+
+
+@app.cli.command("export")
+@click.argument("dataset", type=click.Choice(list(EXPORT_DATASETS)))
+@click.option(
+    "--format",
+    "file_format",
+    type=click.Choice(list(EXPORT_FORMATS)),
+    default="csv",
+    show_default=True,
+)
+@click.option("--provider-id", type=int, help="Only export patients under care of this user.")
+@click.option("--patient-id", type=int, help="Only export this patient.")
+@click.option(
+    "--output", type=click.File("w"), default="-", help="File to write (default stdout)."
+)
+def export_command(dataset, file_format, provider_id, patient_id, output):
+    """Export weights, weight checks, or nutritional needs of every patient"""
+
+    for chunk in export(dataset, file_format, provider_id=provider_id, patient_id=patient_id):
+        output.write(chunk)
+
+
+@app.route("/patients/search")
+@login_required
+def patient_search():
+    """Find patients by patient id, or by the start of "last name" or "last name, first name" """
+
+    query = request.args.get("q", "").strip().lower()
+    limit = page_size_arg(request.args, default=10)
+
+    if not query:
+        return jsonify(patients=[])
+
+    if query.isdigit():
+        patients = Patient.query.filter_by(id=int(query)).all()
+    else:
+        name_last, _, name_first = (part.strip() for part in query.partition(","))
+        if not (name_last or name_first):
+            return jsonify(patients=[])
+
+        # A query starting with a comma, e.g. ", jane", only matches first names
+        patients = patient_search_query(name_last, name_first, limit).all()
+
+    return jsonify(
+        patients=[
+            {
+                "id": patient.id,
+                "name": patient.name_last + ", " + patient.name_first,
+                "bed": patient.bed,
+            }
+            for patient in patients
+        ]
+    )
+
+
 @app.route("/weight_check/<int:patient_id>", methods=["GET", "POST"])
 @login_required
 def weight_check(patient_id):
     """Perform weight check at given intervals"""
 
-    weight_check_row = WeightCheck.query.filter_by(patient_id=patient_id).first()
+    weight_check_row = weight_check_query(patient_id).first()
 
     # If a row doesn't exist yet, create a new one
     if weight_check_row is None:
         weight_check_row = WeightCheck(patient_id=patient_id)
 
-    # Get the current weight and the weight date for the patient
-    current_weight = (
-        MonthlyWeights.query.filter_by(patient_id=patient_id)
-        .order_by(MonthlyWeights.weight_date.desc())
-        .first()
-    )
+    # Load the patient's weights once and calculate percent weight change at 1, 3, 6, and 12 month intervals
+    current_weight, changes = weight_changes(patient_id)
 
     if current_weight is None:
         flash("No current weight data available")
         return redirect("/patient_info/" + str(patient_id))
     else:
-        weight_date = current_weight.weight_date
-
-        # Calculate percent weight change at 1, 3, 6, and 12 month intervals
-        one_month = weight_change(patient_id, 1, current_weight, weight_date)
-        three_month = weight_change(patient_id, 3, current_weight, weight_date)
-        six_month = weight_change(patient_id, 6, current_weight, weight_date)
-        twelve_month = weight_change(patient_id, 12, current_weight, weight_date)
-
         # Update weight check fields
-        weight_check_row.current_weight = current_weight.patient_weight
-        weight_check_row.one_month = one_month
-        weight_check_row.three_month = three_month
-        weight_check_row.six_month = six_month
-        weight_check_row.twelve_month = twelve_month
+        weight_check_row.current_weight = current_weight
+        weight_check_row.one_month = changes[1]
+        weight_check_row.three_month = changes[3]
+        weight_check_row.six_month = changes[6]
+        weight_check_row.twelve_month = changes[12]
         weight_check_row.timestamp = datetime.now()
 
         # Add the row to the session
         db.session.add(weight_check_row)
 
+        # Bring the patient's dashboard summary up to date
+        refresh_patient_summaries(patient_ids=[patient_id])
+
         # Commit changes to database
         db.session.commit()
 
@@ -475,6 +1003,142 @@ def weight_check(patient_id):
         return redirect("/patient_info/" + str(patient_id))
 
 
+@app.route("/weight_check/batch", methods=["POST"])
+@login_required
+def weight_check_batch():
+    """Queue weight checks for every patient under care of the user"""
+
+    job_id = enqueue(
+        "weight_check_batch", user_id=session["user_id"], provider_id=session["user_id"]
+    )
+
+    flash(
+        f"Weight checks for your patients are being updated in the background (job {job_id})"
+    )
+    return redirect("/")
+
+
+@job("weight_check_batch")
+def weight_check_batch_job(provider_id=None):
+    """Perform weight checks for every patient, or every patient under care of one provider"""
+
+    start = time.perf_counter()
+    updated = batch_weight_check(provider_id=provider_id)
+    elapsed = time.perf_counter() - start
+
+    return {
+        "updated": updated,
+        "seconds": round(elapsed, 3),
+        "patients_per_second": round(updated / max(elapsed, 1e-9), 1),
+    }
+
+
+@app.route("/jobs/<int:job_id>")
+@login_required
+def job_detail(job_id):
+    """Return the status and result of a background job started by the user"""
+
+    record = app.extensions["jobs"].get(job_id)
+
+    if record is None or record.user_id != session["user_id"]:
+        return jsonify(error="Job not found"), 404
+
+    return jsonify(job_status(record))
+
+
+@app.cli.command("run-jobs")
+@click.option(
+    "--workers", type=int, default=2, show_default=True, help="Jobs run at once."
+)
+def run_jobs_command(workers):
+    """Run queued background jobs until interrupted
+
+    Start one or more of these next to the web workers (with FLASK_JOB_WORKERS=0 there)
+    to run jobs in their own processes.
+    """
+
+    queue = app.extensions["jobs"]
+    if app.config.get("JOB_BACKEND", "database") != "database":
+        raise click.ClickException("Only jobs in the database can be run by another process")
+
+    queue.workers = workers
+    queue.start()
+    click.echo(f"Running jobs with {workers} workers, press Ctrl+C to stop")
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        click.echo("Stopping after current jobs finish")
+        queue.stop()
+
+
+@app.cli.command("weight-check-all")
+@click.option(
+    "--provider-id", type=int, help="Only check patients under care of this user."
+)
+def weight_check_all_command(provider_id):
+    """Perform weight checks for every patient in one transaction"""
+
+    start = time.perf_counter()
+    updated = batch_weight_check(provider_id=provider_id)
+    elapsed = time.perf_counter() - start
+
+    click.echo(
+        f"Updated {updated} weight checks in {elapsed:.3f}s ({updated / max(elapsed, 1e-9):.1f} patients/sec)"
+    )
+
+
+@app.cli.command("create-api-token")
+@click.argument("username")
+@click.option("--name", required=True, help="What the token is for, e.g. the client using it.")
+def create_api_token_command(username, name):
+    """Create an API token for a user, printed once; it reaches only that user's patients"""
+
+    user_id = db.session.scalar(db.select(User.id).filter_by(username=username))
+    if user_id is None:
+        raise click.ClickException(f"No user named {username}")
+
+    click.echo(create_token(user_id, name))
+
+
+@app.cli.command("revoke-api-token")
+@click.argument("token_id", type=int)
+def revoke_api_token_command(token_id):
+    """Revoke an API token by its id"""
+
+    deleted = db.session.execute(db.delete(ApiToken).filter_by(id=token_id)).rowcount
+    db.session.commit()
+    if not deleted:
+        raise click.ClickException(f"No API token with id {token_id}")
+    click.echo(f"Revoked API token {token_id}")
+
+
+@app.cli.command("list-api-tokens")
+def list_api_tokens_command():
+    """List API tokens by id, user, name, and creation time"""
+
+    for token_id, username, name, created in db.session.execute(
+        db.select(ApiToken.id, User.username, ApiToken.name, ApiToken.created)
+        .join(User, User.id == ApiToken.user_id)
+        .order_by(ApiToken.id)
+    ):
+        click.echo(f"{token_id}\t{username}\t{name}\t{created:%Y-%m-%d %H:%M}")
+
+
+@app.cli.command("check-query-plans")
+def check_query_plans_command():
+    """Fail if any hot route query falls back to a full table scan"""
+
+    failures = 0
+    for name, details, scans in check_query_plans():
+        failures += len(scans)
+        click.echo(f"{'FAIL' if scans else 'ok'}: {name}: {'; '.join(details)}")
+
+    if failures:
+        raise click.ClickException(f"{failures} full scans in hot queries")
+
+
 @app.route("/history")
 @login_required
 def history():
@@ -482,11 +1146,28 @@ def history():
 
     # When the user visits the history page...
     if request.method == "GET":
-        # Retrieve all weights associated with the patient from the database
-        history = MonthlyWeights.query.filter_by(user_id=session["user_id"]).all()
+        page_size = page_size_arg(request.args)
+
+        # Retrieve one page of weights entered by the user, newest weight date first
+        try:
+            history, next_cursor = keyset_page(
+                history_query(session["user_id"]),
+                HISTORY_ORDER,
+                cursor=request.args.get("cursor"),
+                page_size=page_size,
+                descending=True,
+            )
+        except ValueError as e:
+            flash(str(e))
+            return redirect("/history")
 
         # Display the history in a table
-        return render_template("history.html", history=history)
+        return render_template(
+            "history.html",
+            history=history,
+            next_cursor=next_cursor,
+            page_size=page_size,
+        )
 
 
 @app.route("/tubefeed", methods=["GET", "POST"])
@@ -497,8 +1178,9 @@ def tubefeed():
     # Create an instance of TubeFeedForm
     form = TubeFeedForm()
 
-    # Populate the formulas dropdown menu
-    form.formulas.choices = [(f.id, f.name) for f in Formula.query.all()]
+    # Populate the formulas dropdown menu from the preloaded formula catalog
+    catalog = get_catalog()
+    form.formulas.choices = list(catalog.choices)
 
     # User reached route via POST (as by submitting a form via POST)
     if request.method == "POST":
@@ -508,31 +1190,25 @@ def tubefeed():
             tube_feed_rate = form.tube_feed_rate.data
             time = form.time.data
 
-            # Retreive formula id and name
-            formula = Formula.query.filter_by(id=formula_id).first()
-            selected_formula = Formula.query.get(formula_id)
-            formula_name = selected_formula.name
+            # Retreive formula with its nutrient and fluid data
+            formula = catalog.get(formula_id)
 
             if formula is not None:
+                formula_name = formula.name
+
                 # Calculate kcals provided
                 kcal_per_ml = formula.kcal_per_ml
                 kcals_total = "{:.1f}".format(kcal_per_ml * tube_feed_rate * time)
 
                 # Calculate protein provided in grams
-                formula_nutrients = Nutrients.query.filter_by(
-                    formula_id=formula_id
-                ).first()
-
-                protein = formula_nutrients.protein_g
+                protein = formula.protein_g
 
                 protein_per_mL = protein / 1000
 
                 protein_total = "{:.1f}".format(protein_per_mL * tube_feed_rate * time)
 
                 # Calculate fluids provided in mL
-                formula_fluids = Fluids.query.filter_by(formula_id=formula_id).first()
-
-                free_water_percent = formula_fluids.free_water_percent
+                free_water_percent = formula.free_water_percent
 
                 free_water_per_mL = free_water_percent / 100
 
@@ -562,5 +1238,179 @@ def tubefeed():
         return render_template("tubefeed.html", form=form)
 
 
+@app.route("/tubefeed/regimens")
+@login_required
+@cached("reference", catalog_fingerprint)
+def tubefeed_regimens():
+    """Compare nutrition provided by every formula across a range of tube feed rates"""
+
+    # Regimen comparisons are read-only, so the form is submitted via GET
+    form = RegimenGridForm(request.args, meta={"csrf": False})
+
+    regimens = []
+    if request.args and form.validate():
+        try:
+            rates = rate_range(
+                form.rate_start.data, form.rate_stop.data, form.rate_step.data
+            )
+            regimens = evaluate_grid(get_catalog(), rates, form.time.data)
+        except ValueError as e:
+            flash(str(e))
+    else:
+        for field, errors in form.errors.items():
+            for error in errors:
+                flash(error)
+
+    return render_template("tubefeed_regimens.html", form=form, regimens=regimens)
+
+
+@app.route("/api/tubefeed/regimens", methods=["POST"])
+@app.extensions["csrf"].exempt
+@login_or_token_required
+def tubefeed_regimens_api():
+    """Evaluate nutrition provided by many tube feed regimens at once
+
+    Takes a login session or an API token, without a CSRF token, as evaluating regimens
+    changes nothing.
+
+    Accepts either a list of regimens:
+        {"regimens": [{"formula_id": 1, "rate": 50, "hours": 24}, ...]}
+    or every formula (or a list of formula ids) across a range or list of rates:
+        {"formula_ids": [1, 2], "rates": {"start": 10, "stop": 100, "step": 5}, "hours": 24}
+    """
+
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify(error="Request body must be a JSON object"), 400
+
+    try:
+        results = evaluate_request(get_catalog(), payload)
+    except KeyError as e:
+        return jsonify(error=f"Missing field: {e.args[0]}"), 400
+    except (TypeError, ValueError) as e:
+        return jsonify(error=f"Invalid regimen request: {e}"), 400
+
+    return jsonify(columns=NUTRITION_COLUMNS, regimens=results)
+
+
+@app.route("/api/patients/<int:patient_id>/formula_recommendations")
+@login_required
+@cached("revalidate", patient_fingerprint, catalog_fingerprint)
+def formula_recommendations(patient_id):
+    """Rank every formula against a patient's estimated needs
+
+    Optional query parameters: hours (default 24), category_id, limit (default 25), any of
+    lactose_int, gluten_free, kosher set to "yes" to require that diet attribute, and the
+    needs equation, condition, sex, height_in, minute_ventilation, and max_temp.
+    """
+
+    # Only the user's own patients are served
+    patient = own_patient(patient_id)
+    if patient is None:
+        return jsonify(error="Patient not found"), 404
+
+    weight_query = weight_series.get(patient_id).latest()
+
+    if weight_query is None:
+        return jsonify(error="No current weight data available"), 404
+
+    hours = request.args.get("hours", 24, type=float)
+    if not hours or not math.isfinite(hours) or hours <= 0:
+        return jsonify(error="Hours must be a number greater than 0"), 400
+
+    limit = request.args.get("limit", 25, type=int)
+    if limit < 1:
+        return jsonify(error="Limit must be at least 1"), 400
+
+    try:
+        options = needs_options(request.args)
+        # Only predictive equations need the patient's age
+        if options["equation"] != "weight":
+            options["age"] = patient.age
+        needs = estimate_needs(weight_query.patient_weight, **options)
+    except ValueError as e:
+        return jsonify(error=f"Invalid needs request: {e}"), 400
+
+    diet = [
+        attribute for attribute in DIET_FILTERS if request.args.get(attribute) == "yes"
+    ]
+
+    recommendations = recommend_formulas(
+        get_catalog(),
+        needs,
+        hours=hours,
+        diet=diet,
+        category_id=request.args.get("category_id", type=int),
+        limit=limit,
+    )
+
+    return jsonify(
+        patient_id=patient_id,
+        current_weight=weight_query.patient_weight,
+        equation=options["equation"],
+        condition=options["condition"],
+        needs=needs,
+        recommendations=recommendations,
+    )
+
+
+@app.route("/api/patients/<int:patient_id>/weights")
+@login_required
+@cached("revalidate", patient_fingerprint)
+def patient_weights(patient_id):
+    """Return a patient's weights, or weekly or monthly aggregates of them, within a date range
+
+    Optional query parameters: start and end (YYYY-MM-DD, inclusive) and period (week or month).
+    """
+
+    # Only the user's own patients are served
+    if own_patient(patient_id) is None:
+        return jsonify(error="Patient not found"), 404
+
+    try:
+        start, end = (
+            datetime.strptime(request.args[name], "%Y-%m-%d").date()
+            if request.args.get(name)
+            else None
+            for name in ("start", "end")
+        )
+    except ValueError:
+        return jsonify(error="Dates must be formatted YYYY-MM-DD"), 400
+
+    series = weight_series.get(patient_id)
+    period = request.args.get("period")
+
+    if period is None:
+        weights = [
+            {
+                "id": row.id,
+                "weight_date": row.weight_date.isoformat(),
+                "patient_weight": row.patient_weight,
+            }
+            for row in series.rows(start, end)
+        ]
+        return jsonify(patient_id=patient_id, weights=weights)
+
+    try:
+        aggregates = series.downsample(period, start, end)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    return jsonify(
+        patient_id=patient_id,
+        period=period,
+        weights=[
+            {
+                "period_start": aggregate.period_start.isoformat(),
+                "count": aggregate.count,
+                "mean": aggregate.mean,
+                "min": aggregate.min,
+                "max": aggregate.max,
+            }
+            for aggregate in aggregates
+        ],
+    )
+
+
 if __name__ == "__main__":
     app.run()
@@ -0,0 +1,223 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+"""Password hashing and login checks
+
+bcrypt is slow on purpose, so when a whole unit logs in at shift change, hashing on the
+request threads would queue every login behind a few CPU-bound checks. Hashes are instead
+checked on a bounded pool of worker processes, started on the first login, so logins use
+every core while the request threads wait. Usernames are looked up through a short-lived
+cache, role rows through a per-process cache, and hashes made with a different work
+factor than the BCRYPT_ROUNDS setting are replaced at the next successful login.
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+
+from flask import current_app
+
+from extensions import db
+from models import Role, User
+
+# bcrypt work factor of new hashes, unless set with the BCRYPT_ROUNDS setting
+BCRYPT_ROUNDS = 12
+
+# Seconds a username lookup is reused, unless set with the AUTH_CACHE_SECONDS setting
+AUTH_CACHE_SECONDS = 60
+
+# Usernames kept in the lookup cache
+AUTH_CACHE_SIZE = 1024
+
+
+def check_password(password, password_hash):
+    """Return whether a password matches a bcrypt hash, run in a worker process"""
+    return bcrypt.checkpw(password.encode("utf-8"), password_hash)
+
+
+def make_hash(password, rounds):
+    """Return a bcrypt hash of a password with a work factor, run in a worker process"""
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds))
+
+
+def hash_rounds(password_hash):
+    """Return the work factor of a bcrypt hash, e.g. 12 for b"$2b$12$..." """
+    return int(password_hash.split(b"$")[2])
+
+
+class Authenticator:
+    """Checks and makes password hashes on a pool of worker processes
+
+    With no workers, hashing runs on the calling thread. Lookups of users by username are
+    cached for cache_seconds; a user whose hash changes is dropped from the cache.
+    """
+
+    def __init__(
+        self,
+        workers=None,
+        rounds=BCRYPT_ROUNDS,
+        cache_seconds=AUTH_CACHE_SECONDS,
+        cache_size=AUTH_CACHE_SIZE,
+    ):
+        self.workers = (os.cpu_count() or 1) if workers is None else workers
+        self.rounds = rounds
+        self.cache_seconds = cache_seconds
+        self.cache_size = cache_size
+        self._pool = None
+        self._users = OrderedDict()
+        self._roles = {}
+        self._dummy_hash = None
+        self._lock = threading.Lock()
+
+    def run(self, function, *args):
+        """Call function on the worker pool, starting it if needed, and wait for the result"""
+        if not self.workers:
+            return function(*args)
+
+        with self._lock:
+            if self._pool is None:
+                # Worker processes are spawned rather than forked from a threaded server
+                self._pool = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            pool = self._pool
+
+        try:
+            return pool.submit(function, *args).result()
+        except BrokenProcessPool:
+            # A worker died, so start a new pool for the next call
+            with self._lock:
+                if self._pool is pool:
+                    self._pool = None
+            raise
+
+    def shutdown(self):
+        """Stop the worker processes"""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown()
+
+    def hash_password(self, password):
+        """Return a bcrypt hash of a password at the current work factor"""
+        return self.run(make_hash, password, self.rounds)
+
+    def lookup(self, username):
+        """Return the (id, hash) of a username, or None, reusing recent lookups"""
+        now = time.monotonic()
+        with self._lock:
+            cached = self._users.get(username)
+            if cached is not None and cached[0] > now:
+                self._users.move_to_end(username)
+                return cached[1:]
+
+        row = db.session.execute(
+            db.select(User.id, User.hash).filter_by(username=username)
+        ).first()
+        if row is None:
+            # Unknown usernames aren't cached, so they can be registered in any process
+            return None
+
+        with self._lock:
+            self._users[username] = (now + self.cache_seconds, row.id, row.hash)
+            self._users.move_to_end(username)
+            while len(self._users) > self.cache_size:
+                self._users.popitem(last=False)
+        return row.id, row.hash
+
+    def forget(self, username):
+        """Drop a username from the lookup cache"""
+        with self._lock:
+            self._users.pop(username, None)
+
+    def authenticate(self, username, password):
+        """Return the id of the user with a username and password, or None
+
+        A matching hash made with another work factor is replaced with one made at the
+        current work factor.
+        """
+        # A missing username or password matches no one, so skip the lookup and the hash check
+        if not username or not password:
+            return None
+
+        user = self.lookup(username)
+        if user is None:
+            # Check unknown usernames against a throwaway hash, so they take as long as known ones
+            if self._dummy_hash is None:
+                self._dummy_hash = self.hash_password(os.urandom(16).hex())
+            self.run(check_password, password, self._dummy_hash)
+            return None
+
+        user_id, password_hash = user
+        if not self.run(check_password, password, password_hash):
+            return None
+
+        if hash_rounds(password_hash) != self.rounds:
+            db.session.execute(
+                db.update(User)
+                .filter_by(id=user_id)
+                .values(hash=self.hash_password(password))
+            )
+            db.session.commit()
+            self.forget(username)
+        return user_id
+
+    def role(self, name):
+        """Return the role with a name, created if missing, attached to the current database session
+
+        Roles never change once created, so each is only queried once per process.
+        """
+        with self._lock:
+            role = self._roles.get(name)
+
+        if role is None:
+            role = Role.query.filter_by(name=name).first()
+
+            # Create the role if it doesn't exist; it is cached once committed and queried again
+            if role is None:
+                role = Role(name=name)
+                db.session.add(role)
+                return role
+
+            db.session.expunge(role)
+            with self._lock:
+                self._roles[name] = role
+
+        # Attach a copy to this session without querying it again
+        return db.session.merge(role, load=False)
+
+
+def authenticate(username, password):
+    """Return the id of the user with a username and password in the current app, or None"""
+    return current_app.extensions["auth"].authenticate(username, password)
+
+
+def hash_password(password):
+    """Return a bcrypt hash of a password at the current app's work factor"""
+    return current_app.extensions["auth"].hash_password(password)
+
+
+def get_role(name):
+    """Return the role with a name from the current app's role cache"""
+    return current_app.extensions["auth"].role(name)
+
+
+def init_auth(app):
+    """Set up password hashing from the settings
+
+    BCRYPT_ROUNDS: work factor of new hashes; existing hashes are updated at login
+    AUTH_WORKERS: worker processes checking hashes (default one per core, 0 for none)
+    AUTH_CACHE_SECONDS: seconds a username lookup is reused
+    """
+    authenticator = app.extensions["auth"] = Authenticator(
+        workers=app.config.get("AUTH_WORKERS"),
+        rounds=app.config.get("BCRYPT_ROUNDS", BCRYPT_ROUNDS),
+        cache_seconds=app.config.get("AUTH_CACHE_SECONDS", AUTH_CACHE_SECONDS),
+    )
+    return authenticator
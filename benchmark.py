@@ -0,0 +1,1188 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+"""Benchmarks for Dietitian's Friend
+
+Run a benchmark with `python benchmark.py <name>`, e.g. `python benchmark.py tubefeed`.
+"""
+
+import argparse
+import bcrypt
+import csv
+import http.cookiejar
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from dateutil.relativedelta import relativedelta
+from itertools import cycle
+
+from flask import Flask
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session
+
+from catalog import build_catalog
+from csv_to_db import bulk_load_csv, seed_reference_data
+from extensions import db
+from helpers import batch_weight_check
+from models import Fluids, Formula, MonthlyWeights, Nutrients, Patient, User
+from sessions import SESSION_BACKENDS, init_session
+
+# Directory containing app.py, where startup benchmarks are run
+APP_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Measures importing the app and serving its first request in a fresh interpreter
+STARTUP_SCRIPT = """
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.app.test_client().get("/login")
+served = time.perf_counter()
+print(json.dumps({"import_ms": (imported - start) * 1000, "first_request_ms": (served - imported) * 1000}))
+"""
+
+
+def make_app(database_uri="sqlite://"):
+    """Create a bare Flask app bound to a scratch database"""
+    app = Flask(__name__)
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_uri
+    db.init_app(app)
+
+    with app.app_context():
+        db.create_all()
+
+    return app
+
+
+# Password of every provider account created by generate_hospital()
+PROVIDER_PASSWORD = "Provider-1"
+
+
+def generate_hospital(database_uri, providers, patients, months, seed=0, chunk_size=10_000):
+    """Fill a scratch database with provider accounts, their patients, and monthly weights
+
+    Creates providers named provider1, provider2, ... (password PROVIDER_PASSWORD), each with
+    patients of their own, and one weight per patient for each of the last months, entered by
+    the patient's provider. The formula reference data is loaded too. Returns the number of
+    weights created.
+    """
+    app = make_app(database_uri)
+    rng = random.Random(seed)
+    today = date.today()
+
+    with app.app_context():
+        seed_reference_data()
+
+        # Hash once, as every provider shares the password
+        password_hash = bcrypt.hashpw(PROVIDER_PASSWORD.encode("utf-8"), bcrypt.gensalt())
+        db.session.execute(
+            db.insert(User),
+            [
+                {"username": f"provider{provider}", "hash": password_hash}
+                for provider in range(1, providers + 1)
+            ],
+        )
+        provider_ids = db.session.execute(db.select(User.id)).scalars().all()
+
+        db.session.execute(
+            db.insert(Patient),
+            [
+                {
+                    "name_last": f"Patient{patient:06d}",
+                    "name_first": rng.choice(("Ann", "Bob", "Cy", "Di", "Ed", "Flo")),
+                    "age": rng.randint(40, 99),
+                    "bed": f"{patient}A",
+                    "provider_id": provider_id,
+                }
+                for index, provider_id in enumerate(provider_ids)
+                for patient in range(index * patients, (index + 1) * patients)
+            ],
+        )
+        patients_by_provider = db.session.execute(
+            db.select(Patient.id, Patient.provider_id)
+        ).all()
+
+        # Weights drift a little each month from a random starting weight
+        created = 0
+        rows = []
+        for patient_id, provider_id in patients_by_provider:
+            weight = rng.uniform(100, 250)
+            for month in range(months, 0, -1):
+                weight *= rng.uniform(0.97, 1.03)
+                rows.append(
+                    {
+                        "user_id": provider_id,
+                        "patient_id": patient_id,
+                        "weight_date": today - relativedelta(months=month - 1),
+                        "patient_weight": round(weight, 1),
+                        "timestamp": datetime.now(),
+                    }
+                )
+            if len(rows) >= chunk_size:
+                db.session.execute(db.insert(MonthlyWeights), rows)
+                created += len(rows)
+                rows = []
+        if rows:
+            db.session.execute(db.insert(MonthlyWeights), rows)
+            created += len(rows)
+
+        db.session.commit()
+        db.engine.dispose()
+
+    return created
+
+
+def time_calls(function, iterations):
+    """Call function repeatedly and return per-call latencies in microseconds"""
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        function()
+        latencies.append((time.perf_counter() - start) * 1_000_000)
+    return latencies
+
+
+def percentile(values, fraction):
+    """Return the value at a fraction (e.g. 0.99) of a sorted list"""
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(name, latencies):
+    """Print mean, p50, and p99 of a latency distribution in microseconds"""
+    latencies = sorted(latencies)
+    p99 = percentile(latencies, 0.99)
+    print(
+        f"{name:<32} mean {statistics.fmean(latencies):10.1f} us"
+        f"   p50 {statistics.median(latencies):10.1f} us   p99 {p99:10.1f} us"
+    )
+
+
+def benchmark_tubefeed(args):
+    """Compare tube feed lookups through the ORM against the preloaded formula catalog"""
+    app = make_app()
+
+    with app.app_context():
+        seed_reference_data()
+        formula_ids = [formula.id for formula in Formula.query.all()]
+
+        requests = cycle(formula_ids)
+
+        def orm_lookup():
+            # Queries the tube feed route issued per POST before the formula catalog
+            formula_id = next(requests)
+            form_choices = [(f.id, f.name) for f in Formula.query.all()]
+            formula = Formula.query.filter_by(id=formula_id).first()
+            selected_formula = db.session.get(Formula, formula_id)
+            Nutrients.query.filter_by(formula_id=formula_id).first().protein_g
+            Fluids.query.filter_by(formula_id=formula_id).first().free_water_percent
+
+            # Start each request with an empty identity map, as a new request would
+            db.session.expunge_all()
+
+        catalog = build_catalog()
+
+        def catalog_lookup():
+            formula_id = next(requests)
+            form_choices = list(catalog.choices)
+            formula = catalog.get(formula_id)
+            formula.protein_g, formula.free_water_percent
+
+        print(f"tube feed POST lookups over {len(formula_ids)} formulas")
+        report("orm queries", time_calls(orm_lookup, args.iterations))
+        report("formula catalog", time_calls(catalog_lookup, args.iterations))
+
+
+def write_synthetic_formulary(directory, rows):
+    """Write formulas and nutrients CSV files with the given number of synthetic products"""
+    rng = random.Random(0)
+
+    formulas_csv = os.path.join(directory, "formulas.csv")
+    with open(formulas_csv, "w", newline="") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(
+            ["id", "name", "category_id", "kcal_per_ml", "lactose_int", "gluten_free"]
+            + ["kosher", "features", "indications"]
+        )
+        for formula_id in range(1, rows + 1):
+            writer.writerow(
+                [formula_id, f"Formula {formula_id}", rng.randint(1, 9)]
+                + [rng.choice((1.0, 1.2, 1.5, 2.0)), "yes", "yes", "no"]
+                + ["high protein | halal", "can be sole source"]
+            )
+
+    nutrients_csv = os.path.join(directory, "nutrients.csv")
+    with open(nutrients_csv, "w", newline="") as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(
+            ["formula_id", "kcals", "protein_g", "fat_g", "carb_g", "fiber_g"]
+            + ["scfos_g"]
+        )
+        for formula_id in range(1, rows + 1):
+            writer.writerow(
+                [formula_id, rng.randint(1000, 2000)]
+                + [round(rng.uniform(40, 95), 1) for _ in range(4)]
+                + [rng.randint(0, 10)]
+            )
+
+    return ((formulas_csv, Formula, "id"), (nutrients_csv, Nutrients, "formula_id"))
+
+
+def orm_load(csv_file, model, engine):
+    """Load a CSV file one ORM instance per row, as load_data_from_csv did before the bulk loader"""
+    with Session(engine) as session:
+        with open(csv_file, "r") as csvfile:
+            for row in csv.DictReader(csvfile):
+                session.add(model(**row))
+        session.commit()
+
+
+def benchmark_csv_load(args):
+    """Compare per-row ORM inserts against the bulk CSV loader on a synthetic formulary"""
+    with tempfile.TemporaryDirectory() as directory:
+        files = write_synthetic_formulary(directory, args.rows)
+
+        for name in ("orm", "bulk"):
+            engine = create_engine(f"sqlite:///{os.path.join(directory, name)}.db")
+            db.metadata.create_all(engine)
+
+            for csv_file, model, id in files:
+                start = time.perf_counter()
+                if name == "orm":
+                    orm_load(csv_file, model, engine)
+                else:
+                    bulk_load_csv(csv_file, model, id, engine)
+                elapsed = time.perf_counter() - start
+
+                print(
+                    f"{name:<5} {model.__tablename__:<10} {args.rows} rows in {elapsed:6.2f}s"
+                    f"   {args.rows / elapsed:10.0f} rows/sec"
+                )
+
+            engine.dispose()
+
+
+def benchmark_startup(args):
+    """Measure importing the app and serving its first request in fresh interpreters"""
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.run(
+            [sys.executable, "-c", STARTUP_SCRIPT],
+            cwd=APP_DIRECTORY,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout
+        runs.append(json.loads(output.splitlines()[-1]))
+
+    results = {
+        "runs": args.runs,
+        "import_ms": statistics.median(run["import_ms"] for run in runs),
+        "first_request_ms": statistics.median(run["first_request_ms"] for run in runs),
+    }
+    results["startup_ms"] = results["import_ms"] + results["first_request_ms"]
+
+    print(
+        f"startup over {args.runs} runs (median): import {results['import_ms']:.1f} ms"
+        f"   first request {results['first_request_ms']:.1f} ms"
+        f"   total {results['startup_ms']:.1f} ms"
+    )
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+def benchmark_sessions(args):
+    """Compare requests/sec of a logged-in page through each session backend"""
+    with tempfile.TemporaryDirectory() as directory:
+        # Point the app at a scratch database before it is imported and configured
+        os.environ["FLASK_SQLALCHEMY_DATABASE_URI"] = (
+            f"sqlite:///{os.path.join(directory, 'sessions.db')}"
+        )
+        from app import app
+
+        with app.app_context():
+            db.create_all()
+
+        print(
+            f"GET {args.path}: {args.clients} clients x {args.requests} requests per backend"
+        )
+
+        for backend in SESSION_BACKENDS:
+            app.config["SESSION_BACKEND"] = backend
+            init_session(app)
+
+            # Each client logs in once and keeps its session cookie, as a browser would
+            clients = [app.test_client() for _ in range(args.clients)]
+            for client in clients:
+                with client.session_transaction() as session:
+                    session["user_id"] = 1
+
+            def run_client(client):
+                return time_calls(lambda: client.get(args.path), args.requests)
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.clients) as executor:
+                latencies = [
+                    latency
+                    for client_latencies in executor.map(run_client, clients)
+                    for latency in client_latencies
+                ]
+            elapsed = time.perf_counter() - start
+
+            report(f"{backend} ({len(latencies) / elapsed:.0f} req/s)", latencies)
+
+
+def benchmark_login_storm(args):
+    """Log many users in at once, as at shift change, with hashes checked on request threads vs the process pool"""
+    from auth import init_auth
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_uri = f"sqlite:///{os.path.join(directory, 'logins.db')}"
+        generate_hospital(database_uri, args.users, 0, 0)
+
+        # Point the app at the scratch database before it is imported and configured
+        os.environ["FLASK_SQLALCHEMY_DATABASE_URI"] = database_uri
+        from app import app
+
+        # Forms are posted directly, without first fetching a CSRF token
+        app.config["WTF_CSRF_ENABLED"] = False
+
+        print(
+            f"POST /login: {args.clients} clients x {args.logins} logins,"
+            f" {args.users} users, work factor {args.rounds}"
+        )
+
+        for name, workers in (("request threads", 0), ("process pool", args.workers)):
+            app.config["AUTH_WORKERS"] = workers
+            app.config["BCRYPT_ROUNDS"] = args.rounds
+            authenticator = init_auth(app)
+
+            # Hash at the benchmark's work factor, so no login is slowed by rehashing
+            with app.app_context():
+                db.session.execute(
+                    db.update(User).values(
+                        hash=bcrypt.hashpw(
+                            PROVIDER_PASSWORD.encode("utf-8"), bcrypt.gensalt(args.rounds)
+                        )
+                    )
+                )
+                db.session.commit()
+
+            # Start the worker processes before timing, as a running server would have
+            if workers:
+                authenticator.hash_password(PROVIDER_PASSWORD)
+
+            def run_client(client_number):
+                client = app.test_client()
+
+                def log_in():
+                    user = random.randint(1, args.users)
+                    response = client.post(
+                        "/login",
+                        data={"username": f"provider{user}", "password": PROVIDER_PASSWORD},
+                    )
+                    assert response.status_code == 302, response.status_code
+
+                # Latencies in ms
+                return [latency / 1000 for latency in time_calls(log_in, args.logins)]
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.clients) as executor:
+                latencies = sorted(
+                    latency
+                    for client_latencies in executor.map(run_client, range(args.clients))
+                    for latency in client_latencies
+                )
+            elapsed = time.perf_counter() - start
+            authenticator.shutdown()
+
+            print(
+                f"{name:<16} {len(latencies) / elapsed:8.1f} logins/sec"
+                f"   p50 {statistics.median(latencies):8.1f} ms"
+                f"   p99 {percentile(latencies, 0.99):8.1f} ms"
+            )
+
+
+def summarize_route(latencies, queries):
+    """Summarize per-request latencies (ms) and SQL statement counts of one route"""
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "mean_ms": statistics.fmean(latencies),
+        "p50_ms": statistics.median(latencies),
+        "p90_ms": percentile(latencies, 0.90),
+        "p99_ms": percentile(latencies, 0.99),
+        "max_ms": latencies[-1],
+        "queries_mean": statistics.fmean(queries),
+        "queries_max": max(queries),
+    }
+
+
+def compare_routes(baseline, results, threshold, min_delta_ms):
+    """Print each route's change from a baseline run, returning the routes that regressed
+
+    A route regresses if its median latency grew by more than threshold (a fraction) and by
+    more than min_delta_ms, so noise on sub-millisecond routes isn't flagged, or if it runs
+    more SQL statements per request.
+    """
+    if baseline["config"] != results["config"]:
+        print("warning: baseline was run with different settings", baseline["config"])
+
+    regressions = []
+    for name, current in results["routes"].items():
+        previous = baseline["routes"].get(name)
+        if previous is None:
+            continue
+
+        change = current["p50_ms"] / previous["p50_ms"] - 1
+        slower = (
+            change > threshold
+            and current["p50_ms"] - previous["p50_ms"] > min_delta_ms
+        )
+        more_queries = current["queries_mean"] > previous["queries_mean"] + 0.01
+        if slower or more_queries:
+            regressions.append(name)
+
+        print(
+            f"{name:<32} p50 {previous['p50_ms']:8.2f} -> {current['p50_ms']:8.2f} ms ({change:+7.1%})"
+            f"   queries {previous['queries_mean']:6.1f} -> {current['queries_mean']:6.1f}"
+            f"{'   REGRESSION' if slower or more_queries else ''}"
+        )
+
+    return regressions
+
+
+def benchmark_routes(args):
+    """Drive every page through the test client on a synthetic hospital, reporting latency and queries per request"""
+    with tempfile.TemporaryDirectory() as directory:
+        database_uri = f"sqlite:///{os.path.join(directory, 'routes.db')}"
+
+        start = time.perf_counter()
+        weights = generate_hospital(
+            database_uri, args.providers, args.patients, args.years * 12, seed=args.seed
+        )
+        print(
+            f"generated {args.providers} providers, {args.providers * args.patients} patients,"
+            f" and {weights} weights in {time.perf_counter() - start:.1f}s"
+        )
+
+        # Point the app at the scratch database before it is imported and configured
+        os.environ["FLASK_SQLALCHEMY_DATABASE_URI"] = database_uri
+        from app import app
+
+        # Forms are posted directly, without first fetching a CSRF token
+        app.config["WTF_CSRF_ENABLED"] = False
+
+        with app.app_context():
+            engine = db.engine
+
+            # Weight checks and dashboard summaries, as `flask weight-check-all` leaves them
+            batch_weight_check(provider_id=1)
+
+            patient_ids = (
+                db.session.execute(db.select(Patient.id).filter_by(provider_id=1))
+                .scalars()
+                .all()
+            )
+            formula_ids = db.session.execute(db.select(Formula.id)).scalars().all()
+
+            # API requests authenticate with a token instead of the session
+            from api import create_token
+
+            api_headers = {"Authorization": f"Bearer {create_token(1, 'benchmark')}"}
+
+        # Count SQL statements sent by each request
+        statements = 0
+
+        def count_statement(*_):
+            nonlocal statements
+            statements += 1
+
+        event.listen(engine, "before_cursor_execute", count_statement)
+
+        client = app.test_client()
+        with client.session_transaction() as session:
+            session["user_id"] = 1
+
+        rng = random.Random(args.seed)
+
+        # ETag of each patient page already fetched, as a browser revisiting the page would send
+        etags = {}
+
+        def revalidate_patient_info():
+            patient_id = rng.choice(patient_ids)
+            if patient_id not in etags:
+                etags[patient_id] = client.get(f"/patient_info/{patient_id}").headers["ETag"]
+            return client.get(
+                f"/patient_info/{patient_id}",
+                headers={"If-None-Match": etags[patient_id]},
+            )
+
+        routes = {
+            "GET /": lambda: client.get("/"),
+            "GET /patient_info/<id>": lambda: client.get(
+                f"/patient_info/{rng.choice(patient_ids)}"
+            ),
+            "GET /patient_info/<id> (304)": revalidate_patient_info,
+            "GET /weight_check/<id>": lambda: client.get(
+                f"/weight_check/{rng.choice(patient_ids)}"
+            ),
+            "GET /dashboard": lambda: client.get("/dashboard"),
+            "GET /rounds (30)": lambda: client.get(
+                "/rounds?ids="
+                + ",".join(map(str, rng.sample(patient_ids, min(30, len(patient_ids)))))
+            ),
+            "GET /history": lambda: client.get("/history"),
+            "GET /weight_entry": lambda: client.get("/weight_entry"),
+            "POST /weight_entry": lambda: client.post(
+                "/weight_entry",
+                data={
+                    "patient": rng.choice(patient_ids),
+                    "weight": round(rng.uniform(100, 250), 1),
+                    "weight_date": date.today().isoformat(),
+                },
+            ),
+            "GET /tubefeed": lambda: client.get("/tubefeed"),
+            "POST /tubefeed": lambda: client.post(
+                "/tubefeed",
+                data={
+                    "formulas": rng.choice(formula_ids),
+                    "tube_feed_rate": rng.choice((40, 55, 60, 75)),
+                    "time": 24,
+                },
+            ),
+            "GET /api/v1/patients": lambda: client.get(
+                "/api/v1/patients", headers=api_headers
+            ),
+            "GET /api/v1/patients?ids= (50)": lambda: client.get(
+                "/api/v1/patients?ids="
+                + ",".join(map(str, rng.sample(patient_ids, min(50, len(patient_ids))))),
+                headers=api_headers,
+            ),
+            "GET /api/v1/weights (10)": lambda: client.get(
+                "/api/v1/weights?patient_ids="
+                + ",".join(map(str, rng.sample(patient_ids, min(10, len(patient_ids))))),
+                headers=api_headers,
+            ),
+            "POST /api/v1/weights": lambda: client.post(
+                "/api/v1/weights",
+                json={
+                    "weights": [
+                        {
+                            "patient_id": rng.choice(patient_ids),
+                            "weight": round(rng.uniform(100, 250), 1),
+                            "weight_date": date.today().isoformat(),
+                        }
+                    ]
+                },
+                headers=api_headers,
+            ),
+        }
+
+        results = {
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": sys.version.split()[0],
+            "config": {
+                "providers": args.providers,
+                "patients": args.patients,
+                "years": args.years,
+                "requests": args.requests,
+                "warmup": args.warmup,
+                "seed": args.seed,
+            },
+            "routes": {},
+        }
+
+        print(f"{'route':<32} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'queries':>8}")
+        for name, send in routes.items():
+            latencies = []
+            queries = []
+            for iteration in range(args.warmup + args.requests):
+                before = statements
+                start = time.perf_counter()
+                response = send()
+                elapsed = (time.perf_counter() - start) * 1000
+
+                if response.status_code >= 400:
+                    raise RuntimeError(f"{name} returned {response.status_code}")
+                if iteration >= args.warmup:
+                    latencies.append(elapsed)
+                    queries.append(statements - before)
+
+                # Redirects aren't followed, so drop flashed messages before they pile up in the session
+                with client.session_transaction() as session:
+                    session.pop("_flashes", None)
+
+            summary = results["routes"][name] = summarize_route(latencies, queries)
+            print(
+                f"{name:<32} {summary['p50_ms']:8.2f} {summary['p90_ms']:8.2f}"
+                f" {summary['p99_ms']:8.2f} {summary['queries_mean']:8.1f}"
+            )
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            regressions = compare_routes(
+                json.load(baseline_file), results, args.threshold, args.min_delta_ms
+            )
+        if regressions:
+            raise SystemExit(f"Regressions in: {', '.join(regressions)}")
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Leave redirects unfollowed, so each request is timed on its own"""
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class LoadClient:
+    """HTTP client with its own cookie jar, logged in as one user of a running server"""
+
+    def __init__(self, url, username, password):
+        self.url = url.rstrip("/")
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirect()
+        )
+
+        csrf_token = self.csrf_token("/login")
+        status, _ = self.request(
+            "/login",
+            {"username": username, "password": password, "csrf_token": csrf_token},
+        )
+        if status != 302:
+            raise RuntimeError(f"Login as {username} failed with status {status}")
+
+        # Patients on the first page of the roster, and a token for weight entry forms
+        _, roster = self.request("/")
+        self.patient_ids = [int(id) for id in re.findall(r"/patient_info/(\d+)", roster)]
+        if not self.patient_ids:
+            raise RuntimeError(f"{username} has no patients to load test with")
+        self.weight_csrf_token = self.csrf_token("/weight_entry")
+
+    def request(self, path, data=None):
+        """Send a GET (or a form POST if data is given) and return the status and body"""
+        body = None if data is None else urllib.parse.urlencode(data).encode()
+        try:
+            with self.opener.open(self.url + path, body) as response:
+                return response.status, response.read().decode()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read().decode()
+
+    def csrf_token(self, path):
+        _, page = self.request(path)
+        return re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', page).group(1)
+
+
+def start_local_server(directory, patients, months):
+    """Start the app on a scratch database in a background process, returning it and its URL"""
+    database_uri = f"sqlite:///{os.path.join(directory, 'load.db')}"
+    generate_hospital(database_uri, 1, patients, months)
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+
+    env = dict(
+        os.environ,
+        FLASK_SQLALCHEMY_DATABASE_URI=database_uri,
+        FLASK_SECRET_KEY="load-test",
+    )
+    server = subprocess.Popen(
+        [sys.executable, "-m", "flask", "--app", "wsgi", "run", "--port", str(port)]
+        + ["--with-threads"],
+        cwd=APP_DIRECTORY,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            urllib.request.urlopen(url + "/login").close()
+            return server, url
+        except OSError:
+            if server.poll() is not None or time.monotonic() > deadline:
+                server.kill()
+                raise RuntimeError("Local server failed to start")
+            time.sleep(0.1)
+
+
+def run_load(url, args):
+    """Drive mixed read and write traffic from concurrent clients and report latency per request type"""
+    clients = [LoadClient(url, args.username, args.password) for _ in range(args.clients)]
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+
+    def run_client(seed, client):
+        rng = random.Random(seed)
+        while time.monotonic() < deadline:
+            patient_id = rng.choice(client.patient_ids)
+
+            if rng.random() < args.write_ratio:
+                name, path, data = rng.choice(
+                    (
+                        (
+                            "POST /weight_entry",
+                            "/weight_entry",
+                            {
+                                "patient": patient_id,
+                                "weight": round(rng.uniform(100, 250), 1),
+                                "weight_date": date.today().isoformat(),
+                                "csrf_token": client.weight_csrf_token,
+                            },
+                        ),
+                        ("GET /weight_check", f"/weight_check/{patient_id}", None),
+                    )
+                )
+            else:
+                name, path, data = rng.choice(
+                    (
+                        ("GET /", "/", None),
+                        ("GET /patient_info", f"/patient_info/{patient_id}", None),
+                        ("GET /history", "/history", None),
+                        ("GET /api/weights", f"/api/patients/{patient_id}/weights", None),
+                    )
+                )
+
+            start = time.perf_counter()
+            status, _ = client.request(path, data)
+            elapsed = (time.perf_counter() - start) * 1_000_000
+
+            with lock:
+                latencies[name].append(elapsed)
+                if status >= 400:
+                    errors[name] += 1
+
+    with ThreadPoolExecutor(max_workers=args.clients) as executor:
+        list(executor.map(run_client, range(args.clients), clients))
+
+    total = sum(len(values) for values in latencies.values())
+    print(
+        f"{url}: {args.clients} clients for {args.duration}s, {args.write_ratio:.0%} writes:"
+        f" {total} requests ({total / args.duration:.0f} req/s), {sum(errors.values())} errors"
+    )
+    for name in sorted(latencies):
+        report(f"{name} ({errors[name]} err)", latencies[name])
+    report("all requests", [value for values in latencies.values() for value in values])
+
+
+def benchmark_load(args):
+    """Load test a running server, or a local one on a scratch database, with mixed reads and writes"""
+    if args.url:
+        run_load(args.url, args)
+        return
+
+    with tempfile.TemporaryDirectory() as directory:
+        server, url = start_local_server(directory, args.patients, args.months)
+        try:
+            run_load(url, args)
+        finally:
+            server.terminate()
+            server.wait()
+
+
+def write_weight_file(path, file_format, rows, patients, invalid, seed=0):
+    """Write a synthetic scale export of weights for patients generate_hospital() created
+
+    Rows refer to patients by id, by name and bed, or by bed, and a fraction of them are
+    invalid, so every validation path is exercised.
+    """
+    rng = random.Random(seed)
+    today = date.today()
+    columns = ["patient_id", "name_last", "name_first", "bed", "weight", "weight_date"]
+
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file)
+        if file_format == "csv":
+            writer.writerow(columns)
+
+        for row in range(rows):
+            patient_id, name_last, name_first, bed = rng.choice(patients)
+            weight_date = (today - relativedelta(days=row % 365)).isoformat()
+            record = {"weight": round(rng.uniform(100, 250), 1), "weight_date": weight_date}
+
+            # Refer to the patient by id, by name and bed, or by bed
+            way = row % 3
+            if way == 0:
+                record["patient_id"] = patient_id
+            elif way == 1:
+                record.update(name_last=name_last, name_first=name_first, bed=bed)
+            else:
+                record["bed"] = bed
+
+            if rng.random() < invalid:
+                record[rng.choice(("weight", "weight_date", "bed"))] = "not valid"
+                record.pop("patient_id", None)
+
+            if file_format == "csv":
+                writer.writerow([record.get(column, "") for column in columns])
+            else:
+                file.write(json.dumps(record) + "\n")
+
+
+def benchmark_weight_import(args):
+    """Import a synthetic scale export of weights, reporting rows/sec and peak memory"""
+    from weight_import import PatientIndex, import_weights
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_uri = f"sqlite:///{os.path.join(directory, 'import.db')}"
+        generate_hospital(database_uri, args.providers, args.patients, 0)
+
+        app = make_app(database_uri)
+        with app.app_context():
+            patients = db.session.execute(
+                db.select(Patient.id, Patient.name_last, Patient.name_first, Patient.bed)
+            ).all()
+
+        path = os.path.join(directory, f"weights.{args.format}")
+        start = time.perf_counter()
+        write_weight_file(path, args.format, args.rows, patients, args.invalid)
+        print(
+            f"wrote {args.rows} rows ({os.path.getsize(path) / 2**20:.0f} MB) in"
+            f" {time.perf_counter() - start:.1f}s"
+        )
+
+        # Peak memory of this process so far, in MB (ru_maxrss is in KB on Linux)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+        with app.app_context():
+            start = time.perf_counter()
+            report = import_weights(
+                path, 1, patients=PatientIndex.load(), batch_size=args.batch_size
+            )
+            elapsed = time.perf_counter() - start
+
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    print(
+        f"imported {report['imported']} of {report['rows']} rows for {report['patients']} patients,"
+        f" {report['rejected']} rejected, in {elapsed:.1f}s ({report['rows'] / elapsed:,.0f} rows/sec)"
+    )
+    print(f"peak memory {before:.0f} MB before import, {after:.0f} MB after")
+
+
+def write_census_file(path, patients, rows, existing, transfers, seed=0):
+    """Write a synthetic census CSV of one provider's patients that generate_hospital() created
+
+    A fraction of rows list patients already admitted, some of them in a new bed, and the
+    rest are new admissions.
+    """
+    rng = random.Random(seed)
+
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["name_last", "name_first", "age", "bed"])
+
+        for row in range(rows):
+            draw = rng.random()
+            if draw < existing + transfers:
+                name_last, name_first, age, bed = rng.choice(patients)
+                if draw >= existing:
+                    bed = f"T{row}"
+            else:
+                name_last, name_first, age, bed = f"Census{row}", "New", rng.randint(18, 99), f"N{row}"
+            writer.writerow([name_last, name_first, age, bed])
+
+
+def benchmark_admission(args):
+    """Compare per-patient duplicate checks and commits against batch admission of a census file"""
+    from admission import admit_patients
+
+    with tempfile.TemporaryDirectory() as directory:
+        hospital = os.path.join(directory, "hospital.db")
+        generate_hospital(f"sqlite:///{hospital}", args.providers, args.patients, 0)
+
+        app = make_app(f"sqlite:///{hospital}")
+        with app.app_context():
+            patients = db.session.execute(
+                db.select(Patient.name_last, Patient.name_first, Patient.age, Patient.bed)
+                .filter_by(provider_id=1)
+            ).all()
+
+        path = os.path.join(directory, "census.csv")
+        write_census_file(path, patients, args.rows, args.existing, args.transfers)
+
+        for name in ("per-row", "batch"):
+            database = os.path.join(directory, f"{name}.db")
+            shutil.copy(hospital, database)
+
+            app = make_app(f"sqlite:///{database}")
+            with app.app_context():
+                start = time.perf_counter()
+                if name == "per-row":
+                    # The duplicate check, insert, and commit of patient_entry() for each row
+                    with open(path, newline="") as file:
+                        for row in csv.DictReader(file):
+                            values = dict(row, age=int(row["age"]), provider_id=1)
+                            if Patient.query.filter_by(**values).first() is None:
+                                db.session.add(Patient(**values))
+                                db.session.commit()
+                else:
+                    admit_patients(path, provider_id=1)
+                elapsed = time.perf_counter() - start
+
+                count = db.session.scalar(db.select(db.func.count(Patient.id)))
+
+            print(
+                f"{name:<8} {args.rows} rows in {elapsed:6.2f}s   {args.rows / elapsed:10,.0f} rows/sec"
+                f"   {count} patients after"
+            )
+
+
+def benchmark_export(args):
+    """Export every weight of a synthetic hospital in each format, reporting rows/sec, first byte, and peak memory"""
+    from exports import EXPORT_FORMATS, export
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_uri = f"sqlite:///{os.path.join(directory, 'export.db')}"
+        weights = generate_hospital(
+            database_uri, args.providers, args.patients, args.years * 12
+        )
+        print(f"generated {weights} weights")
+
+        app = make_app(database_uri)
+        with app.app_context():
+            for file_format in EXPORT_FORMATS:
+                start = time.perf_counter()
+                first_chunk = None
+                size = 0
+
+                for chunk in export("weights", file_format):
+                    if first_chunk is None:
+                        first_chunk = time.perf_counter() - start
+                    size += len(chunk)
+                elapsed = time.perf_counter() - start
+
+                # Peak memory of this process so far, in MB (ru_maxrss is in KB on Linux)
+                peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+                print(
+                    f"{file_format:<10} {weights / elapsed:>10,.0f} rows/sec"
+                    f"   first chunk {first_chunk * 1000:6.1f} ms"
+                    f"   {size / 2**20:6.1f} MB   peak memory {peak:.0f} MB"
+                )
+
+
+def benchmark_needs(args):
+    """Estimate needs of many patients by each equation, one call per patient vs one batch"""
+    from needs import EQUATIONS, SEXES, estimate_needs, evaluate_needs
+
+    rng = random.Random(args.seed)
+    columns = {
+        "weights_lb": [rng.uniform(90, 350) for _ in range(args.patients)],
+        "ages": [rng.randint(18, 99) for _ in range(args.patients)],
+        "heights_in": [rng.uniform(58, 76) for _ in range(args.patients)],
+        "sexes": [rng.choice(SEXES) for _ in range(args.patients)],
+        "minute_ventilation": [rng.uniform(5, 15) for _ in range(args.patients)],
+        "max_temps": [rng.uniform(36, 40) for _ in range(args.patients)],
+    }
+    # Every patient value, one patient at a time, with the names estimate_needs() takes
+    patients = list(
+        zip(
+            columns["weights_lb"],
+            columns["ages"],
+            columns["heights_in"],
+            columns["sexes"],
+            columns["minute_ventilation"],
+            columns["max_temps"],
+        )
+    )
+
+    print(f"needs of {args.patients} patients, best of {args.repeat} runs")
+    for equation in EQUATIONS:
+        timings = {"per patient": [], "batch": []}
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            for weight, age, height, sex, ventilation, temp in patients:
+                estimate_needs(
+                    weight,
+                    equation,
+                    age=age,
+                    height_in=height,
+                    sex=sex,
+                    minute_ventilation=ventilation,
+                    max_temp=temp,
+                )
+            timings["per patient"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            evaluate_needs(
+                columns["weights_lb"],
+                equation,
+                **{name: columns[name] for name in EQUATIONS[equation].inputs},
+            )
+            timings["batch"].append(time.perf_counter() - start)
+
+        for mode, seconds in timings.items():
+            best = min(seconds)
+            print(
+                f"{equation:<16} {mode:<12} {best * 1000:8.1f} ms"
+                f"   {args.patients / (best * 1000):8.1f} patients/ms"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    tubefeed = subparsers.add_parser(
+        "tubefeed", help="formula lookups: ORM queries vs formula catalog"
+    )
+    tubefeed.add_argument("--iterations", type=int, default=200)
+    tubefeed.set_defaults(run=benchmark_tubefeed)
+
+    csv_load = subparsers.add_parser(
+        "csv-load", help="CSV loading: per-row ORM inserts vs bulk loader"
+    )
+    csv_load.add_argument("--rows", type=int, default=100_000)
+    csv_load.set_defaults(run=benchmark_csv_load)
+
+    startup = subparsers.add_parser(
+        "startup", help="app import plus first request, in fresh interpreters"
+    )
+    startup.add_argument("--runs", type=int, default=10)
+    startup.add_argument("--output", help="write results as JSON to this file")
+    startup.set_defaults(run=benchmark_startup)
+
+    sessions = subparsers.add_parser(
+        "sessions", help="requests/sec of a logged-in page through each session backend"
+    )
+    sessions.add_argument("--clients", type=int, default=4)
+    sessions.add_argument("--requests", type=int, default=500)
+    sessions.add_argument("--path", default="/tubefeed")
+    sessions.set_defaults(run=benchmark_sessions)
+
+    login_storm = subparsers.add_parser(
+        "login-storm",
+        help="logins/sec and p99 latency of concurrent logins, hashing on request threads vs a process pool",
+    )
+    login_storm.add_argument("--clients", type=int, default=16, help="concurrent clients")
+    login_storm.add_argument("--logins", type=int, default=4, help="logins per client")
+    login_storm.add_argument("--users", type=int, default=50)
+    login_storm.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1, help="hashing processes"
+    )
+    login_storm.add_argument("--rounds", type=int, default=12, help="bcrypt work factor")
+    login_storm.set_defaults(run=benchmark_login_storm)
+
+    load = subparsers.add_parser(
+        "load",
+        help="p50/p99 latency of mixed read/write traffic from concurrent clients",
+    )
+    load.add_argument(
+        "--url", help="server to test (default: start one on a scratch database)"
+    )
+    load.add_argument("--username", default="provider1")
+    load.add_argument("--password", default=PROVIDER_PASSWORD)
+    load.add_argument("--clients", type=int, default=8)
+    load.add_argument("--duration", type=float, default=10)
+    load.add_argument("--write-ratio", type=float, default=0.2)
+    load.add_argument("--patients", type=int, default=200)
+    load.add_argument("--months", type=int, default=24, help="monthly weights per patient")
+    load.set_defaults(run=benchmark_load)
+
+    routes = subparsers.add_parser(
+        "routes",
+        help="latency and queries per request of every page on a synthetic hospital",
+    )
+    routes.add_argument("--providers", type=int, default=10)
+    routes.add_argument("--patients", type=int, default=200, help="patients per provider")
+    routes.add_argument("--years", type=int, default=3, help="years of monthly weights")
+    routes.add_argument("--requests", type=int, default=200, help="timed requests per route")
+    routes.add_argument("--warmup", type=int, default=20, help="untimed requests per route")
+    routes.add_argument("--seed", type=int, default=0)
+    routes.add_argument("--output", help="write results as JSON to this file")
+    routes.add_argument(
+        "--compare", help="compare against results saved with --output, failing on regressions"
+    )
+    routes.add_argument(
+        "--threshold",
+        type=float,
+        default=0.2,
+        help="median latency increase that counts as a regression (default 0.2, i.e. 20%%)",
+    )
+    routes.add_argument(
+        "--min-delta-ms",
+        type=float,
+        default=0.5,
+        help="smallest median latency increase in ms that counts as a regression",
+    )
+    routes.set_defaults(run=benchmark_routes)
+
+    weight_import = subparsers.add_parser(
+        "weight-import",
+        help="rows/sec and peak memory of a bulk weight import",
+    )
+    weight_import.add_argument("--rows", type=int, default=1_000_000)
+    weight_import.add_argument("--format", choices=("csv", "jsonl"), default="csv")
+    weight_import.add_argument("--providers", type=int, default=10)
+    weight_import.add_argument("--patients", type=int, default=200, help="patients per provider")
+    weight_import.add_argument(
+        "--invalid", type=float, default=0.01, help="fraction of rows that are invalid"
+    )
+    weight_import.add_argument("--batch-size", type=int, default=5000)
+    weight_import.set_defaults(run=benchmark_weight_import)
+
+    admission = subparsers.add_parser(
+        "admission",
+        help="per-patient duplicate checks and commits vs batch admission of a census file",
+    )
+    admission.add_argument("--rows", type=int, default=10_000, help="census rows")
+    admission.add_argument("--providers", type=int, default=10)
+    admission.add_argument("--patients", type=int, default=200, help="patients per provider")
+    admission.add_argument(
+        "--existing", type=float, default=0.1, help="fraction of rows already admitted"
+    )
+    admission.add_argument(
+        "--transfers", type=float, default=0.05, help="fraction of rows moving to a new bed"
+    )
+    admission.set_defaults(run=benchmark_admission)
+
+    export = subparsers.add_parser(
+        "export",
+        help="rows/sec, first byte, and peak memory of exporting every weight",
+    )
+    export.add_argument("--providers", type=int, default=10)
+    export.add_argument("--patients", type=int, default=200, help="patients per provider")
+    export.add_argument("--years", type=int, default=10, help="years of monthly weights")
+    export.set_defaults(run=benchmark_export)
+
+    needs = subparsers.add_parser(
+        "needs",
+        help="patients/ms of needs estimates by each equation, per patient vs in batch",
+    )
+    needs.add_argument("--patients", type=int, default=100_000)
+    needs.add_argument("--repeat", type=int, default=5)
+    needs.add_argument("--seed", type=int, default=0)
+    needs.set_defaults(run=benchmark_needs)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == "__main__":
+    main()
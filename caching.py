@@ -0,0 +1,220 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+"""Per-route HTTP caching policies
+
+Responses are not cached unless their route opts in. Static files get long-lived public
+caching when requested through a versioned URL, formula reference pages are cached
+privately for a while, and patient pages carry strong ETags so an unchanged page is
+answered with 304 Not Modified before any patient query or template runs. Pages with
+patient information are only ever marked private, so shared caches never store them.
+"""
+
+import hashlib
+import os
+
+from functools import lru_cache, wraps
+
+from flask import current_app, g, make_response, message_flashed, request, session
+from werkzeug.security import safe_join
+
+from catalog import get_catalog
+from extensions import db
+from models import MonthlyWeights, Patient, WeightCheck
+
+# Cache-Control header of each caching policy
+CACHE_POLICIES = {
+    # Static files requested with their content version, which never change at that URL
+    "static": "public, max-age=31536000, immutable",
+    # Formula reference data, which only changes when reference data is reloaded
+    "reference": "private, max-age=3600",
+    # Pages that browsers may keep, but must check with the server (by ETag) before showing
+    "revalidate": "private, no-cache",
+}
+
+# Headers of every response whose route doesn't opt in to caching
+NO_STORE_HEADERS = {
+    "Cache-Control": "no-cache, no-store, must-revalidate",
+    "Expires": "0",
+    "Pragma": "no-cache",
+}
+
+# Files whose contents decide how pages render, so a deploy changing any of them changes every ETag
+VERSIONED_EXTENSIONS = (".py", ".html", ".css", ".js")
+
+
+def cached(policy, *fingerprints):
+    """Decorate routes to apply a caching policy to their successful GET responses
+
+    Each fingerprint is called with the view's arguments and returns values that change
+    whenever the page would. With fingerprints, the response gets a strong ETag, and a
+    request whose If-None-Match matches it is answered with 304 without calling the view.
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if request.method not in ("GET", "HEAD"):
+                return f(*args, **kwargs)
+
+            g.cache_policy = policy
+
+            # Pending flash messages must be rendered, so the page can't be answered from cache
+            if not fingerprints or session.get("_flashes"):
+                return f(*args, **kwargs)
+
+            etag = make_etag(
+                [fingerprint(*args, **kwargs) for fingerprint in fingerprints]
+            )
+
+            if request.if_none_match.contains(etag):
+                response = current_app.response_class(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+
+            if response.status_code in (200, 304):
+                response.set_etag(etag)
+            return response
+
+        return decorated_function
+
+    return decorator
+
+
+def make_etag(values):
+    """Return a strong ETag for a page of the current deploy, user, and URL built from values"""
+    digest = hashlib.sha256()
+    for value in (
+        current_app.extensions["caching"],
+        session.get("user_id"),
+        request.full_path,
+        values,
+    ):
+        digest.update(repr(value).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()[:32]
+
+
+def patient_fingerprint(patient_id, **kwargs):
+    """Return the patient's details and the latest changes to their weights and weight checks
+
+    Taken in one query, so checking whether a patient page changed costs far less than
+    building it.
+    """
+    return tuple(db.session.execute(patient_fingerprint_query(patient_id)).one())
+
+
+def patient_fingerprint_query(patient_id):
+    """Select a patient's details and their weight and weight check counts, latest ids, and timestamps"""
+
+    def subqueries(query, *columns):
+        return [
+            query.with_only_columns(column).scalar_subquery() for column in columns
+        ]
+
+    return db.select(
+        *subqueries(
+            db.select(Patient.id).filter(Patient.id == patient_id),
+            Patient.name_last,
+            Patient.name_first,
+            Patient.age,
+            Patient.bed,
+            Patient.provider_id,
+        ),
+        *subqueries(
+            db.select(MonthlyWeights.id).filter(MonthlyWeights.patient_id == patient_id),
+            db.func.count(MonthlyWeights.id),
+            db.func.max(MonthlyWeights.id),
+            db.func.max(MonthlyWeights.timestamp),
+        ),
+        *subqueries(
+            db.select(WeightCheck.id).filter(WeightCheck.patient_id == patient_id),
+            db.func.count(WeightCheck.id),
+            db.func.max(WeightCheck.id),
+            db.func.max(WeightCheck.timestamp),
+        ),
+    )
+
+
+def catalog_fingerprint(*args, **kwargs):
+    """Return the version of the formula catalog"""
+    return get_catalog().version
+
+
+@lru_cache(maxsize=None)
+def static_version(path):
+    """Return a short digest of a static file's contents, or None if it doesn't exist"""
+    try:
+        with open(path, "rb") as file:
+            return hashlib.sha256(file.read()).hexdigest()[:12]
+    except OSError:
+        return None
+
+
+def deploy_version(app):
+    """Return a digest of the app's code, templates, and static files"""
+    if app.config.get("CACHE_VERSION"):
+        return str(app.config["CACHE_VERSION"])
+
+    digest = hashlib.sha256()
+    for directory in (app.root_path, app.template_folder, app.static_folder):
+        directory = os.path.join(app.root_path, directory)
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if name.endswith(VERSIONED_EXTENSIONS) and os.path.isfile(path):
+                digest.update(name.encode())
+                digest.update(static_version(path).encode())
+    return digest.hexdigest()[:16]
+
+
+def set_cache_headers(response):
+    """Set the caching headers of a response from its route's caching policy"""
+    policy = None
+
+    if request.endpoint == "static":
+        # Versioned URLs never change, anything else is checked by the file's ETag
+        path = safe_join(current_app.static_folder, request.view_args["filename"])
+        if path and request.args.get("v") and request.args["v"] == static_version(path):
+            policy = "static"
+        else:
+            policy = "revalidate"
+    elif response.status_code in (200, 304) and not g.get("flashed"):
+        policy = g.get("cache_policy")
+
+    if policy is None:
+        # A page that flashed a message must not be reused, or it would show the message again
+        response.headers.pop("ETag", None)
+        response.headers.update(NO_STORE_HEADERS)
+        return response
+
+    response.headers["Cache-Control"] = CACHE_POLICIES[policy]
+    response.headers.pop("Expires", None)
+    response.headers.pop("Pragma", None)
+
+    # Private pages depend on who is logged in
+    if policy != "static":
+        response.vary.add("Cookie")
+    return response
+
+
+def init_caching(app):
+    """Version static file URLs and record flashes, so responses get their caching headers"""
+    app.extensions["caching"] = deploy_version(app)
+
+    def add_static_version(endpoint, values):
+        if endpoint == "static" and "v" not in values and "filename" in values:
+            version = static_version(
+                os.path.join(app.static_folder, values["filename"])
+            )
+            if version is not None:
+                values["v"] = version
+
+    def message_flashed_handler(sender, message, category, **extra):
+        g.flashed = True
+
+    app.url_defaults(add_static_version)
+
+    # Signal receivers are only weakly referenced, so the app keeps this one alive
+    app.extensions["caching_flash_handler"] = message_flashed_handler
+    message_flashed.connect(message_flashed_handler, app)
+
+    return app.extensions["caching"]
@@ -0,0 +1,180 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+import hashlib
+import threading
+
+from types import MappingProxyType
+
+from extensions import db
+from models import Category, Fluids, Formula, Minerals, Nutrients
+
+# Columns joined from the formula reference tables into each catalog record
+FORMULA_COLUMNS = (
+    Formula.id,
+    Formula.name,
+    Formula.category_id,
+    Category.name.label("category"),
+    Formula.kcal_per_ml,
+    Formula.lactose_int,
+    Formula.gluten_free,
+    Formula.kosher,
+    Formula.features,
+    Formula.indications,
+    Nutrients.kcals,
+    Nutrients.protein_g,
+    Nutrients.fat_g,
+    Nutrients.carb_g,
+    Nutrients.fiber_g,
+    Nutrients.scfos_g,
+    Minerals.sodium_mg,
+    Minerals.potassium_mg,
+    Minerals.phosphorus_mg,
+    Minerals.magnesium_mg,
+    Minerals.vitk_mcg,
+    Fluids.free_water_percent,
+    Fluids.water_ml,
+    Fluids.osmolality,
+)
+
+
+# Nutrition provided per mL of formula: (name, record attribute, divisor to convert to per mL)
+# Nutrients and minerals are listed per 1000 mL, free water as a percent of volume
+PER_ML_COLUMNS = (
+    ("kcals", "kcal_per_ml", 1),
+    ("protein_g", "protein_g", 1000),
+    ("fat_g", "fat_g", 1000),
+    ("carb_g", "carb_g", 1000),
+    ("fiber_g", "fiber_g", 1000),
+    ("scfos_g", "scfos_g", 1000),
+    ("sodium_mg", "sodium_mg", 1000),
+    ("potassium_mg", "potassium_mg", 1000),
+    ("phosphorus_mg", "phosphorus_mg", 1000),
+    ("magnesium_mg", "magnesium_mg", 1000),
+    ("vitk_mcg", "vitk_mcg", 1000),
+    ("free_water_ml", "free_water_percent", 100),
+)
+
+
+class FormulaRecord:
+    """Read-only record of a tube feed formula joined with its category, nutrients, minerals, and fluids"""
+
+    __slots__ = tuple(column.key for column in FORMULA_COLUMNS) + ("per_ml",)
+
+    def __init__(self, row):
+        for column in FORMULA_COLUMNS:
+            object.__setattr__(self, column.key, getattr(row, column.key))
+
+        # Precomputed vector of nutrition per mL, aligned with PER_ML_COLUMNS (None if not on file)
+        object.__setattr__(
+            self,
+            "per_ml",
+            tuple(
+                None if getattr(row, attribute) is None
+                else getattr(row, attribute) / divisor
+                for _, attribute, divisor in PER_ML_COLUMNS
+            ),
+        )
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Formula catalog records are read-only")
+
+    def __delattr__(self, name):
+        raise AttributeError("Formula catalog records are read-only")
+
+
+class FormulaCatalog:
+    """Immutable catalog of formula records keyed by formula id"""
+
+    __slots__ = ("records", "choices", "version")
+
+    def __init__(self, records):
+        object.__setattr__(
+            self, "records", MappingProxyType({record.id: record for record in records})
+        )
+
+        # Choices for formula dropdown menus, in formula id order
+        object.__setattr__(
+            self, "choices", tuple((record.id, record.name) for record in records)
+        )
+
+        # Digest of every record, which changes whenever any formula data does
+        object.__setattr__(
+            self,
+            "version",
+            hashlib.sha256(
+                repr(
+                    [
+                        tuple(getattr(record, column.key) for column in FORMULA_COLUMNS)
+                        for record in records
+                    ]
+                ).encode()
+            ).hexdigest()[:16],
+        )
+
+    def __setattr__(self, name, value):
+        raise AttributeError("The formula catalog is read-only")
+
+    def __delattr__(self, name):
+        raise AttributeError("The formula catalog is read-only")
+
+    def get(self, formula_id):
+        """Return the record for formula_id (as int or numeric string), or None"""
+        try:
+            return self.records.get(int(formula_id))
+        except (TypeError, ValueError):
+            return None
+
+    def __iter__(self):
+        return iter(self.records.values())
+
+    def __len__(self):
+        return len(self.records)
+
+
+def build_catalog():
+    """Build a formula catalog by joining the formula reference tables in a single query"""
+    rows = db.session.execute(
+        db.select(*FORMULA_COLUMNS)
+        .outerjoin(Category, Formula.category_id == Category.id)
+        .outerjoin(Nutrients, Nutrients.formula_id == Formula.id)
+        .outerjoin(Minerals, Minerals.formula_id == Formula.id)
+        .outerjoin(Fluids, Fluids.formula_id == Formula.id)
+        .order_by(Formula.id)
+    ).all()
+
+    return FormulaCatalog([FormulaRecord(row) for row in rows])
+
+
+# Catalog shared by every request in this process
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def load_catalog():
+    """Build the formula catalog and make it the shared catalog for this process"""
+    global _catalog
+
+    with _catalog_lock:
+        _catalog = build_catalog()
+        return _catalog
+
+
+def get_catalog():
+    """Return the shared formula catalog, building it on first use"""
+    global _catalog
+
+    catalog = _catalog
+    if catalog is None:
+        with _catalog_lock:
+            if _catalog is None:
+                _catalog = build_catalog()
+            catalog = _catalog
+    return catalog
+
+
+def invalidate_catalog():
+    """Drop the shared formula catalog so it is rebuilt from the database on next use"""
+    global _catalog
+
+    with _catalog_lock:
+        _catalog = None
@@ -1,44 +1,137 @@
 # # Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
 
+import argparse
 import csv
 import logging
+import time
 
-from sqlalchemy import create_engine, func
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, func, select
 
-# Set up SQLAlchemy
-engine = create_engine("sqlite:///instance/diet.db")
+from catalog import invalidate_catalog
+from extensions import db
+from models import Category, Fluids, Formula, Minerals, Nutrients
 
-Session = sessionmaker(bind=engine)
+# Database loaded from the command line when no other target is given
+DEFAULT_DATABASE_URI = "sqlite:///instance/diet.db"
 
-session = Session()
+# Number of CSV rows inserted per executemany batch
+CHUNK_SIZE = 500
+
+# Reference data files, the models they are loaded into, and the column identifying each row
+REFERENCE_DATA = (
+    ("data/formulas.csv", Formula, "id"),
+    ("data/categories.csv", Category, "id"),
+    ("data/nutrients.csv", Nutrients, "formula_id"),
+    ("data/minerals.csv", Minerals, "formula_id"),
+    ("data/fluids.csv", Fluids, "formula_id"),
+)
 
 # Create a logger
 logger = logging.getLogger(__name__)
 
 
-def is_table_empty(model, id):
+def is_table_empty(model, id, engine=None):
     """Check if table is empty"""
-    count = session.query(func.count(getattr(model, id))).scalar()
+    table = getattr(model, "__table__", model)
+
+    with (engine or db.engine).connect() as connection:
+        count = connection.execute(select(func.count(table.columns[id]))).scalar()
     return count == 0
 
 
-def load_data_from_csv(csv_file, model, id):
+def column_converters(table, fieldnames):
+    """Return one converter per CSV column, turning text into the column's Python type and empty text into None"""
+    converters = []
+    for fieldname in fieldnames:
+        python_type = table.columns[fieldname].type.python_type
+
+        if python_type is str:
+            converters.append(lambda value: value)
+        else:
+            converters.append(
+                lambda value, python_type=python_type: (
+                    python_type(value) if value != "" else None
+                )
+            )
+
+    return converters
+
+
+def read_csv_chunks(csv_file, table, chunk_size=CHUNK_SIZE):
+    """Stream typed rows from a CSV file as lists of dicts of at most chunk_size rows"""
+    with open(csv_file, "r", newline="") as csvfile:
+        csvreader = csv.reader(csvfile)
+        fieldnames = next(csvreader)
+
+        # Look up each column's type once, rather than once per row
+        converters = column_converters(table, fieldnames)
+        columns = list(zip(fieldnames, converters))
+
+        chunk = []
+        for line in csvreader:
+            chunk.append(
+                {
+                    fieldname: convert(value)
+                    for (fieldname, convert), value in zip(columns, line)
+                }
+            )
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+
+        if chunk:
+            yield chunk
+
+
+def bulk_load_csv(
+    csv_file, model, id, engine=None, upsert=False, chunk_size=CHUNK_SIZE
+):
+    """Stream a CSV file into a model's table with batched executemany inserts in one transaction
+
+    Loads into the app's database unless another engine is given. In upsert mode, existing
+    rows whose id column matches a CSV row are replaced, so a refreshed file can be loaded
+    over existing data. Returns the number of rows loaded.
+    """
+    table = getattr(model, "__table__", model)
+    target = engine or db.engine
+
+    start = time.perf_counter()
+    loaded = 0
+
+    # Load the whole file in one transaction, so a bad row leaves the table unchanged
+    with target.begin() as connection:
+        for chunk in read_csv_chunks(csv_file, table, chunk_size):
+            if upsert:
+                connection.execute(
+                    table.delete().where(
+                        table.columns[id].in_([row[id] for row in chunk])
+                    )
+                )
+            connection.execute(table.insert(), chunk)
+            loaded += len(chunk)
+
+    elapsed = time.perf_counter() - start
+    logger.info(
+        "Loaded %d rows from %s into %s in %.2fs (%.0f rows/sec)",
+        loaded,
+        csv_file,
+        table.name,
+        elapsed,
+        loaded / max(elapsed, 1e-9),
+    )
+
+    # Formula reference data changed, so the cached formula catalog is stale
+    invalidate_catalog()
+
+    return loaded
+
+
+def load_data_from_csv(csv_file, model, id, engine=None):
     """Load data from a CSV file into a specified model if not already loaded"""
     # Check if database table is already populated
-    if is_table_empty(model, id):
+    if is_table_empty(model, id, engine):
         try:
-            # Open CSV file
-            with open(csv_file, "r") as csvfile:
-                csvreader = csv.DictReader(csvfile)
-
-                # For each row in the CSV file:
-                for row in csvreader:
-                    # Create a new instance of the model, setting each attribute to the corresponding value in the row
-                    instance = model(**row)
-
-                    # Add the new instance to the SQLAlchemy session
-                    session.add(instance)
+            bulk_load_csv(csv_file, model, id, engine)
 
         # Handle any exceptions appropriately, such as file not found or data conversion errors
         except FileNotFoundError:
@@ -48,9 +141,55 @@ def load_data_from_csv(csv_file, model, id):
         except ValueError:
             logger.error("Error: There was a problem converting the data.")
 
-        # After the loop, commit the session to insert all the new instances into the database
-        session.commit()
-
 
-# After all data has been loaded, close session
-session.close()
+def seed_reference_data(engine=None, upsert=False):
+    """Load every reference data file into its table
+
+    Only empty tables are loaded, so seeding can be repeated safely. In upsert mode every
+    file is reloaded over existing rows instead.
+    """
+    for csv_file, model, id in REFERENCE_DATA:
+        if upsert:
+            bulk_load_csv(csv_file, model, id, engine, upsert=True)
+        else:
+            load_data_from_csv(csv_file, model, id, engine)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Bulk load a CSV file into a database table"
+    )
+    parser.add_argument("csv_file", help="CSV file with a header row of column names")
+    parser.add_argument("table", help="name of the table to load, e.g. formulas")
+    parser.add_argument(
+        "id", help="column identifying rows to replace in upsert mode, e.g. formula_id"
+    )
+    parser.add_argument(
+        "--database",
+        default=DEFAULT_DATABASE_URI,
+        help=f"SQLAlchemy database URI (default: {DEFAULT_DATABASE_URI})",
+    )
+    parser.add_argument(
+        "--upsert",
+        action="store_true",
+        help="replace existing rows with matching ids instead of only inserting",
+    )
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    engine = create_engine(args.database)
+    bulk_load_csv(
+        args.csv_file,
+        db.metadata.tables[args.table],
+        args.id,
+        engine,
+        upsert=args.upsert,
+        chunk_size=args.chunk_size,
+    )
+    engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+"""Streaming data exports
+
+Weight history, weight checks with their significance flags, and nutritional needs are
+exported as CSV, JSON lines, or columnar JSON lines, where each line holds a row group of
+up to ROW_GROUP_SIZE rows stored column by column, in the manner of Parquet. Rows are read
+from the database YIELD_PER at a time and written as they arrive, so an export of every
+weight in the hospital never holds more than a batch of rows in memory.
+"""
+
+import csv
+import io
+import json
+
+from datetime import date, datetime
+from itertools import islice
+
+from extensions import db
+from helpers import WEIGHT_CHECK_COLUMNS, significant_change
+from models import MonthlyWeights, Patient, WeightCheck
+from needs import NEEDS, evaluate_needs
+
+# Export formats and their media types
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson",
+    "columnar": "application/x-ndjson",
+}
+
+# Rows fetched from the database at a time
+YIELD_PER = 1000
+
+# Rows in each row group of columnar output
+ROW_GROUP_SIZE = 10_000
+
+
+def scoped(query, patient_column, provider_id=None, patient_id=None):
+    """Limit a query to one patient, or the patients under care of one provider"""
+    if patient_id is not None:
+        query = query.filter(patient_column == patient_id)
+    if provider_id is not None:
+        query = query.filter(
+            patient_column.in_(db.select(Patient.id).filter_by(provider_id=provider_id))
+        )
+    return query
+
+
+def stream_rows(query):
+    """Yield rows of a query, fetched YIELD_PER at a time"""
+    yield from db.session.execute(query.execution_options(yield_per=YIELD_PER))
+
+
+def weight_rows_query(provider_id=None, patient_id=None):
+    """Select every weight, ordered by patient and weight date"""
+    query = db.select(
+        MonthlyWeights.id,
+        MonthlyWeights.patient_id,
+        MonthlyWeights.user_id,
+        MonthlyWeights.weight_date,
+        MonthlyWeights.patient_weight,
+        MonthlyWeights.timestamp,
+    ).order_by(
+        MonthlyWeights.patient_id, MonthlyWeights.weight_date, MonthlyWeights.id
+    )
+    return scoped(query, MonthlyWeights.patient_id, provider_id, patient_id)
+
+
+def weight_rows(provider_id=None, patient_id=None):
+    """Every weight, ordered by patient and weight date"""
+    for row in stream_rows(weight_rows_query(provider_id, patient_id)):
+        yield tuple(row)
+
+
+def weight_check_rows(provider_id=None, patient_id=None):
+    """Each patient's weight check, with whether the change at each interval is significant"""
+    query = (
+        db.select(
+            Patient.id,
+            Patient.name_last,
+            Patient.name_first,
+            Patient.bed,
+            WeightCheck.current_weight,
+            *(getattr(WeightCheck, column) for column in WEIGHT_CHECK_COLUMNS.values()),
+            WeightCheck.timestamp,
+        )
+        .join(WeightCheck, WeightCheck.patient_id == Patient.id)
+        .order_by(Patient.id)
+    )
+
+    for row in stream_rows(scoped(query, Patient.id, provider_id, patient_id)):
+        changes = row[5 : 5 + len(WEIGHT_CHECK_COLUMNS)]
+        flags = [
+            change is not None and significant_change(change, interval_months)
+            for interval_months, change in zip(WEIGHT_CHECK_COLUMNS, changes)
+        ]
+        yield tuple(row) + tuple(flags) + (any(flags),)
+
+
+def needs_rows_query(provider_id=None, patient_id=None):
+    """Select each patient with the date and weight of their most recent weight"""
+
+    def latest(column):
+        return (
+            db.select(column)
+            .filter(MonthlyWeights.patient_id == Patient.id)
+            .order_by(MonthlyWeights.weight_date.desc(), MonthlyWeights.id.desc())
+            .limit(1)
+            .scalar_subquery()
+        )
+
+    query = db.select(
+        Patient.id,
+        Patient.name_last,
+        Patient.name_first,
+        Patient.bed,
+        latest(MonthlyWeights.weight_date),
+        latest(MonthlyWeights.patient_weight),
+    ).order_by(Patient.id)
+    return scoped(query, Patient.id, provider_id, patient_id)
+
+
+def needs_rows(provider_id=None, patient_id=None):
+    """Each patient's estimated daily needs from their most recent weight"""
+    rows = stream_rows(needs_rows_query(provider_id, patient_id))
+
+    # Needs are estimated for each batch of rows fetched together
+    while True:
+        batch = list(islice(rows, YIELD_PER))
+        if not batch:
+            break
+
+        needs = evaluate_needs([row[5] for row in batch])
+        columns = [column for name in NEEDS for column in needs[name]]
+        for row, values in zip(batch, zip(*columns)):
+            yield tuple(row) + values
+
+
+# Columns and row generator of each dataset
+EXPORT_DATASETS = {
+    "weights": (
+        ["id", "patient_id", "user_id", "weight_date", "patient_weight", "timestamp"],
+        weight_rows,
+    ),
+    "weight_checks": (
+        ["patient_id", "name_last", "name_first", "bed", "current_weight"]
+        + list(WEIGHT_CHECK_COLUMNS.values())
+        + ["timestamp"]
+        + [f"{column}_significant" for column in WEIGHT_CHECK_COLUMNS.values()]
+        + ["significant"],
+        weight_check_rows,
+    ),
+    "needs": (
+        ["patient_id", "name_last", "name_first", "bed", "weight_date", "current_weight"]
+        + [
+            f"{name}_{limit}"
+            for name in NEEDS
+            for limit in ("low", "high")
+        ],
+        needs_rows,
+    ),
+}
+
+
+def plain(value):
+    """Convert a value for JSON, writing dates and times in ISO 8601"""
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def write_csv(columns, rows):
+    """Yield CSV text, a header line and then YIELD_PER rows at a time"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+
+    for count, row in enumerate(rows, start=1):
+        writer.writerow(map(plain, row))
+        if count % YIELD_PER == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue()
+
+
+def write_jsonl(columns, rows):
+    """Yield one JSON object per row, YIELD_PER rows at a time"""
+    lines = []
+    for row in rows:
+        lines.append(json.dumps(dict(zip(columns, map(plain, row)))) + "\n")
+        if len(lines) == YIELD_PER:
+            yield "".join(lines)
+            lines = []
+
+    yield "".join(lines)
+
+
+def write_columnar(columns, rows, row_group_size=ROW_GROUP_SIZE):
+    """Yield a schema line and then one line per row group, holding a list of values per column"""
+    yield json.dumps({"columns": columns}) + "\n"
+
+    group = [[] for _ in columns]
+    count = 0
+    for row in rows:
+        for values, value in zip(group, row):
+            values.append(plain(value))
+        count += 1
+
+        if count == row_group_size:
+            yield json.dumps({"rows": count, "columns": dict(zip(columns, group))}) + "\n"
+            group = [[] for _ in columns]
+            count = 0
+
+    if count:
+        yield json.dumps({"rows": count, "columns": dict(zip(columns, group))}) + "\n"
+
+
+def export(dataset, file_format, provider_id=None, patient_id=None):
+    """Return a generator of the text of a dataset in a format, for one patient or provider or everyone
+
+    Nothing is read from the database until the generator is started.
+    """
+    if dataset not in EXPORT_DATASETS:
+        raise ValueError(
+            f"Unknown export {dataset!r}, expected one of {', '.join(EXPORT_DATASETS)}"
+        )
+    if file_format not in EXPORT_FORMATS:
+        raise ValueError(
+            f"Unknown format {file_format!r}, expected one of {', '.join(EXPORT_FORMATS)}"
+        )
+
+    columns, read_rows = EXPORT_DATASETS[dataset]
+    rows = read_rows(provider_id=provider_id, patient_id=patient_id)
+
+    if file_format == "csv":
+        return write_csv(columns, rows)
+    elif file_format == "jsonl":
+        return write_jsonl(columns, rows)
+    else:
+        return write_columnar(columns, rows)
@@ -1,5 +1,37 @@
 # Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
 
+import sqlite3
+
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 
 db = SQLAlchemy()
+
+# Settings applied to every new SQLite connection. Write-ahead logging lets readers carry on
+# while another worker writes, NORMAL sync is safe in WAL mode without an fsync per commit,
+# and writers wait up to 15 seconds for a lock instead of failing with "database is locked"
+SQLITE_PRAGMAS = (
+    ("journal_mode", "WAL"),
+    ("synchronous", "NORMAL"),
+    ("busy_timeout", 15000),
+)
+
+# Connection pool for file databases, sized for a worker serving requests on several threads
+POOL_OPTIONS = {
+    "pool_size": 10,
+    "max_overflow": 10,
+    "pool_timeout": 30,
+}
+
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Apply SQLITE_PRAGMAS to each new SQLite connection"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS:
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
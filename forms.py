@@ -1,6 +1,7 @@
 # Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
 
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileRequired
 from wtforms import (
     IntegerField,
     FloatField,
@@ -13,6 +14,10 @@ from wtforms import (
 )
 from wtforms.validators import DataRequired, EqualTo, Length
 
+# Rules for patient weights, shared by the weight form and bulk weight imports
+WEIGHT_MIN = 0
+WEIGHT_DATE_FORMAT = "%Y-%m-%d"
+
 
 # Form for user login
 class LoginForm(FlaskForm):
@@ -61,12 +66,47 @@ class TubeFeedForm(FlaskForm):
     )
 
 
+# Form for comparing tube feed regimens across every formula
+class RegimenGridForm(FlaskForm):
+    rate_start = FloatField(
+        "Lowest Rate (mL/hr)",
+        [validators.InputRequired(), validators.NumberRange(min=0)],
+        default=10,
+    )
+    rate_stop = FloatField(
+        "Highest Rate (mL/hr)",
+        [validators.InputRequired(), validators.NumberRange(min=0)],
+        default=100,
+    )
+    rate_step = FloatField(
+        "Rate Step (mL/hr)",
+        [validators.InputRequired(), validators.NumberRange(min=0.1)],
+        default=10,
+    )
+    time = IntegerField(
+        "Time (hr)",
+        [validators.InputRequired(), validators.NumberRange(min=1)],
+        default=24,
+    )
+
+
 # Form for weight input
 class WeightForm(FlaskForm):
     patient = SelectField("Patient", choices=[])
     weight = FloatField(
-        "Weight (lb)", [validators.InputRequired(), validators.NumberRange(min=0)]
+        "Weight (lb)",
+        [validators.InputRequired(), validators.NumberRange(min=WEIGHT_MIN)],
     )
     weight_date = DateField(
-        "Weight Date", [validators.InputRequired()], format="%Y-%m-%d"
+        "Weight Date", [validators.InputRequired()], format=WEIGHT_DATE_FORMAT
     )
+
+
+# Form for uploading a file of patient weights
+class WeightImportForm(FlaskForm):
+    file = FileField("Weights File (CSV or JSON lines)", validators=[FileRequired()])
+
+
+# Form for uploading a census file of patients to admit
+class CensusImportForm(FlaskForm):
+    file = FileField("Census File (CSV or JSON lines)", validators=[FileRequired()])
@@ -1,10 +1,46 @@
 # Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
 
+import base64
+import json
+
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
 from flask import flash, redirect, render_template, session
 from functools import wraps
+from itertools import groupby
+from operator import attrgetter
+
+from extensions import db
+from models import MonthlyWeights, Patient, PatientSummary, WeightCheck
+from needs import NEEDS, evaluate_needs
+from weight_series import weight_series
+
+# Month intervals checked for significant weight change
+WEIGHT_CHECK_INTERVALS = (1, 3, 6, 12)
+
+# WeightCheck column holding the percent weight change at each interval
+WEIGHT_CHECK_COLUMNS = {
+    1: "one_month",
+    3: "three_month",
+    6: "six_month",
+    12: "twelve_month",
+}
+
+# Percent weight change (loss or gain) at each interval that is clinically significant
+WEIGHT_CHANGE_LIMITS = {1: 5.0, 3: 7.5, 6: 10.0, 12: 20.0}
 
-from models import MonthlyWeights
+# Rows shown per page of the roster and history, and the most a request can ask for
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+# Columns the roster (in name order) and history (newest weight date first) are paged by
+ROSTER_ORDER = (Patient.name_last, Patient.name_first, Patient.id)
+HISTORY_ORDER = (MonthlyWeights.weight_date, MonthlyWeights.id)
+
+# Most patients on one rounds report, and the recent weights shown for each
+MAX_ROUNDS_PATIENTS = 100
+ROUNDS_WEIGHTS = 5
 
 
 def login_required(f):
@@ -23,6 +59,92 @@ def login_required(f):
     return decorated_function
 
 
+def own_patient(patient_id):
+    """Returns the logged-in user's patient with patient_id, or None if they have no such patient"""
+    return db.session.scalar(
+        db.select(Patient).filter_by(id=patient_id, provider_id=session["user_id"])
+    )
+
+
+def roster_query(provider_id):
+    """Queries the patients under care of a provider, paged in ROSTER_ORDER"""
+    return Patient.query.filter_by(provider_id=provider_id)
+
+
+def history_query(user_id):
+    """Queries the weights entered by a user, paged in HISTORY_ORDER"""
+    return MonthlyWeights.query.filter_by(user_id=user_id)
+
+
+def patient_search_query(name_last, name_first, limit):
+    """Queries patients by the start of their last and first names, in name order
+
+    Either prefix may be empty, and both must be lowercase. Last names are found from
+    the prefix up to the next prefix, which the lower(name_last) index can seek to.
+    """
+    name_last_lower = db.func.lower(Patient.name_last)
+    query = Patient.query
+    if name_last:
+        query = query.filter(
+            name_last_lower >= name_last,
+            name_last_lower < name_last[:-1] + chr(ord(name_last[-1]) + 1),
+        )
+    if name_first:
+        query = query.filter(
+            db.func.lower(Patient.name_first).startswith(name_first, autoescape=True)
+        )
+
+    return query.order_by(name_last_lower, Patient.name_first, Patient.id).limit(limit)
+
+
+def weight_check_query(patient_id):
+    """Queries a patient's weight check"""
+    return WeightCheck.query.filter_by(patient_id=patient_id)
+
+
+def rounds_query(patient_ids, provider_id):
+    """Selects a provider's patients with patient_ids, each with their weight check"""
+    return (
+        db.select(Patient, WeightCheck)
+        .outerjoin(WeightCheck, WeightCheck.patient_id == Patient.id)
+        .filter(Patient.id.in_(patient_ids), Patient.provider_id == provider_id)
+    )
+
+
+def dashboard_counts_query(provider_id):
+    """Selects a provider's counts of patients, weight checks, and flagged patients"""
+    return (
+        db.select(
+            db.func.count(Patient.id),
+            db.func.count(PatientSummary.patient_id),
+            db.func.count(PatientSummary.patient_id).filter(PatientSummary.flagged),
+        )
+        .outerjoin(PatientSummary, PatientSummary.patient_id == Patient.id)
+        .filter(Patient.provider_id == provider_id)
+    )
+
+
+def dashboard_query(provider_id, show_all=False):
+    """Selects a provider's flagged patients' summaries, or all with show_all, by name
+
+    Flagged patients are found through the (provider_id, flagged) index.
+    """
+    query = (
+        db.select(PatientSummary, Patient.name_last, Patient.name_first, Patient.bed)
+        .join(Patient, Patient.id == PatientSummary.patient_id)
+        .filter(PatientSummary.provider_id == provider_id)
+        .order_by(Patient.name_last, Patient.name_first, Patient.id)
+    )
+    if not show_all:
+        query = query.filter(PatientSummary.flagged.is_(True))
+    return query
+
+
+def significant_change(percent_change, interval_months):
+    """Returns whether a percent weight change at an interval is clinically significant"""
+    return abs(percent_change) >= WEIGHT_CHANGE_LIMITS[interval_months]
+
+
 def weight_change(patient_id, interval_months, current_weight, weight_date):
     """Calculates percentage weight change in a given interval of months"""
     # Calculate the date interval_months ago from weight_date
@@ -92,3 +214,381 @@ def weight_change(patient_id, interval_months, current_weight, weight_date):
         ) * 100
 
     return percent_change
+
+
+def weight_on_date(dates, weights, target_date):
+    """Returns the first weight recorded on exactly target_date, or None"""
+    target = target_date.toordinal()
+    index = bisect_left(dates, target)
+    if index < len(dates) and dates[index] == target:
+        return weights[index]
+    return None
+
+
+def series_weight_change(dates, weights, interval_months, current_weight, weight_date):
+    """Calculates percentage weight change in a given interval of months from a loaded weight series
+
+    dates are the series' weight dates as ordinals, oldest first. Mirrors weight_change()
+    without touching the database, returning the percent change and the message
+    weight_change() would have flashed (or None).
+    """
+    # Calculate the date interval_months ago from weight_date
+    interval_ago = weight_date - relativedelta(months=interval_months)
+
+    # Find the weight record at the closest date on or before the calculated date
+    index = bisect_right(dates, interval_ago.toordinal())
+
+    if index:
+        weight_at_interval_ago = weights[index - 1]
+        percent_change = (
+            (current_weight - weight_at_interval_ago) / weight_at_interval_ago
+        ) * 100
+        return percent_change, None
+
+    # If no weight record is found at interval, attempt to find weights one month before and one month after interval
+    weight_before = weight_on_date(
+        dates, weights, interval_ago - relativedelta(months=1)
+    )
+    weight_after = weight_on_date(dates, weights, interval_ago + relativedelta(months=1))
+
+    if weight_before is not None and weight_after is not None:
+        # If both neighboring weights are available, calculate the average weight to estimate the change
+        interval_average_weight = (weight_before + weight_after) / 2
+
+        percent_change = (
+            (current_weight - interval_average_weight) / interval_average_weight
+        ) * 100
+
+        return (
+            percent_change,
+            f"No weight found for given interval. Average of weights from surrounding months: {interval_average_weight:.2f}",
+        )
+
+    # If no neighboring weights available, indicate that there is no data to calculate weight change
+    interval_text = f"{interval_months} month{'s' if interval_months > 1 else ''}"
+    return (
+        0.0,
+        f"No weight found for given interval {interval_text} and no surrounding weights available to calculate average at {weight_date}.",
+    )
+
+
+def weight_changes(patient_id, intervals=WEIGHT_CHECK_INTERVALS):
+    """Calculates percentage weight change at every interval from the patient's weight series
+
+    Returns the current weight and a dict of percent change keyed by interval, or (None, {})
+    if the patient has no weights. Fallback messages are flashed as weight_change() does.
+    """
+    series = weight_series.get(patient_id)
+
+    if not len(series):
+        return None, {}
+
+    # The most recent weight is the current weight
+    current_weight = series.weights[-1]
+    weight_date = date.fromordinal(series.dates[-1])
+
+    changes = {}
+    for interval_months in intervals:
+        percent_change, message = series_weight_change(
+            series.dates, series.weights, interval_months, current_weight, weight_date
+        )
+        if message:
+            flash(message)
+        changes[interval_months] = percent_change
+
+    return current_weight, changes
+
+
+def batch_weights_query(patient_ids=None, provider_id=None):
+    """Queries the weights of patients by id, by provider, or of all patients
+
+    Weights are ordered by patient and weight date.
+    """
+    query = MonthlyWeights.query.with_entities(
+        MonthlyWeights.patient_id,
+        MonthlyWeights.weight_date,
+        MonthlyWeights.patient_weight,
+    )
+
+    if patient_ids is not None:
+        query = query.filter(MonthlyWeights.patient_id.in_(patient_ids))
+    elif provider_id is not None:
+        query = query.filter(
+            MonthlyWeights.patient_id.in_(
+                db.select(Patient.id).filter_by(provider_id=provider_id)
+            )
+        )
+
+    return query.order_by(
+        MonthlyWeights.patient_id.asc(),
+        MonthlyWeights.weight_date.asc(),
+        MonthlyWeights.id.asc(),
+    )
+
+
+def batch_weight_check(patient_ids=None, provider_id=None):
+    """Recalculates and upserts weight checks for many patients in one pass
+
+    Weights for every selected patient are pulled in a single query ordered by patient
+    and date, grouped per patient in memory, and all WeightCheck rows are written in one
+    transaction. Patients are selected by id, by provider, or all patients if neither is given.
+    Returns the number of patients whose weight check was updated.
+    """
+    checks_query = WeightCheck.query
+
+    if patient_ids is not None:
+        checks_query = checks_query.filter(WeightCheck.patient_id.in_(patient_ids))
+    elif provider_id is not None:
+        checks_query = checks_query.filter(
+            WeightCheck.patient_id.in_(
+                db.select(Patient.id).filter_by(provider_id=provider_id)
+            )
+        )
+
+    rows = batch_weights_query(patient_ids, provider_id).all()
+
+    # Existing weight check rows, keyed by patient, so they can be updated in place
+    weight_check_rows = {row.patient_id: row for row in checks_query.all()}
+
+    timestamp = datetime.now()
+    updated = 0
+
+    for patient_id, patient_rows in groupby(rows, key=attrgetter("patient_id")):
+        patient_rows = list(patient_rows)
+        dates = [row.weight_date.toordinal() for row in patient_rows]
+        weights = [row.patient_weight for row in patient_rows]
+
+        # The most recent weight is the current weight
+        current_weight = weights[-1]
+        weight_date = patient_rows[-1].weight_date
+
+        changes = {
+            interval_months: series_weight_change(
+                dates, weights, interval_months, current_weight, weight_date
+            )[0]
+            for interval_months in WEIGHT_CHECK_INTERVALS
+        }
+
+        # If a row doesn't exist yet, create a new one
+        weight_check_row = weight_check_rows.get(patient_id)
+        if weight_check_row is None:
+            weight_check_row = WeightCheck(patient_id=patient_id)
+            db.session.add(weight_check_row)
+
+        weight_check_row.current_weight = current_weight
+        weight_check_row.one_month = changes[1]
+        weight_check_row.three_month = changes[3]
+        weight_check_row.six_month = changes[6]
+        weight_check_row.twelve_month = changes[12]
+        weight_check_row.timestamp = timestamp
+        updated += 1
+
+    # Commit every weight check, and the dashboard summaries copying them, in one transaction
+    refresh_patient_summaries(patient_ids=patient_ids, provider_id=provider_id)
+    db.session.commit()
+
+    return updated
+
+
+def affected_intervals(series, index, intervals=WEIGHT_CHECK_INTERVALS):
+    """Returns the intervals whose weight change depends on the weight at index of a series
+
+    A new current weight moves every interval. An earlier weight only matters to intervals
+    whose lookup reaches its date: the closest weight on or before the interval date, or
+    the weights one month either side of it.
+    """
+    if index == len(series) - 1:
+        return tuple(intervals)
+
+    weight_date = date.fromordinal(series.dates[-1])
+    ordinal = series.dates[index]
+
+    affected = []
+    for interval_months in intervals:
+        interval_ago = weight_date - relativedelta(months=interval_months)
+        if ordinal <= (interval_ago + relativedelta(months=1)).toordinal():
+            affected.append(interval_months)
+    return tuple(affected)
+
+
+def update_weight_check(patient_id, weight_id):
+    """Brings a patient's weight check up to date after a weight is added
+
+    Only the intervals the new weight affects are recalculated, from the patient's weight
+    series. Every interval is calculated if the patient has no weight check yet, or if it
+    was performed before weights other than the new one were entered. Returns the weight
+    check row (added to the session, not committed), or None if the weight wasn't found.
+    """
+    series = weight_series.get(patient_id)
+
+    try:
+        index = series.ids.index(weight_id)
+    except ValueError:
+        return None
+
+    weight_check_row = weight_check_query(patient_id).first()
+
+    # If a row doesn't exist yet, create a new one
+    if weight_check_row is None:
+        weight_check_row = WeightCheck(patient_id=patient_id)
+        db.session.add(weight_check_row)
+        intervals = WEIGHT_CHECK_INTERVALS
+    elif weight_check_row.timestamp is not None and series.entered_by(
+        weight_check_row.timestamp, skip=index
+    ):
+        intervals = affected_intervals(series, index)
+    else:
+        intervals = WEIGHT_CHECK_INTERVALS
+
+    # The most recent weight is the current weight
+    current_weight = series.weights[-1]
+    weight_date = date.fromordinal(series.dates[-1])
+
+    for interval_months in intervals:
+        percent_change = series_weight_change(
+            series.dates, series.weights, interval_months, current_weight, weight_date
+        )[0]
+        setattr(weight_check_row, WEIGHT_CHECK_COLUMNS[interval_months], percent_change)
+
+    weight_check_row.current_weight = current_weight
+    weight_check_row.timestamp = datetime.now()
+
+    # Bring the patient's dashboard summary up to date in the same transaction
+    refresh_patient_summaries(patient_ids=[patient_id])
+
+    return weight_check_row
+
+
+def refresh_patient_summaries(patient_ids=None, provider_id=None):
+    """Rewrites dashboard summaries from patients' weight checks and latest weight dates
+
+    Each selected patient's weight check and latest weight date are read in one query, and
+    their summaries replaced in the current transaction (not committed), so summaries change
+    along with the weight checks they copy. Patients without a weight check get no summary.
+    Patients are selected by id, by provider, or all patients if neither is given. Returns
+    the number of summaries written.
+    """
+    weight_date = (
+        db.select(db.func.max(MonthlyWeights.weight_date))
+        .filter(MonthlyWeights.patient_id == Patient.id)
+        .scalar_subquery()
+    )
+    query = db.select(
+        Patient.id,
+        Patient.provider_id,
+        WeightCheck.current_weight,
+        weight_date,
+        *(getattr(WeightCheck, column) for column in WEIGHT_CHECK_COLUMNS.values()),
+    ).join(WeightCheck, WeightCheck.patient_id == Patient.id)
+    stale = db.delete(PatientSummary)
+
+    if patient_ids is not None:
+        query = query.filter(Patient.id.in_(patient_ids))
+        stale = stale.filter(PatientSummary.patient_id.in_(patient_ids))
+    elif provider_id is not None:
+        query = query.filter(Patient.provider_id == provider_id)
+        stale = stale.filter(
+            PatientSummary.patient_id.in_(
+                db.select(Patient.id).filter_by(provider_id=provider_id)
+            )
+        )
+
+    summaries = {}
+    timestamp = datetime.now()
+
+    rows = db.session.execute(query).all()
+
+    # Needs of every selected patient are estimated in one batch
+    needs = evaluate_needs([row.current_weight for row in rows])
+
+    for position, row in enumerate(rows):
+        patient_id, patient_provider, current_weight, latest_date, *changes = row
+        changes = dict(zip(WEIGHT_CHECK_COLUMNS.values(), changes))
+
+        # A patient is flagged if the change at any interval is clinically significant
+        flagged = any(
+            change is not None and significant_change(change, interval_months)
+            for interval_months, change in zip(WEIGHT_CHECK_COLUMNS, changes.values())
+        )
+
+        summaries[patient_id] = {
+            "patient_id": patient_id,
+            "provider_id": patient_provider,
+            "current_weight": current_weight,
+            "weight_date": latest_date,
+            **changes,
+            "flagged": flagged,
+            **{
+                f"{name}_{limit}": column[position]
+                for name in NEEDS
+                for limit, column in zip(("low", "high"), needs[name])
+            },
+            "timestamp": timestamp,
+        }
+
+    # Replace the selected patients' summaries
+    db.session.execute(stale)
+    if summaries:
+        db.session.execute(db.insert(PatientSummary), list(summaries.values()))
+
+    return len(summaries)
+
+
+def page_size_arg(args, default=PAGE_SIZE):
+    """Reads the page_size query parameter, limited to between 1 and MAX_PAGE_SIZE"""
+    return max(1, min(args.get("page_size", default, type=int), MAX_PAGE_SIZE))
+
+
+def encode_cursor(values):
+    """Encodes the sort key of the last row on a page as an opaque, URL-safe cursor"""
+    payload = json.dumps(
+        [value.isoformat() if isinstance(value, date) else value for value in values]
+    )
+    return base64.urlsafe_b64encode(payload.encode()).decode()
+
+
+def decode_cursor(cursor, columns):
+    """Decodes a cursor into sort key values for columns, raising ValueError if it is malformed"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError
+        return tuple(
+            date.fromisoformat(value) if isinstance(column.type, db.Date) else value
+            for column, value in zip(columns, values)
+        )
+    except (TypeError, ValueError):
+        raise ValueError("Invalid page cursor")
+
+
+def keyset_query(query, columns, cursor=None, page_size=PAGE_SIZE, descending=False):
+    """Returns a query of the rows of one page after the cursor, ordered by columns
+
+    columns must end with a unique column, such as id. Rows after the cursor are found with a
+    row value comparison that an index on columns can seek to, so every page costs the same
+    however far into the table it is. One row more than page_size is selected, to show
+    whether another page follows.
+    """
+    if cursor:
+        after = decode_cursor(cursor, columns)
+        key = db.tuple_(*columns)
+        query = query.filter(key < after if descending else key > after)
+
+    return query.order_by(
+        *(column.desc() if descending else column.asc() for column in columns)
+    ).limit(page_size + 1)
+
+
+def keyset_page(query, columns, cursor=None, page_size=PAGE_SIZE, descending=False):
+    """Returns one page of a query ordered by columns, and the next page's cursor
+
+    Rows are selected by keyset_query().
+    """
+    rows = keyset_query(query, columns, cursor, page_size, descending).all()
+
+    # The extra row only shows whether another page follows
+    if len(rows) <= page_size:
+        return rows, None
+
+    rows = rows[:page_size]
+    return rows, encode_cursor([getattr(rows[-1], column.key) for column in columns])
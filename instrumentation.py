@@ -0,0 +1,336 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+"""Opt-in request instrumentation
+
+Records wall time, SQL statement count and time, and template render time for each route,
+warns when a request repeats the same SQL statement many times (an N+1 query pattern), and
+serves the numbers at /metrics in Prometheus text format. Sampled requests can also be
+profiled with cProfile, keeping the profile only if the request turned out to be slow.
+
+Enable with the INSTRUMENTATION setting (FLASK_INSTRUMENTATION=true). Metrics are kept
+per process, so each worker reports its own, and are only served to logged-in users or to
+scrapers sending the METRICS_TOKEN setting as a bearer token.
+"""
+
+import cProfile
+import hmac
+import os
+import random
+import threading
+import time
+
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from flask import (
+    Response,
+    before_render_template,
+    g,
+    has_request_context,
+    request,
+    request_finished,
+    request_started,
+    request_tearing_down,
+    session,
+    template_rendered,
+)
+from sqlalchemy import event
+
+from extensions import db
+
+# Upper bounds in seconds of the request duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Executions of one SQL statement in a single request that suggest an N+1 query pattern
+N_PLUS_ONE_THRESHOLD = 5
+
+# Prefix of every metric name
+METRIC_PREFIX = "dietitians_friend"
+
+
+class RequestMetrics:
+    """Timings and SQL statements collected while serving one request"""
+
+    __slots__ = (
+        "start",
+        "sql_count",
+        "sql_seconds",
+        "template_seconds",
+        "template_starts",
+        "statements",
+        "profiler",
+        "status",
+    )
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+        # Start times of the templates being rendered, as templates render inside others
+        self.template_starts = []
+        self.statements = Counter()
+        self.profiler = None
+        self.status = 500
+
+
+class RouteMetrics:
+    """Totals and a duration histogram for one route and method"""
+
+    __slots__ = (
+        "requests",
+        "statuses",
+        "seconds",
+        "buckets",
+        "sql_count",
+        "sql_seconds",
+        "template_seconds",
+        "n_plus_one",
+    )
+
+    def __init__(self):
+        self.requests = 0
+        self.statuses = Counter()
+        self.seconds = 0.0
+        self.buckets = [0] * (len(DURATION_BUCKETS) + 1)
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.template_seconds = 0.0
+        self.n_plus_one = 0
+
+
+class MetricsRegistry:
+    """Per-route metrics for this process, rendered in Prometheus text format"""
+
+    def __init__(self):
+        self.routes = defaultdict(RouteMetrics)
+        self._lock = threading.Lock()
+
+    def record(self, route, method, seconds, metrics, n_plus_one):
+        with self._lock:
+            totals = self.routes[(route, method)]
+            totals.requests += 1
+            totals.statuses[metrics.status] += 1
+            totals.seconds += seconds
+            totals.buckets[bisect_left(DURATION_BUCKETS, seconds)] += 1
+            totals.sql_count += metrics.sql_count
+            totals.sql_seconds += metrics.sql_seconds
+            totals.template_seconds += metrics.template_seconds
+            totals.n_plus_one += n_plus_one
+
+    def render(self):
+        """Return every metric in Prometheus text exposition format"""
+        with self._lock:
+            routes = sorted(self.routes.items())
+
+            lines = []
+
+            def family(name, kind, help_text):
+                lines.append(f"# HELP {METRIC_PREFIX}_{name} {help_text}")
+                lines.append(f"# TYPE {METRIC_PREFIX}_{name} {kind}")
+
+            family("requests_total", "counter", "Requests served, by route, method, and status")
+            for (route, method), totals in routes:
+                for status, count in sorted(totals.statuses.items()):
+                    lines.append(
+                        f"{METRIC_PREFIX}_requests_total"
+                        f"{labels(route=route, method=method, status=status)} {count}"
+                    )
+
+            family("request_duration_seconds", "histogram", "Request wall time")
+            for (route, method), totals in routes:
+                cumulative = 0
+                for bound, count in zip(DURATION_BUCKETS + ("+Inf",), totals.buckets):
+                    cumulative += count
+                    lines.append(
+                        f"{METRIC_PREFIX}_request_duration_seconds_bucket"
+                        f"{labels(route=route, method=method, le=bound)} {cumulative}"
+                    )
+                lines.append(
+                    f"{METRIC_PREFIX}_request_duration_seconds_sum"
+                    f"{labels(route=route, method=method)} {totals.seconds}"
+                )
+                lines.append(
+                    f"{METRIC_PREFIX}_request_duration_seconds_count"
+                    f"{labels(route=route, method=method)} {totals.requests}"
+                )
+
+            for name, attribute, help_text in (
+                ("sql_statements_total", "sql_count", "SQL statements executed"),
+                ("sql_duration_seconds_total", "sql_seconds", "Time spent executing SQL"),
+                ("template_duration_seconds_total", "template_seconds", "Time spent rendering templates"),
+                ("n_plus_one_total", "n_plus_one", "SQL statements repeated often enough in one request to suggest an N+1 pattern"),
+            ):
+                family(name, "counter", help_text)
+                for (route, method), totals in routes:
+                    lines.append(
+                        f"{METRIC_PREFIX}_{name}{labels(route=route, method=method)}"
+                        f" {getattr(totals, attribute)}"
+                    )
+
+        return "\n".join(lines) + "\n"
+
+
+def labels(**values):
+    """Format Prometheus labels, escaping backslashes, quotes, and newlines in values"""
+    formatted = (
+        f'{name}="'
+        + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        + '"'
+        for name, value in values.items()
+    )
+    return "{" + ",".join(formatted) + "}"
+
+
+def summarize_statement(statement, length=300):
+    """Shorten a SQL statement for logging, eliding the column list of a SELECT"""
+    statement = " ".join(statement.split())
+    columns, found, rest = statement.partition(" FROM ")
+    if found and columns.startswith("SELECT"):
+        statement = "SELECT ... FROM " + rest
+    return statement[:length]
+
+
+def current_metrics():
+    """Return the metrics of the request being served, or None outside an instrumented request"""
+    if not has_request_context():
+        return None
+    return g.get("_request_metrics")
+
+
+def init_instrumentation(app):
+    """Hook request, template, and SQL timing into the app, and serve them at /metrics
+
+    Settings:
+        METRICS_TOKEN: bearer token that lets a scraper read /metrics without logging in
+        N_PLUS_ONE_THRESHOLD: executions of one statement in a request that log a warning
+        PROFILE_SAMPLE_RATE: fraction of requests to run under cProfile (default 0, off)
+        PROFILE_SLOW_SECONDS: sampled requests slower than this have their profile kept
+        PROFILE_DIR: where kept profiles are written (default instance/profiles)
+    """
+    registry = MetricsRegistry()
+    metrics_token = app.config.get("METRICS_TOKEN")
+    threshold = app.config.get("N_PLUS_ONE_THRESHOLD", N_PLUS_ONE_THRESHOLD)
+    sample_rate = app.config.get("PROFILE_SAMPLE_RATE", 0)
+    slow_seconds = app.config.get("PROFILE_SLOW_SECONDS", 0.5)
+    profile_dir = app.config.get(
+        "PROFILE_DIR", os.path.join(app.instance_path, "profiles")
+    )
+
+    def request_started_handler(sender, **extra):
+        metrics = g._request_metrics = RequestMetrics()
+
+        if sample_rate and random.random() < sample_rate:
+            metrics.profiler = cProfile.Profile()
+            metrics.profiler.enable()
+
+    def request_finished_handler(sender, response, **extra):
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics.status = response.status_code
+
+    def request_tearing_down_handler(sender, **extra):
+        metrics = current_metrics()
+        if metrics is None:
+            return
+        g._request_metrics = None
+
+        seconds = time.perf_counter() - metrics.start
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+        repeated = [
+            (statement, count)
+            for statement, count in metrics.statements.items()
+            if count >= threshold
+        ]
+        for statement, count in repeated:
+            app.logger.warning(
+                "Possible N+1 query in %s %s: %d executions of %s",
+                request.method,
+                route,
+                count,
+                summarize_statement(statement),
+            )
+
+        registry.record(route, request.method, seconds, metrics, len(repeated))
+
+        if metrics.profiler is not None:
+            metrics.profiler.disable()
+            if seconds >= slow_seconds:
+                os.makedirs(profile_dir, exist_ok=True)
+                filename = "{}-{}-{:.0f}ms.prof".format(
+                    datetime.now().strftime("%Y%m%dT%H%M%S%f"),
+                    request.endpoint or "unmatched",
+                    seconds * 1000,
+                )
+                metrics.profiler.dump_stats(os.path.join(profile_dir, filename))
+
+    def before_render_handler(sender, template, context, **extra):
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics.template_starts.append(time.perf_counter())
+
+    def template_rendered_handler(sender, template, context, **extra):
+        metrics = current_metrics()
+        if metrics is None or not metrics.template_starts:
+            return
+        start = metrics.template_starts.pop()
+
+        # Templates rendered inside another are timed as part of the outermost one
+        if not metrics.template_starts:
+            metrics.template_seconds += time.perf_counter() - start
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if current_metrics() is not None:
+            conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        metrics = current_metrics()
+        if metrics is None or not conn.info.get("query_start"):
+            return
+        metrics.sql_count += 1
+        metrics.sql_seconds += time.perf_counter() - conn.info["query_start"].pop()
+        metrics.statements[statement] += 1
+
+    # Signal receivers are only weakly referenced, so the app keeps them alive
+    app.extensions["instrumentation"] = (
+        request_started_handler,
+        request_finished_handler,
+        request_tearing_down_handler,
+        before_render_handler,
+        template_rendered_handler,
+    )
+    request_started.connect(request_started_handler, app)
+    request_finished.connect(request_finished_handler, app)
+    request_tearing_down.connect(request_tearing_down_handler, app)
+    before_render_template.connect(before_render_handler, app)
+    template_rendered.connect(template_rendered_handler, app)
+
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute", before_cursor_execute)
+        event.listen(db.engine, "after_cursor_execute", after_cursor_execute)
+
+    def metrics():
+        """Serve per-route metrics in Prometheus text format, to logged-in users or the metrics token"""
+        scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+        token_valid = (
+            metrics_token
+            and scheme.lower() == "bearer"
+            and hmac.compare_digest(token.strip().encode(), metrics_token.encode())
+        )
+        if not token_valid and session.get("user_id") is None:
+            return Response(
+                "Log in or send the metrics token\n",
+                status=401,
+                mimetype="text/plain",
+                headers={"WWW-Authenticate": 'Bearer realm="metrics"'},
+            )
+
+        return Response(
+            registry.render(), mimetype="text/plain; version=0.0.4; charset=utf-8"
+        )
+
+    app.add_url_rule("/metrics", "metrics", metrics)
+
+    return registry
@@ -0,0 +1,438 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+"""Background jobs
+
+Routes enqueue long-running work, such as weight checks for a whole ward, and return
+straight away. Jobs are kept in the jobs table, so any worker process can run them and
+they survive restarts, or in this process alone with the memory backend. Each process
+runs jobs on a small pool of worker threads started on first use, and `flask run-jobs`
+runs a dedicated worker process so long calculations can use other cores.
+
+Failed jobs are retried with exponential backoff until they reach their attempt limit.
+"""
+
+import json
+import threading
+import time
+import traceback
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from extensions import db
+from models import Job
+
+# Job backends selectable with the JOB_BACKEND setting
+JOB_BACKENDS = ("database", "memory")
+
+# Worker threads each process starts for jobs, unless set with the JOB_WORKERS setting
+JOB_WORKERS = 2
+
+# Seconds idle workers wait before checking for jobs enqueued by other processes
+JOB_POLL_SECONDS = 1.0
+
+# Seconds a job may run before another worker assumes its worker died and runs it again,
+# if it has attempts left; otherwise it is marked failed
+JOB_LEASE_SECONDS = 600
+
+# Attempts at a job before it is marked failed
+MAX_ATTEMPTS = 3
+
+# Job functions registered with the job decorator, keyed by name
+JOBS = {}
+
+# Job statuses
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+# Error of jobs whose last attempt outlived its lease
+LEASE_EXPIRED = "Lease expired on the last attempt"
+
+# Snapshot of a job's state
+JobRecord = namedtuple(
+    "JobRecord",
+    [
+        "id",
+        "name",
+        "args",
+        "status",
+        "attempts",
+        "max_attempts",
+        "result",
+        "error",
+        "user_id",
+        "created",
+        "run_after",
+        "started",
+        "finished",
+    ],
+)
+
+
+def job(name):
+    """Decorate a function to register it as a job that can be enqueued by name
+
+    The function is called in an app context with the job's keyword arguments, and
+    returns a JSON-serializable result.
+    """
+
+    def decorator(f):
+        JOBS[name] = f
+        return f
+
+    return decorator
+
+
+def retry_delay(attempts):
+    """Return how long to wait before retrying a job that has failed attempts times"""
+    return timedelta(seconds=2**attempts)
+
+
+class DatabaseJobStore:
+    """Keeps jobs in the jobs table, shared by every worker process using the database
+
+    Bookkeeping uses its own connections, so it never commits or rolls back the database
+    session of a request or a running job. Workers claim a job with a conditional update,
+    so each attempt runs in exactly one worker.
+    """
+
+    def add(self, name, args, user_id, max_attempts):
+        now = datetime.now()
+        with db.engine.begin() as connection:
+            return connection.execute(
+                db.insert(Job).values(
+                    name=name,
+                    args=json.dumps(args),
+                    status=QUEUED,
+                    attempts=0,
+                    max_attempts=max_attempts,
+                    user_id=user_id,
+                    created=now,
+                    run_after=now,
+                )
+            ).inserted_primary_key[0]
+
+    def get(self, job_id):
+        with db.engine.connect() as connection:
+            row = connection.execute(
+                db.select(*(getattr(Job, field) for field in JobRecord._fields)).filter(
+                    Job.id == job_id
+                )
+            ).first()
+
+        if row is None:
+            return None
+        return JobRecord(**row._asdict())._replace(
+            args=json.loads(row.args),
+            result=None if row.result is None else json.loads(row.result),
+        )
+
+    def claim(self, lease):
+        now = datetime.now()
+
+        # Jobs due to run, and running jobs that outlived their lease, as their worker may have died
+        due = db.and_(Job.status == QUEUED, Job.run_after <= now)
+        expired = db.and_(Job.status == RUNNING, Job.started < now - lease)
+
+        # Expired jobs are only run again if they have attempts left, as a slow worker may
+        # still be running them
+        claimable = db.or_(due, db.and_(expired, Job.attempts < Job.max_attempts))
+
+        while True:
+            with db.engine.begin() as connection:
+                row = connection.execute(
+                    db.select(Job.id, Job.status, Job.attempts, Job.max_attempts)
+                    .filter(db.or_(due, expired))
+                    .order_by(Job.id)
+                    .limit(1)
+                ).first()
+                if row is None:
+                    return None
+
+                if row.status == RUNNING and row.attempts >= row.max_attempts:
+                    connection.execute(
+                        db.update(Job)
+                        .filter(Job.id == row.id, expired)
+                        .values(status=FAILED, error=LEASE_EXPIRED, finished=now)
+                    )
+                    continue
+
+                # Another worker may have claimed the job since it was selected
+                claimed = connection.execute(
+                    db.update(Job)
+                    .filter(Job.id == row.id, claimable)
+                    .values(status=RUNNING, started=now, attempts=Job.attempts + 1)
+                ).rowcount
+
+            if claimed:
+                return self.get(row.id)
+
+    def finish(self, job_id, result):
+        with db.engine.begin() as connection:
+            connection.execute(
+                db.update(Job)
+                .filter(Job.id == job_id)
+                .values(
+                    status=SUCCEEDED,
+                    result=json.dumps(result),
+                    error=None,
+                    finished=datetime.now(),
+                )
+            )
+
+    def fail(self, job_id, error, retry_at):
+        values = {"error": error}
+        if retry_at is None:
+            values.update(status=FAILED, finished=datetime.now())
+        else:
+            values.update(status=QUEUED, run_after=retry_at)
+
+        with db.engine.begin() as connection:
+            connection.execute(db.update(Job).filter(Job.id == job_id).values(**values))
+
+
+class MemoryJobStore:
+    """Keeps jobs in this process, for setups without a shared database
+
+    Jobs are lost on restart and only run by this process's worker threads.
+    """
+
+    def __init__(self):
+        self._jobs = {}
+        self._next_id = 1
+        self._lock = threading.Lock()
+
+    def add(self, name, args, user_id, max_attempts):
+        now = datetime.now()
+        with self._lock:
+            job_id = self._next_id
+            self._next_id += 1
+
+            # Arguments are stored serialized, as the database backend does
+            self._jobs[job_id] = JobRecord(
+                job_id,
+                name,
+                json.loads(json.dumps(args)),
+                QUEUED,
+                0,
+                max_attempts,
+                None,
+                None,
+                user_id,
+                now,
+                now,
+                None,
+                None,
+            )
+            return job_id
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def claim(self, lease):
+        now = datetime.now()
+        with self._lock:
+            for record in self._jobs.values():
+                expired = record.status == RUNNING and record.started < now - lease
+
+                # Expired jobs without attempts left may still be running, so aren't run again
+                if expired and record.attempts >= record.max_attempts:
+                    self._jobs[record.id] = record._replace(
+                        status=FAILED, error=LEASE_EXPIRED, finished=now
+                    )
+                elif expired or (record.status == QUEUED and record.run_after <= now):
+                    record = self._jobs[record.id] = record._replace(
+                        status=RUNNING, started=now, attempts=record.attempts + 1
+                    )
+                    return record
+        return None
+
+    def finish(self, job_id, result):
+        with self._lock:
+            self._jobs[job_id] = self._jobs[job_id]._replace(
+                status=SUCCEEDED,
+                result=json.loads(json.dumps(result)),
+                error=None,
+                finished=datetime.now(),
+            )
+
+    def fail(self, job_id, error, retry_at):
+        with self._lock:
+            record = self._jobs[job_id]._replace(error=error)
+            if retry_at is None:
+                record = record._replace(status=FAILED, finished=datetime.now())
+            else:
+                record = record._replace(status=QUEUED, run_after=retry_at)
+            self._jobs[job_id] = record
+
+
+class JobQueue:
+    """Enqueues jobs in a job store and runs them on a pool of worker threads"""
+
+    def __init__(
+        self,
+        app,
+        store,
+        workers=JOB_WORKERS,
+        poll_seconds=JOB_POLL_SECONDS,
+        lease_seconds=JOB_LEASE_SECONDS,
+    ):
+        self.app = app
+        self.store = store
+        self.workers = workers
+        self.poll_seconds = poll_seconds
+        self.lease = timedelta(seconds=lease_seconds)
+        self._threads = []
+        self._wakeup = threading.Condition()
+        self._pending = 0
+        self._stopping = False
+        self._lock = threading.Lock()
+
+    def enqueue(self, name, user_id=None, max_attempts=MAX_ATTEMPTS, **args):
+        """Add a job to the queue and return its id, starting worker threads if needed"""
+        if name not in JOBS:
+            raise ValueError(f"Unknown job {name!r}")
+
+        job_id = self.store.add(name, args, user_id, max_attempts)
+
+        self.start()
+        with self._wakeup:
+            self._pending += 1
+            self._wakeup.notify()
+        return job_id
+
+    def get(self, job_id):
+        """Return a job's current state, or None"""
+        return self.store.get(job_id)
+
+    def start(self):
+        """Start this process's worker threads, if they aren't running"""
+        with self._lock:
+            if self._threads or not self.workers:
+                return
+            self._stopping = False
+            for number in range(self.workers):
+                thread = threading.Thread(
+                    target=self.work, name=f"job-worker-{number}", daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def stop(self):
+        """Ask worker threads to stop once their current job finishes, and wait for them"""
+        with self._wakeup:
+            self._stopping = True
+            self._wakeup.notify_all()
+
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            thread.join()
+
+    def work(self):
+        """Run jobs until stopped, waiting for new ones when the queue is empty"""
+        while not self._stopping:
+            if not self.run_next():
+                with self._wakeup:
+                    if not self._pending and not self._stopping:
+                        self._wakeup.wait(self.poll_seconds)
+                    self._pending = max(self._pending - 1, 0)
+
+    def run_next(self):
+        """Claim and run one job, returning False if none was due"""
+        with self.app.app_context():
+            record = self.store.claim(self.lease)
+            if record is None:
+                return False
+
+            start = time.perf_counter()
+            try:
+                result = JOBS[record.name](**record.args)
+            except Exception:
+                db.session.rollback()
+                error = traceback.format_exc()
+
+                retry_at = None
+                if record.attempts < record.max_attempts:
+                    retry_at = datetime.now() + retry_delay(record.attempts)
+
+                self.app.logger.warning(
+                    "Job %d (%s) failed on attempt %d of %d%s:\n%s",
+                    record.id,
+                    record.name,
+                    record.attempts,
+                    record.max_attempts,
+                    "" if retry_at is None else ", will retry",
+                    error,
+                )
+                self.store.fail(record.id, error, retry_at)
+            else:
+                self.store.finish(record.id, result)
+                self.app.logger.info(
+                    "Job %d (%s) finished in %.2fs",
+                    record.id,
+                    record.name,
+                    time.perf_counter() - start,
+                )
+            finally:
+                db.session.remove()
+
+        return True
+
+
+def job_status(record):
+    """Return a job's state as a JSON-serializable dict"""
+    return {
+        "id": record.id,
+        "name": record.name,
+        "status": record.status,
+        "attempts": record.attempts,
+        "max_attempts": record.max_attempts,
+        "result": record.result,
+        "error": record.error,
+        "created": record.created.isoformat(),
+        "started": None if record.started is None else record.started.isoformat(),
+        "finished": None if record.finished is None else record.finished.isoformat(),
+    }
+
+
+def enqueue(name, user_id=None, max_attempts=MAX_ATTEMPTS, **args):
+    """Add a job to the current app's queue and return its id"""
+    return current_app.extensions["jobs"].enqueue(
+        name, user_id=user_id, max_attempts=max_attempts, **args
+    )
+
+
+def init_jobs(app):
+    """Set up the job queue named by the JOB_BACKEND setting
+
+    database: jobs in the jobs table, run by any worker process (the default)
+    memory: jobs in this process, run only by its worker threads
+
+    Worker threads start on the first enqueued job, so startup does no work. Set
+    JOB_WORKERS to 0 to leave jobs to dedicated `flask run-jobs` processes.
+    """
+    backend = app.config.get("JOB_BACKEND", "database")
+
+    if backend == "database":
+        store = DatabaseJobStore()
+    elif backend == "memory":
+        store = MemoryJobStore()
+    else:
+        raise ValueError(
+            f"Unknown job backend {backend!r}, expected one of {', '.join(JOB_BACKENDS)}"
+        )
+
+    queue = app.extensions["jobs"] = JobQueue(
+        app,
+        store,
+        workers=app.config.get("JOB_WORKERS", JOB_WORKERS),
+        poll_seconds=app.config.get("JOB_POLL_SECONDS", JOB_POLL_SECONDS),
+        lease_seconds=app.config.get("JOB_LEASE_SECONDS", JOB_LEASE_SECONDS),
+    )
+    return queue
@@ -1,5 +1,8 @@
 # Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
 
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateIndex
+
 from extensions import db
 
 # Association table linking users to roles
@@ -35,6 +38,21 @@ class Patient(db.Model):
     bed = db.Column(db.Text)
     provider_id = db.Column(db.Integer, db.ForeignKey("users.id"))
 
+    __table_args__ = (
+        db.Index("ix_patients_provider_name", "provider_id", "name_last", "name_first"),
+        db.Index("ix_patients_name_search", db.func.lower(name_last), name_first),
+        # A patient is entered once per provider, name, age, and bed
+        db.Index(
+            "ix_patients_identity",
+            "provider_id",
+            "name_last",
+            "name_first",
+            "age",
+            "bed",
+            unique=True,
+        ),
+    )
+
 
 # Models for weights functionality
 class MonthlyWeights(db.Model):
@@ -46,6 +64,11 @@ class MonthlyWeights(db.Model):
     patient_weight = db.Column(db.Float)
     timestamp = db.Column(db.DateTime)
 
+    __table_args__ = (
+        db.Index("ix_monthly_weights_patient_date", "patient_id", "weight_date"),
+        db.Index("ix_monthly_weights_user_date", "user_id", "weight_date"),
+    )
+
 
 class WeightCheck(db.Model):
     __tablename__ = "weight_check"
@@ -58,6 +81,77 @@ class WeightCheck(db.Model):
     twelve_month = db.Column(db.Float)
     timestamp = db.Column(db.DateTime)
 
+    __table_args__ = (db.Index("ix_weight_check_patient_id", "patient_id"),)
+
+
+# Model for each patient's latest weight, weight check, and needs, kept up to date as weights are entered
+class PatientSummary(db.Model):
+    __tablename__ = "patient_summaries"
+    patient_id = db.Column(db.Integer, db.ForeignKey("patients.id"), primary_key=True)
+    provider_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    current_weight = db.Column(db.Float)
+    weight_date = db.Column(db.Date)
+    one_month = db.Column(db.Float)
+    three_month = db.Column(db.Float)
+    six_month = db.Column(db.Float)
+    twelve_month = db.Column(db.Float)
+    flagged = db.Column(db.Boolean, nullable=False)
+    kcals_low = db.Column(db.Float)
+    kcals_high = db.Column(db.Float)
+    protein_g_low = db.Column(db.Float)
+    protein_g_high = db.Column(db.Float)
+    fluids_ml_low = db.Column(db.Float)
+    fluids_ml_high = db.Column(db.Float)
+    timestamp = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index("ix_patient_summaries_provider_flagged", "provider_id", "flagged"),
+    )
+
+
+# Model for server-side sessions shared between worker processes
+class SessionRecord(db.Model):
+    __tablename__ = "sessions"
+    id = db.Column(db.Text, primary_key=True)
+    data = db.Column(db.LargeBinary, nullable=False)
+    expiry = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (db.Index("ix_sessions_expiry", "expiry"),)
+
+
+# Model for API tokens of machine clients, stored as SHA-256 hashes
+class ApiToken(db.Model):
+    __tablename__ = "api_tokens"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"), nullable=False)
+    name = db.Column(db.Text, nullable=False)
+    token_hash = db.Column(db.Text, nullable=False)
+    created = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        db.Index("ix_api_tokens_token_hash", "token_hash", unique=True),
+    )
+
+
+# Model for background jobs run by worker threads or processes
+class Job(db.Model):
+    __tablename__ = "jobs"
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    name = db.Column(db.Text, nullable=False)
+    args = db.Column(db.Text, nullable=False)
+    status = db.Column(db.Text, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False)
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    user_id = db.Column(db.Integer, db.ForeignKey("users.id"))
+    created = db.Column(db.DateTime, nullable=False)
+    run_after = db.Column(db.DateTime, nullable=False)
+    started = db.Column(db.DateTime)
+    finished = db.Column(db.DateTime)
+
+    __table_args__ = (db.Index("ix_jobs_status_run_after", "status", "run_after"),)
+
 
 # Models for tube feed and nutrition functionality
 class Formula(db.Model):
@@ -109,3 +203,24 @@ class Fluids(db.Model):
     free_water_percent = db.Column(db.Float)
     water_ml = db.Column(db.Integer)
     osmolality = db.Column(db.Integer)
+
+
+def create_missing_indexes():
+    """Create declared indexes missing from an existing database
+
+    db.create_all() only creates indexes along with new tables, so databases created
+    before an index was declared are brought up to date here. IF NOT EXISTS is used rather
+    than reflection, which can't see expression indexes such as lower(name_last).
+
+    A unique index can't be created while rows break it, so it is skipped, and its name
+    returned, until the duplicates are merged.
+    """
+    skipped = []
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(CreateIndex(index, if_not_exists=True))
+            except IntegrityError:
+                skipped.append(index.name)
+    return skipped
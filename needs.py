@@ -0,0 +1,304 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+"""Daily nutritional needs equations
+
+Needs are estimated for many patients at once: evaluate_needs() takes columns of patient
+values (weights, ages, heights, and so on, one entry per patient) and returns columns of
+needs, so a ward or an export is evaluated in a few list comprehensions rather than a
+function call per patient. Energy needs come from either the patient's condition's kcal/kg
+factors or a predictive equation of resting energy expenditure (Mifflin-St Jeor,
+Harris-Benedict, or Penn State for ventilated patients); protein and fluid needs always
+come from the condition's per kg factors.
+"""
+
+import math
+
+from collections import namedtuple
+
+# Pounds per kilogram and centimeters per inch, as weights are stored in pounds
+LB_PER_KG = 2.2
+CM_PER_IN = 2.54
+
+# Daily needs per kg of body weight as (low, high) limits, and the (low, high) factor
+# applied to resting energy expenditure from a predictive equation
+Condition = namedtuple(
+    "Condition", ("label", "kcals_per_kg", "protein_g_per_kg", "fluids_ml_per_kg", "stress")
+)
+
+CONDITIONS = {
+    "general": Condition("General", (25, 30), (1.2, 1.5), (30, 35), (1.2, 1.3)),
+    "critical_illness": Condition(
+        "Critical illness", (25, 30), (1.2, 2.0), (30, 35), (1.0, 1.2)
+    ),
+    "pressure_injury": Condition(
+        "Pressure injury", (30, 35), (1.25, 1.5), (30, 35), (1.2, 1.4)
+    ),
+    "ckd": Condition("CKD, not on dialysis", (25, 35), (0.6, 0.8), (25, 30), (1.1, 1.3)),
+    "dialysis": Condition("Dialysis", (25, 35), (1.0, 1.2), (25, 30), (1.1, 1.3)),
+}
+
+# Sexes accepted by the predictive equations
+SEXES = ("female", "male")
+
+# Mifflin-St Jeor: 10 kg + 6.25 cm - 5 years + 5 (male) or - 161 (female)
+MIFFLIN_ST_JEOR = {"female": -161.0, "male": 5.0}
+
+# Harris-Benedict (Roza and Shizgal revision): constant, kg, cm, and years coefficients
+HARRIS_BENEDICT = {
+    "female": (447.593, 9.247, 3.098, -4.330),
+    "male": (88.362, 13.397, 4.799, -5.677),
+}
+
+# Penn State 2003b, and the 2010 revision for patients 60 or older with a BMI of 30 or
+# more: Mifflin-St Jeor, minute ventilation (L/min), and maximum temperature (°C)
+# coefficients and constant
+PENN_STATE = (0.96, 31.0, 167.0, -6212.0)
+PENN_STATE_2010 = (0.71, 64.0, 85.0, -3085.0)
+
+# Equations of energy needs, and the patient values each needs besides weight
+Equation = namedtuple("Equation", ("label", "inputs"))
+
+EQUATIONS = {
+    "weight": Equation("kcal/kg", ()),
+    "mifflin_st_jeor": Equation("Mifflin-St Jeor", ("ages", "heights_in", "sexes")),
+    "harris_benedict": Equation("Harris-Benedict", ("ages", "heights_in", "sexes")),
+    "penn_state": Equation(
+        "Penn State",
+        ("ages", "heights_in", "sexes", "minute_ventilation", "max_temps"),
+    ),
+}
+
+# Names of the patient values in messages
+INPUT_LABELS = {
+    "ages": "age",
+    "heights_in": "height",
+    "sexes": "sex",
+    "minute_ventilation": "minute ventilation",
+    "max_temps": "maximum temperature",
+}
+
+# Needs in each result, in the order of their (low, high) columns
+NEEDS = ("kcals", "protein_g", "fluids_ml")
+
+
+def per_kg(weights_lb, factors):
+    """Return (low, high) columns of a need per kg of body weight, from weights in pounds
+
+    The conversion to kg is folded into the factors, saving a pass over the weights.
+    """
+    low, high = (factor / LB_PER_KG for factor in factors)
+    return [weight * low for weight in weights_lb], [weight * high for weight in weights_lb]
+
+
+def mifflin_st_jeor(weights_kg, ages, heights_cm, sexes):
+    """Return a column of resting energy expenditure (kcal/day) by Mifflin-St Jeor"""
+    return [
+        10.0 * weight + 6.25 * height - 5.0 * age + MIFFLIN_ST_JEOR[sex]
+        for weight, age, height, sex in zip(weights_kg, ages, heights_cm, sexes)
+    ]
+
+
+def harris_benedict(weights_kg, ages, heights_cm, sexes):
+    """Return a column of resting energy expenditure (kcal/day) by Harris-Benedict"""
+    results = []
+    for weight, age, height, sex in zip(weights_kg, ages, heights_cm, sexes):
+        constant, kg, cm, years = HARRIS_BENEDICT[sex]
+        results.append(constant + kg * weight + cm * height + years * age)
+    return results
+
+
+def penn_state(weights_kg, ages, heights_cm, sexes, minute_ventilation, max_temps):
+    """Return a column of resting energy expenditure (kcal/day) of ventilated patients by Penn State
+
+    Patients 60 or older with a BMI of 30 or more use the 2010 revision.
+    """
+    results = []
+    for weight, age, height, ree, ventilation, temp in zip(
+        weights_kg,
+        ages,
+        heights_cm,
+        mifflin_st_jeor(weights_kg, ages, heights_cm, sexes),
+        minute_ventilation,
+        max_temps,
+    ):
+        older_obese = age >= 60 and weight * 10_000 >= 30 * height * height
+        per_ree, per_ventilation, per_degree, constant = (
+            PENN_STATE_2010 if older_obese else PENN_STATE
+        )
+        results.append(
+            per_ree * ree + per_ventilation * ventilation + per_degree * temp + constant
+        )
+    return results
+
+
+def scatter(column, indexes, length):
+    """Return a column of length with the values of column at indexes, and None elsewhere"""
+    full = [None] * length
+    for index, value in zip(indexes, column):
+        full[index] = value
+    return full
+
+
+def evaluate_needs(
+    weights_lb,
+    equation="weight",
+    condition="general",
+    ages=None,
+    heights_in=None,
+    sexes=None,
+    minute_ventilation=None,
+    max_temps=None,
+):
+    """Estimate low and high limits of daily kcal, protein, and fluid needs of many patients
+
+    weights_lb is a column of weights in pounds, and the other patient values columns of
+    the same length, only needed by the equations that use them (see EQUATIONS). Patients
+    without a weight (None) get None needs. Returns a dict of (low, high) column pairs for
+    kcals, protein_g, and fluids_ml, aligned with weights_lb.
+    """
+    if equation not in EQUATIONS:
+        raise ValueError(
+            f"Unknown equation {equation!r}, expected one of {', '.join(EQUATIONS)}"
+        )
+    if condition not in CONDITIONS:
+        raise ValueError(
+            f"Unknown condition {condition!r}, expected one of {', '.join(CONDITIONS)}"
+        )
+
+    values = {
+        "ages": ages,
+        "heights_in": heights_in,
+        "sexes": sexes,
+        "minute_ventilation": minute_ventilation,
+        "max_temps": max_temps,
+    }
+    inputs = {name: values[name] for name in EQUATIONS[equation].inputs}
+    missing = [INPUT_LABELS[name] for name, column in inputs.items() if column is None]
+    if missing:
+        raise ValueError(
+            f"The {EQUATIONS[equation].label} equation needs {', '.join(missing)}"
+        )
+    if any(len(column) != len(weights_lb) for column in inputs.values()):
+        raise ValueError("Every patient value needs one entry per weight")
+    if "sexes" in inputs and not set(inputs["sexes"]) <= set(SEXES):
+        raise ValueError(f"Sex must be one of {', '.join(SEXES)}")
+
+    # Patients without a weight are left out, and given None needs once the rest are evaluated
+    if None in weights_lb:
+        present = [index for index, weight in enumerate(weights_lb) if weight is not None]
+        needs = evaluate_needs(
+            [weights_lb[index] for index in present],
+            equation,
+            condition,
+            **{
+                name: [column[index] for index in present]
+                for name, column in inputs.items()
+            },
+        )
+
+        return {
+            name: tuple(scatter(column, present, len(weights_lb)) for column in columns)
+            for name, columns in needs.items()
+        }
+
+    factors = CONDITIONS[condition]
+
+    if equation == "weight":
+        kcals = per_kg(weights_lb, factors.kcals_per_kg)
+    else:
+        weights_kg = [weight / LB_PER_KG for weight in weights_lb]
+        heights_cm = [height * CM_PER_IN for height in inputs["heights_in"]]
+        if equation == "mifflin_st_jeor":
+            ree = mifflin_st_jeor(weights_kg, inputs["ages"], heights_cm, inputs["sexes"])
+            low, high = factors.stress
+        elif equation == "harris_benedict":
+            ree = harris_benedict(weights_kg, inputs["ages"], heights_cm, inputs["sexes"])
+            low, high = factors.stress
+        else:
+            # Penn State already accounts for the stress of critical illness
+            ree = penn_state(
+                weights_kg,
+                inputs["ages"],
+                heights_cm,
+                inputs["sexes"],
+                inputs["minute_ventilation"],
+                inputs["max_temps"],
+            )
+            low, high = 1.0, 1.0
+        kcals = [value * low for value in ree], [value * high for value in ree]
+
+    return {
+        "kcals": kcals,
+        "protein_g": per_kg(weights_lb, factors.protein_g_per_kg),
+        "fluids_ml": per_kg(weights_lb, factors.fluids_ml_per_kg),
+    }
+
+
+def estimate_needs(
+    weight_lb,
+    equation="weight",
+    condition="general",
+    age=None,
+    height_in=None,
+    sex=None,
+    minute_ventilation=None,
+    max_temp=None,
+):
+    """Estimates low and high limits of daily kcal, protein, and fluid needs of one patient
+
+    Returns a dict of (low, high) limits for kcals, protein_g, and fluids_ml.
+    """
+
+    def column(value):
+        return None if value is None else [value]
+
+    needs = evaluate_needs(
+        [weight_lb],
+        equation,
+        condition,
+        ages=column(age),
+        heights_in=column(height_in),
+        sexes=column(sex),
+        minute_ventilation=column(minute_ventilation),
+        max_temps=column(max_temp),
+    )
+    return {name: (low[0], high[0]) for name, (low, high) in needs.items()}
+
+
+def needs_options(args):
+    """Read the equation, condition, and patient values of a needs estimate from request arguments
+
+    Returns keyword arguments for estimate_needs() other than weight and age, raising
+    ValueError if a value is malformed.
+    """
+    options = {
+        "equation": args.get("equation") or "weight",
+        "condition": args.get("condition") or "general",
+    }
+    if options["equation"] not in EQUATIONS:
+        raise ValueError(f"Unknown equation {options['equation']!r}")
+    if options["condition"] not in CONDITIONS:
+        raise ValueError(f"Unknown condition {options['condition']!r}")
+
+    for name, label in (
+        ("height_in", "Height"),
+        ("minute_ventilation", "Minute ventilation"),
+        ("max_temp", "Maximum temperature"),
+    ):
+        value = args.get(name)
+        if value:
+            try:
+                options[name] = float(value)
+            except ValueError:
+                raise ValueError(f"{label} must be a number")
+            if not math.isfinite(options[name]):
+                raise ValueError(f"{label} must be a finite number")
+            if options[name] <= 0:
+                raise ValueError(f"{label} must be greater than 0")
+
+    if args.get("sex"):
+        options["sex"] = args.get("sex")
+        if options["sex"] not in SEXES:
+            raise ValueError(f"Sex must be one of {', '.join(SEXES)}")
+
+    return options
@@ -0,0 +1,107 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+"""Query plan checks of the hot route queries
+
+Each query the routes run on every page view is explained with EXPLAIN QUERY PLAN, and
+any step SQLite reports as a full table or index walk (SCAN) rather than an index lookup
+(SEARCH) is a regression: a dropped or mismatched index that only shows up once tables
+grow. The checks run in the test suite on a fresh schema, and against a live database
+with `flask check-query-plans`.
+"""
+
+from datetime import date
+
+from api import patients_query, token_query, weights_query
+from caching import patient_fingerprint_query
+from exports import needs_rows_query, weight_rows_query
+from extensions import db
+from helpers import (
+    HISTORY_ORDER,
+    ROSTER_ORDER,
+    batch_weights_query,
+    dashboard_counts_query,
+    dashboard_query,
+    encode_cursor,
+    history_query,
+    keyset_query,
+    patient_search_query,
+    rounds_query,
+    roster_query,
+    weight_check_query,
+)
+from weight_series import series_rows_query, versions_query
+
+
+def hot_queries():
+    """Return the queries run on every view of the hot routes and by the weight series, by name
+
+    Covers the API, index, dashboard, rounds, patient search, patient_info, weight_check,
+    and history routes, built by the same functions the routes call. Literal ids and
+    dates stand in for request values.
+    """
+    roster_cursor = encode_cursor(["Doe", "Jane", 1])
+    return {
+        "patient pages: ETag fingerprint": patient_fingerprint_query(1),
+        "api: token": token_query("0" * 64),
+        "api: patients page": keyset_query(
+            patients_query(1), ROSTER_ORDER, roster_cursor
+        ),
+        "api: weights of patients": weights_query(1, [1, 2]),
+        "dashboard: counts": dashboard_counts_query(1),
+        "dashboard: flagged patients": dashboard_query(1),
+        "export: weights by provider": weight_rows_query(provider_id=1),
+        "export: latest weight per patient": needs_rows_query(provider_id=1),
+        "index: roster page": keyset_query(
+            roster_query(1), ROSTER_ORDER, roster_cursor
+        ),
+        "patient search: last name prefix": patient_search_query("smi", "", 10),
+        "patient search: full name prefix": patient_search_query("smi", "j", 10),
+        "patient_info: weight check": weight_check_query(1),
+        "rounds: patients with weight checks": rounds_query([1, 2], 1),
+        "weight series: versions": versions_query([1, 2]),
+        "weight series: new rows": series_rows_query([1, 2], since=100),
+        "weight series: reload": series_rows_query([1, 2]),
+        "history: page by user": keyset_query(
+            history_query(1),
+            HISTORY_ORDER,
+            encode_cursor([date(2023, 1, 1), 100]),
+            descending=True,
+        ),
+        "weight_check_batch: provider weights": batch_weights_query(provider_id=1),
+    }
+
+
+def query_plan(query):
+    """Return the steps of SQLite's plan for a query, e.g. "SEARCH patients USING INDEX ..." """
+    statement = getattr(query, "statement", query).compile(
+        db.engine, compile_kwargs={"literal_binds": True}
+    )
+    plan = db.session.execute(db.text(f"EXPLAIN QUERY PLAN {statement}")).all()
+    return [row[-1] for row in plan]
+
+
+def full_scans(details):
+    """Return the steps of a query plan that walk a whole table or index
+
+    A select of subqueries alone reads one constant row, which isn't a table scan.
+    """
+    return [
+        detail
+        for detail in details
+        if detail.startswith("SCAN") and detail != "SCAN CONSTANT ROW"
+    ]
+
+
+def check_query_plans(queries=None):
+    """Explain each hot query, or the given queries by name
+
+    Returns a list of (name, plan steps, full scans), in the order of the queries.
+    """
+    if queries is None:
+        queries = hot_queries()
+
+    results = []
+    for name, query in queries.items():
+        details = query_plan(query)
+        results.append((name, details, full_scans(details)))
+    return results
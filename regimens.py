@@ -0,0 +1,224 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+import math
+
+from operator import itemgetter
+
+from catalog import PER_ML_COLUMNS
+
+# Names of the nutrition columns in every evaluated regimen
+NUTRITION_COLUMNS = tuple(name for name, _, _ in PER_ML_COLUMNS)
+
+# Upper bound on regimens evaluated per request
+MAX_REGIMENS = 100_000
+
+
+def finite(value, label):
+    """Return value as a float, raising ValueError if it isn't a finite number, e.g. "inf" or "nan" """
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError(f"{label} must be a finite number")
+    return value
+
+
+def rate_range(start, stop, step):
+    """Return tube feed rates (mL/hr) from start to stop inclusive, in increments of step
+
+    The number of rates is checked against MAX_REGIMENS before any are built.
+    """
+    start = finite(start, "Rate start")
+    stop = finite(stop, "Rate stop")
+    step = finite(step, "Rate step")
+    if step <= 0:
+        raise ValueError("Rate step must be greater than 0")
+    if start < 0 or stop < start:
+        raise ValueError("Rate range must satisfy 0 <= start <= stop")
+
+    count = int((stop - start) / step + 1e-9) + 1
+    if count > MAX_REGIMENS:
+        raise ValueError(f"Rate range cannot exceed {MAX_REGIMENS} rates")
+
+    return [round(start + i * step, 6) for i in range(count)]
+
+
+def evaluate(formulas, volumes):
+    """Evaluate nutrition provided for each formula at each volume as one outer product
+
+    formulas is a sequence of catalog records and volumes a sequence of volume rows in mL,
+    one row per formula. Returns one nutrition row per (formula, volume), aligned with
+    NUTRITION_COLUMNS, with None where the formula has no data for a column.
+    """
+    return [
+        [
+            [None if per_ml is None else per_ml * volume for per_ml in formula.per_ml]
+            for volume in formula_volumes
+        ]
+        for formula, formula_volumes in zip(formulas, volumes)
+    ]
+
+
+def _regimen(formula, rate, hours, nutrition):
+    """Combine a regimen and its nutrition row into a result dict"""
+    result = {
+        "formula_id": formula.id,
+        "formula_name": formula.name,
+        "rate": rate,
+        "hours": hours,
+        "volume_ml": rate * hours,
+    }
+    result.update(zip(NUTRITION_COLUMNS, nutrition))
+    return result
+
+
+def evaluate_regimens(catalog, regimens):
+    """Evaluate a list of (formula_id, rate, hours) regimens against the formula catalog"""
+    if len(regimens) > MAX_REGIMENS:
+        raise ValueError(f"Cannot evaluate more than {MAX_REGIMENS} regimens")
+
+    formulas = []
+    volumes = []
+    for formula_id, rate, hours in regimens:
+        formula = catalog.get(formula_id)
+        if formula is None:
+            raise ValueError(f"Unknown formula id: {formula_id}")
+        rate = finite(rate, "Rate")
+        hours = finite(hours, "Hours")
+        if rate < 0 or hours < 0:
+            raise ValueError("Rate and hours must be 0 or greater")
+        formulas.append(formula)
+        volumes.append((rate * hours,))
+
+    nutrition = evaluate(formulas, volumes)
+
+    return [
+        _regimen(formula, rate, hours, formula_nutrition[0])
+        for formula, (_, rate, hours), formula_nutrition in zip(
+            formulas, regimens, nutrition
+        )
+    ]
+
+
+def evaluate_grid(catalog, rates, hours, formula_ids=None):
+    """Evaluate every formula (or the given formula ids) at every rate for a number of hours"""
+    if formula_ids is None:
+        formulas = list(catalog)
+    else:
+        formulas = [catalog.get(formula_id) for formula_id in formula_ids]
+        if None in formulas:
+            raise ValueError("Unknown formula id")
+
+    if len(formulas) * len(rates) > MAX_REGIMENS:
+        raise ValueError(f"Cannot evaluate more than {MAX_REGIMENS} regimens")
+    rates = [finite(rate, "Rate") for rate in rates]
+    hours = finite(hours, "Hours")
+    if hours < 0:
+        raise ValueError("Hours must be 0 or greater")
+
+    rate_volumes = [rate * hours for rate in rates]
+    nutrition = evaluate(formulas, [rate_volumes] * len(formulas))
+
+    return [
+        _regimen(formula, rate, hours, rate_nutrition)
+        for formula, formula_nutrition in zip(formulas, nutrition)
+        for rate, rate_nutrition in zip(rates, formula_nutrition)
+    ]
+
+
+def evaluate_request(catalog, payload):
+    """Evaluate the regimens of a JSON request body, as either a list of regimens or a rate grid
+
+    Raises KeyError for a missing field, and TypeError or ValueError for an invalid one.
+    """
+    if "regimens" in payload:
+        regimens = [
+            (regimen["formula_id"], float(regimen["rate"]), float(regimen["hours"]))
+            for regimen in payload["regimens"]
+        ]
+        return evaluate_regimens(catalog, regimens)
+
+    rates = payload["rates"]
+    if isinstance(rates, dict):
+        rates = rate_range(float(rates["start"]), float(rates["stop"]), float(rates["step"]))
+    else:
+        rates = [float(rate) for rate in rates]
+    return evaluate_grid(catalog, rates, float(payload["hours"]), payload.get("formula_ids"))
+
+
+# Positions of the nutrition columns used to fit formulas to a patient's needs
+KCALS = NUTRITION_COLUMNS.index("kcals")
+PROTEIN = NUTRITION_COLUMNS.index("protein_g")
+FREE_WATER = NUTRITION_COLUMNS.index("free_water_ml")
+
+# Diet attributes formulas can be filtered on, stored as "yes"/"no" in the formulas table
+DIET_FILTERS = ("lactose_int", "gluten_free", "kosher")
+
+# Relative weight of fluid fit against protein fit when scoring formulas
+FLUID_FIT_WEIGHT = 0.5
+
+
+def range_fit(value, low, high):
+    """Return 0 if value lies within low and high, else its distance from the range relative to the nearest limit"""
+    if value < low:
+        return (low - value) / low if low else 0.0
+    if value > high:
+        return (value - high) / high if high else 0.0
+    return 0.0
+
+
+def recommend_formulas(catalog, needs, hours=24, diet=(), category_id=None, limit=None):
+    """Rank formulas by how well they meet a patient's estimated needs
+
+    For each formula, solves for the rate that provides the midpoint of the kcal needs over
+    the given hours, then scores protein and free water provided at that rate against the
+    protein and fluid needs (0 is a perfect fit). Formulas are filtered on diet attributes
+    (any of DIET_FILTERS, which must be "yes") and category before ranking.
+    """
+    kcals_low, kcals_high = needs["kcals"]
+    protein_low, protein_high = needs["protein_g"]
+    fluids_low, fluids_high = needs["fluids_ml"]
+    kcals_target = (kcals_low + kcals_high) / 2
+
+    scored = []
+    for formula in catalog:
+        if category_id is not None and formula.category_id != category_id:
+            continue
+        if any(getattr(formula, attribute) != "yes" for attribute in diet):
+            continue
+
+        per_ml = formula.per_ml
+        if not per_ml[KCALS] or per_ml[PROTEIN] is None or per_ml[FREE_WATER] is None:
+            continue
+
+        # Volume that meets the kcal target, and protein and free water provided by it
+        volume = kcals_target / per_ml[KCALS]
+        protein_fit = range_fit(per_ml[PROTEIN] * volume, protein_low, protein_high)
+        fluid_fit = range_fit(per_ml[FREE_WATER] * volume, fluids_low, fluids_high)
+
+        scored.append(
+            (protein_fit + FLUID_FIT_WEIGHT * fluid_fit, protein_fit, fluid_fit, formula)
+        )
+
+    scored.sort(key=itemgetter(0))
+
+    # Build results only for the formulas that are returned
+    recommendations = []
+    for score, protein_fit, fluid_fit, formula in scored[:limit]:
+        volume = kcals_target / formula.per_ml[KCALS]
+        recommendations.append(
+            {
+                "formula_id": formula.id,
+                "formula_name": formula.name,
+                "category": formula.category,
+                "rate": volume / hours,
+                "hours": hours,
+                "volume_ml": volume,
+                "kcals": kcals_target,
+                "protein_g": formula.per_ml[PROTEIN] * volume,
+                "free_water_ml": formula.per_ml[FREE_WATER] * volume,
+                "protein_fit": protein_fit,
+                "fluid_fit": fluid_fit,
+                "score": score,
+            }
+        )
+
+    return recommendations
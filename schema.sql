@@ -61,6 +61,71 @@ CREATE TABLE
     PRIMARY KEY (id)
   );
 
+-- Table to store server-side sessions shared between worker processes
+CREATE TABLE
+  sessions (
+    id TEXT NOT NULL,
+    data BLOB NOT NULL,
+    expiry DATETIME NOT NULL,
+    PRIMARY KEY (id)
+  );
+
+-- Table to store each patient's latest weight, weight check, and needs for the dashboard
+CREATE TABLE
+  patient_summaries (
+    patient_id INTEGER NOT NULL,
+    provider_id INTEGER,
+    current_weight FLOAT,
+    weight_date DATE,
+    one_month FLOAT,
+    three_month FLOAT,
+    six_month FLOAT,
+    twelve_month FLOAT,
+    flagged BOOLEAN NOT NULL,
+    kcals_low FLOAT,
+    kcals_high FLOAT,
+    protein_g_low FLOAT,
+    protein_g_high FLOAT,
+    fluids_ml_low FLOAT,
+    fluids_ml_high FLOAT,
+    TIMESTAMP DATETIME,
+    PRIMARY KEY (patient_id),
+    FOREIGN KEY (patient_id) REFERENCES patients (id),
+    FOREIGN KEY (provider_id) REFERENCES users (id)
+  );
+
+-- Table to store background jobs run by worker threads or processes
+CREATE TABLE
+  jobs (
+    id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    args TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    max_attempts INTEGER NOT NULL,
+    result TEXT,
+    error TEXT,
+    user_id INTEGER,
+    created DATETIME NOT NULL,
+    run_after DATETIME NOT NULL,
+    started DATETIME,
+    finished DATETIME,
+    PRIMARY KEY (id),
+    FOREIGN KEY (user_id) REFERENCES users (id)
+  );
+
+-- Table to store API tokens of machine clients, as SHA-256 hashes
+CREATE TABLE
+  api_tokens (
+    id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    token_hash TEXT NOT NULL,
+    created DATETIME NOT NULL,
+    PRIMARY KEY (id),
+    FOREIGN KEY (user_id) REFERENCES users (id)
+  );
+
 -- Tables to store data for tube feed calculations
 CREATE TABLE
   formulas (
@@ -116,4 +181,25 @@ CREATE TABLE
     osmolality INTEGER,
     PRIMARY KEY (id),
     FOREIGN KEY (formula_id) REFERENCES formulas (id)
-  );
\ No newline at end of file
+  );
+
+-- Indexes for hot patient and weight lookups
+CREATE INDEX IF NOT EXISTS ix_patients_provider_name ON patients (provider_id, name_last, name_first);
+
+CREATE INDEX IF NOT EXISTS ix_patients_name_search ON patients (lower(name_last), name_first);
+
+CREATE UNIQUE INDEX IF NOT EXISTS ix_patients_identity ON patients (provider_id, name_last, name_first, age, bed);
+
+CREATE INDEX IF NOT EXISTS ix_monthly_weights_patient_date ON monthly_weights (patient_id, weight_date);
+
+CREATE INDEX IF NOT EXISTS ix_monthly_weights_user_date ON monthly_weights (user_id, weight_date);
+
+CREATE INDEX IF NOT EXISTS ix_weight_check_patient_id ON weight_check (patient_id);
+
+CREATE INDEX IF NOT EXISTS ix_sessions_expiry ON sessions (expiry);
+
+CREATE INDEX IF NOT EXISTS ix_jobs_status_run_after ON jobs (status, run_after);
+
+CREATE INDEX IF NOT EXISTS ix_patient_summaries_provider_flagged ON patient_summaries (provider_id, flagged);
+
+CREATE UNIQUE INDEX IF NOT EXISTS ix_api_tokens_token_hash ON api_tokens (token_hash);
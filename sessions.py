@@ -0,0 +1,156 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+import threading
+import time
+
+from collections import OrderedDict
+from datetime import datetime
+
+from flask.sessions import SecureCookieSessionInterface
+from flask_session.base import ServerSideSessionInterface
+from flask_session.defaults import Defaults
+
+from extensions import db
+from models import SessionRecord
+
+# Session backends selectable with the SESSION_BACKEND setting
+SESSION_BACKENDS = ("memory", "database", "cookie")
+
+# Sessions kept by the memory backend before the least recently used are dropped
+MEMORY_SESSIONS = 10_000
+
+
+class MemorySessionInterface(ServerSideSessionInterface):
+    """Keeps serialized sessions in a least recently used cache in this process
+
+    Fastest backend with no I/O per request, but sessions are lost on restart and aren't
+    shared between worker processes, so it suits a single-process server.
+    """
+
+    ttl = True
+
+    def __init__(self, app, max_sessions=MEMORY_SESSIONS, **kwargs):
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        super().__init__(app, **kwargs)
+
+    def _retrieve_session_data(self, store_id):
+        with self._lock:
+            entry = self._sessions.get(store_id)
+            if entry is None:
+                return None
+
+            data, expires = entry
+            if expires <= time.monotonic():
+                del self._sessions[store_id]
+                return None
+
+            self._sessions.move_to_end(store_id)
+
+        return self.serializer.decode(data)
+
+    def _delete_session(self, store_id):
+        with self._lock:
+            self._sessions.pop(store_id, None)
+
+    def _upsert_session(self, session_lifetime, session, store_id):
+        # Sessions are stored serialized, so later changes to the session can't leak into the cache
+        data = self.serializer.encode(session)
+        expires = time.monotonic() + session_lifetime.total_seconds()
+
+        with self._lock:
+            self._sessions[store_id] = (data, expires)
+            self._sessions.move_to_end(store_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+
+class DatabaseSessionInterface(ServerSideSessionInterface):
+    """Keeps serialized sessions in the sessions table of the app's database
+
+    Sessions survive restarts and are shared by every worker process using the same
+    database. Each read and write uses its own connection, so saving a session never
+    commits or rolls back the request's database session.
+    """
+
+    ttl = False
+
+    def _retrieve_session_data(self, store_id):
+        with db.engine.connect() as connection:
+            data = connection.execute(
+                db.select(SessionRecord.data).filter(
+                    SessionRecord.id == store_id,
+                    SessionRecord.expiry > datetime.now(),
+                )
+            ).scalar()
+
+        return None if data is None else self.serializer.decode(data)
+
+    def _delete_session(self, store_id):
+        with db.engine.begin() as connection:
+            connection.execute(db.delete(SessionRecord).filter_by(id=store_id))
+
+    def _upsert_session(self, session_lifetime, session, store_id):
+        data = self.serializer.encode(session)
+        expiry = datetime.now() + session_lifetime
+
+        with db.engine.begin() as connection:
+            updated = connection.execute(
+                db.update(SessionRecord)
+                .filter_by(id=store_id)
+                .values(data=data, expiry=expiry)
+            ).rowcount
+
+            if not updated:
+                connection.execute(
+                    db.insert(SessionRecord).values(id=store_id, data=data, expiry=expiry)
+                )
+
+    def _delete_expired_sessions(self):
+        with db.engine.begin() as connection:
+            connection.execute(
+                db.delete(SessionRecord).filter(SessionRecord.expiry <= datetime.now())
+            )
+
+
+def init_session(app):
+    """Install the session backend named by the SESSION_BACKEND setting
+
+    memory: server-side sessions in this process (the default, for a single process)
+    database: server-side sessions in the app's database, shared by every worker
+    cookie: Flask's signed cookie sessions, which need no storage but must fit in a cookie
+
+    The database and cookie backends need the same SECRET_KEY in every worker.
+    """
+    backend = app.config.get("SESSION_BACKEND", "memory")
+
+    common_params = {
+        "key_prefix": app.config.get("SESSION_KEY_PREFIX", Defaults.SESSION_KEY_PREFIX),
+        "permanent": app.config.get("SESSION_PERMANENT", Defaults.SESSION_PERMANENT),
+        "sid_length": app.config.get("SESSION_ID_LENGTH", Defaults.SESSION_ID_LENGTH),
+        "serialization_format": app.config.get(
+            "SESSION_SERIALIZATION_FORMAT", Defaults.SESSION_SERIALIZATION_FORMAT
+        ),
+    }
+
+    if backend == "memory":
+        app.session_interface = MemorySessionInterface(
+            app,
+            max_sessions=app.config.get("SESSION_MEMORY_SESSIONS", MEMORY_SESSIONS),
+            **common_params,
+        )
+    elif backend == "database":
+        app.session_interface = DatabaseSessionInterface(
+            app,
+            cleanup_n_requests=app.config.get("SESSION_CLEANUP_N_REQUESTS"),
+            **common_params,
+        )
+    elif backend == "cookie":
+        app.session_interface = SecureCookieSessionInterface()
+    else:
+        raise ValueError(
+            f"Unknown session backend {backend!r}, expected one of {', '.join(SESSION_BACKENDS)}"
+        )
+
+    return app.session_interface
@@ -0,0 +1,140 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+import os
+import sys
+import tempfile
+
+from datetime import datetime
+
+import pytest
+
+# The app is configured from FLASK_ environment variables when app.py is imported, so
+# point it at a scratch database, hash passwords on the test thread, and run no job workers
+DATABASE = os.path.join(tempfile.mkdtemp(prefix="diet-tests-"), "diet.db")
+os.environ["FLASK_SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{DATABASE}"
+os.environ["FLASK_AUTH_WORKERS"] = "0"
+os.environ["FLASK_BCRYPT_ROUNDS"] = "4"
+os.environ["FLASK_JOB_WORKERS"] = "0"
+os.environ["FLASK_TESTING"] = "true"
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import app as flask_app  # noqa: E402
+from auth import hash_password, init_auth  # noqa: E402
+from catalog import load_catalog  # noqa: E402
+from csv_to_db import seed_reference_data  # noqa: E402
+from extensions import db  # noqa: E402
+from models import MonthlyWeights, Patient, User  # noqa: E402
+from weight_series import weight_series  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    """The app with fresh tables, and CSRF checks off unless a test turns them on"""
+    flask_app.config["WTF_CSRF_ENABLED"] = False
+    with flask_app.app_context():
+        db.create_all()
+        yield flask_app
+        db.session.remove()
+        db.drop_all()
+    # Forget cached users, roles, and weights of the dropped tables
+    init_auth(flask_app)
+    weight_series.invalidate()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def csrf(app):
+    """Turn CSRF protection on, as it is outside the tests"""
+    app.config["WTF_CSRF_ENABLED"] = True
+    yield
+    app.config["WTF_CSRF_ENABLED"] = False
+
+
+@pytest.fixture
+def formulas(app):
+    """Load the reference data, returning the formula catalog"""
+    seed_reference_data()
+    return load_catalog()
+
+
+@pytest.fixture
+def users(app):
+    """Two providers with two patients each, as {username: (user id, [patient ids])}"""
+    providers = {}
+    for username in ("alice", "bob"):
+        user = User(username=username, hash=hash_password("Password1!"))
+        db.session.add(user)
+        db.session.flush()
+        patients = [
+            Patient(
+                name_last=username.title(),
+                name_first=f"Patient {number}",
+                age=60 + number,
+                bed=f"{username[0]}{number}",
+                provider_id=user.id,
+            )
+            for number in (1, 2)
+        ]
+        db.session.add_all(patients)
+        db.session.flush()
+        providers[username] = (user.id, [patient.id for patient in patients])
+    db.session.commit()
+    return providers
+
+
+@pytest.fixture
+def login(client, users):
+    """Log the test client in as a provider, returning their user id and patient ids"""
+
+    def login(username="alice"):
+        with client.session_transaction() as session:
+            session["user_id"] = users[username][0]
+        return users[username]
+
+    return login
+
+
+@pytest.fixture
+def add_patient(users):
+    """Admit a patient to a provider, returning their id"""
+
+    def add_patient(name_last, name_first="Pat", age=70, bed=None, username="alice"):
+        patient = Patient(
+            name_last=name_last,
+            name_first=name_first,
+            age=age,
+            bed=bed or f"{name_last[:2]}{name_first[:2]}{age}",
+            provider_id=users[username][0],
+        )
+        db.session.add(patient)
+        db.session.commit()
+        return patient.id
+
+    return add_patient
+
+
+@pytest.fixture
+def add_weights(users):
+    """Enter (weight date, weight) pairs for a patient, returning the new weights' ids"""
+
+    def add_weights(patient_id, weights, username="alice"):
+        rows = [
+            MonthlyWeights(
+                user_id=users[username][0],
+                patient_id=patient_id,
+                weight_date=weight_date,
+                patient_weight=weight,
+                timestamp=datetime.now(),
+            )
+            for weight_date, weight in weights
+        ]
+        db.session.add_all(rows)
+        db.session.commit()
+        return [row.id for row in rows]
+
+    return add_weights
@@ -0,0 +1,120 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+import io
+import json
+
+from admission import admit_patients
+from extensions import db
+from models import Patient
+
+CENSUS_HEADER = "name_last,name_first,age,bed,provider_id"
+
+
+def roster(provider_id):
+    return db.session.execute(
+        db.select(Patient.name_last, Patient.name_first, Patient.age, Patient.bed)
+        .filter_by(provider_id=provider_id)
+        .order_by(Patient.name_last, Patient.name_first)
+    ).all()
+
+
+def admit(app, client, census):
+    """Upload a census, run its admission job, and return the job's report"""
+    response = client.post(
+        "/patient_admission",
+        data={"file": (io.BytesIO(census.encode()), "census.csv")},
+        headers={"Accept": "application/json"},
+    )
+    assert response.status_code == 202
+
+    # Admission runs as a background job, run here as no job workers are started
+    assert app.extensions["jobs"].run_next()
+
+    job = client.get(response.get_json()["status_url"]).get_json()
+    assert job["status"] == "succeeded"
+    return job["result"]
+
+
+def test_census_admits_transfers_and_rejects(
+    app, client, login, users, tmp_path, monkeypatch
+):
+    # Keep saved uploads out of the app's instance folder
+    monkeypatch.setattr(app, "instance_path", str(tmp_path))
+    user_id, _ = login()
+    bob_id = users["bob"][0]
+    census = "\n".join(
+        [
+            CENSUS_HEADER,
+            "Alice,Patient 1,61,a1,",
+            "Alice,Patient 2,62,a9,",
+            "New,Person,50,n1,",
+            "New,Person,50,n1,",
+            "Bad,Age,x,n2,",
+            f"Other,Provider,40,n3,{bob_id}",
+            "Missing,Bed,40,,",
+        ]
+    )
+
+    report = admit(app, client, census)
+
+    counts = ("rows", "admitted", "transferred", "existing", "rejected")
+    assert [report[count] for count in counts] == [7, 1, 1, 2, 3]
+    assert report["errors"] == [
+        {"line": 6, "error": "Age must be a whole number"},
+        {"line": 7, "error": "Patients can only be admitted to your own care"},
+        {"line": 8, "error": "Row needs name_last, name_first, age, and bed"},
+    ]
+    assert roster(user_id) == [
+        ("Alice", "Patient 1", 61, "a1"),
+        ("Alice", "Patient 2", 62, "a9"),
+        ("New", "Person", 50, "n1"),
+    ]
+    assert len(roster(bob_id)) == 2
+
+    # Applying the same census again changes nothing
+    report = admit(app, client, census)
+    assert (report["admitted"], report["transferred"], report["existing"]) == (0, 0, 4)
+    assert len(roster(user_id)) == 3
+
+
+def test_census_rejects_ambiguous_and_unknown_providers(
+    app, tmp_path, users, add_patient
+):
+    alice_id = users["alice"][0]
+    patient = {"name_first": "Pat", "age": 30}
+    add_patient("Twin", "Pat", age=30, bed="t1")
+    add_patient("Twin", "Pat", age=30, bed="t2")
+    path = tmp_path / "census.jsonl"
+    path.write_text(
+        "\n".join(
+            json.dumps(record)
+            for record in [
+                {**patient, "name_last": "Twin", "bed": "t3", "provider_id": alice_id},
+                {**patient, "name_last": "Lost", "bed": "l1", "provider_id": 999},
+                {**patient, "name_last": "Lost", "bed": "l1"},
+            ]
+        )
+    )
+
+    report = admit_patients(str(path))
+
+    assert report["errors"] == [
+        {"line": 1, "error": "More than one patient named Twin, Pat aged 30"},
+        {"line": 2, "error": "No provider with id 999"},
+        {"line": 3, "error": "Row needs provider_id"},
+    ]
+    assert report["admitted"] == 0
+
+
+def test_admit_patients_command(app, tmp_path, users):
+    bob_id = users["bob"][0]
+    path = tmp_path / "census.csv"
+    path.write_text("name_last,name_first,age,bed\nNew,Admit,45,b9\n")
+
+    result = app.test_cli_runner().invoke(
+        args=["admit-patients", str(path), "--provider-id", str(bob_id)]
+    )
+
+    assert result.exit_code == 0
+    assert result.output.startswith("Admitted 1 and transferred 0 of 1 patients")
+    assert ("New", "Admit", 45, "b9") in roster(bob_id)
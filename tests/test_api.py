@@ -0,0 +1,54 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+from api import create_token
+
+REGIMENS = {"rates": {"start": 50, "stop": 60, "step": 10}, "hours": 24}
+
+
+def test_api_requires_token(client, users):
+    response = client.get("/api/v1/patients")
+
+    assert response.status_code == 401
+
+
+def test_api_lists_token_users_patients(client, users):
+    user_id, patient_ids = users["alice"]
+    token = create_token(user_id, "test")
+
+    response = client.get(
+        "/api/v1/patients", headers={"Authorization": f"Bearer {token}"}
+    )
+
+    assert response.status_code == 200
+    assert sorted(patient["id"] for patient in response.json["patients"]) == patient_ids
+
+
+def test_regimens_with_token_skip_csrf(client, users, formulas, csrf):
+    token = create_token(users["alice"][0], "test")
+
+    response = client.post(
+        "/api/tubefeed/regimens",
+        json=REGIMENS,
+        headers={"Authorization": f"Bearer {token}"},
+    )
+
+    assert response.status_code == 200
+    assert len(response.json["regimens"]) == 2 * len(formulas)
+
+
+def test_regimens_with_session_skip_csrf(client, login, formulas, csrf):
+    login()
+
+    response = client.post("/api/tubefeed/regimens", json=REGIMENS)
+
+    assert response.status_code == 200
+
+
+def test_regimens_require_login_or_token(client, users, csrf):
+    response = client.post(
+        "/api/tubefeed/regimens",
+        json=REGIMENS,
+        headers={"Authorization": "Bearer not-a-token"},
+    )
+
+    assert response.status_code == 401
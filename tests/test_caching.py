@@ -0,0 +1,93 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+from datetime import date
+
+from flask import url_for
+
+from caching import CACHE_POLICIES, NO_STORE_HEADERS
+
+
+def test_unchanged_patient_page_is_not_modified(client, login):
+    _, (patient_id, _) = login()
+
+    response = client.get(f"/patient_info/{patient_id}")
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == CACHE_POLICIES["revalidate"]
+    assert "Cookie" in response.vary
+
+    etag = response.get_etag()[0]
+    response = client.get(
+        f"/patient_info/{patient_id}", headers={"If-None-Match": f'"{etag}"'}
+    )
+    assert response.status_code == 304
+    assert response.data == b""
+    assert response.get_etag()[0] == etag
+
+
+def test_new_weight_changes_patient_etag(client, login, add_weights):
+    _, (patient_id, _) = login()
+    etag = client.get(f"/patient_info/{patient_id}").get_etag()[0]
+
+    add_weights(patient_id, [(date.today(), 150.0)])
+
+    response = client.get(
+        f"/patient_info/{patient_id}", headers={"If-None-Match": f'"{etag}"'}
+    )
+    assert response.status_code == 200
+    assert response.get_etag()[0] != etag
+
+
+def test_patient_etag_differs_per_user(client, login):
+    _, (patient_id, _) = login()
+    etag = client.get(f"/patient_info/{patient_id}").get_etag()[0]
+
+    login("bob")
+
+    response = client.get(
+        f"/patient_info/{patient_id}", headers={"If-None-Match": f'"{etag}"'}
+    )
+    assert response.status_code != 304
+
+
+def test_page_with_flashed_message_is_not_stored(client, login):
+    _, (patient_id, _) = login()
+
+    response = client.post(
+        "/weight_entry",
+        data={
+            "patient": patient_id,
+            "weight": 150,
+            "weight_date": date.today().isoformat(),
+        },
+        follow_redirects=True,
+    )
+
+    assert b"Weight entry added successfully!" in response.data
+    assert response.headers["Cache-Control"] == NO_STORE_HEADERS["Cache-Control"]
+    assert "ETag" not in response.headers
+
+
+def test_pages_without_a_policy_are_not_stored(client, login):
+    login()
+
+    response = client.get("/")
+
+    assert response.headers["Cache-Control"] == NO_STORE_HEADERS["Cache-Control"]
+
+
+def test_formula_reference_pages_are_cached(client, login, formulas):
+    login()
+
+    response = client.get("/tubefeed/regimens")
+
+    assert response.headers["Cache-Control"] == CACHE_POLICIES["reference"]
+
+
+def test_versioned_static_files_are_immutable(app, client):
+    with app.test_request_context():
+        versioned = url_for("static", filename="styles.css")
+
+    assert "?v=" in versioned
+    assert client.get(versioned).headers["Cache-Control"] == CACHE_POLICIES["static"]
+    response = client.get("/static/styles.css")
+    assert response.headers["Cache-Control"] == CACHE_POLICIES["revalidate"]
@@ -0,0 +1,90 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+import pytest
+
+from markupsafe import escape
+
+from catalog import get_catalog, invalidate_catalog
+from extensions import db
+from models import Fluids, Formula, Nutrients
+
+
+def test_catalog_matches_reference_tables(formulas):
+    rows = db.session.execute(
+        db.select(Formula, Nutrients, Fluids)
+        .join(Nutrients, Nutrients.formula_id == Formula.id)
+        .join(Fluids, Fluids.formula_id == Formula.id)
+    ).all()
+
+    assert len(formulas) == db.session.scalar(db.select(db.func.count(Formula.id)))
+    for formula, nutrients, fluids in rows:
+        record = formulas.get(str(formula.id))
+        assert (record.name, record.kcal_per_ml) == (formula.name, formula.kcal_per_ml)
+        assert (record.protein_g, record.free_water_percent) == (
+            nutrients.protein_g,
+            fluids.free_water_percent,
+        )
+
+
+@pytest.mark.parametrize("formula_id", [None, "", "abc", 10**9])
+def test_catalog_missing_formula(formulas, formula_id):
+    assert formulas.get(formula_id) is None
+
+
+def test_catalog_version_follows_formula_data(formulas):
+    formula = db.session.scalars(db.select(Formula).order_by(Formula.id)).first()
+    formula.kcal_per_ml += 0.5
+    db.session.commit()
+
+    # The shared catalog is kept until invalidated, as reloading reference data does
+    assert get_catalog().version == formulas.version
+    invalidate_catalog()
+
+    catalog = get_catalog()
+    assert catalog.version != formulas.version
+    assert catalog.get(formula.id).kcal_per_ml == formula.kcal_per_ml
+
+
+def test_tubefeed_lists_every_formula(client, login, formulas):
+    login()
+
+    page = client.get("/tubefeed").get_data(as_text=True)
+
+    for formula_id, name in formulas.choices:
+        assert f'<option value="{formula_id}">{escape(name)}</option>' in page
+
+
+def test_tubefeed_nutrition(client, login, formulas):
+    login()
+    record = next(iter(formulas))
+
+    response = client.post(
+        "/tubefeed", data={"formulas": record.id, "tube_feed_rate": 50, "time": 20}
+    )
+
+    assert response.status_code == 200
+    page = response.get_data(as_text=True)
+    assert f"<td>{escape(record.name)}</td>" in page
+    assert f"<td>{record.kcal_per_ml * 1000:.1f}</td>" in page
+    assert f"<td>{record.protein_g:.1f}</td>" in page
+    assert f"<td>{record.free_water_percent * 10:.1f}</td>" in page
+
+
+@pytest.mark.parametrize("attribute", ["records", "choices", "version"])
+def test_catalog_is_read_only(formulas, attribute):
+    with pytest.raises(AttributeError, match="read-only"):
+        setattr(formulas, attribute, None)
+    with pytest.raises(AttributeError, match="read-only"):
+        delattr(formulas, attribute)
+
+
+def test_catalog_contents_are_read_only(formulas):
+    record = next(iter(formulas))
+
+    with pytest.raises(TypeError):
+        formulas.records[record.id] = None
+    with pytest.raises(AttributeError, match="read-only"):
+        record.kcal_per_ml = 0
+    with pytest.raises(AttributeError):
+        formulas.extra = None
+    assert isinstance(formulas.choices, tuple)
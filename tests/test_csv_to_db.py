@@ -0,0 +1,82 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+import csv
+
+import pytest
+
+from csv_to_db import REFERENCE_DATA, bulk_load_csv, seed_reference_data
+from extensions import db
+from models import Category, Fluids
+
+
+def csv_rows(csv_file):
+    with open(csv_file, newline="") as csvfile:
+        return list(csv.DictReader(csvfile))
+
+
+def write_csv(path, lines):
+    path.write_text("\n".join(lines) + "\n")
+    return str(path)
+
+
+def table_rows(model):
+    table = model.__table__
+    return db.session.execute(db.select(table).order_by(*table.primary_key)).all()
+
+
+def test_seed_loads_every_reference_file_once(app):
+    seed_reference_data()
+    seed_reference_data()
+
+    for csv_file, model, id in REFERENCE_DATA:
+        column = model.__table__.columns[id]
+        expected = sorted(int(row[id]) for row in csv_rows(csv_file))
+        assert db.session.scalars(db.select(column).order_by(column)).all() == expected
+
+
+def test_rows_are_typed_across_chunks(app, tmp_path):
+    csv_file = write_csv(
+        tmp_path / "fluids.csv",
+        [
+            "formula_id,free_water_percent,water_ml,osmolality",
+            "1,80.7,807,450",
+            "2,76,760,",
+            "3,,,300",
+        ],
+    )
+
+    assert bulk_load_csv(csv_file, Fluids, "formula_id", chunk_size=2) == 3
+
+    fluids = db.session.scalars(db.select(Fluids).order_by(Fluids.formula_id)).all()
+    assert [
+        (row.formula_id, row.free_water_percent, row.water_ml, row.osmolality)
+        for row in fluids
+    ] == [(1, 80.7, 807, 450), (2, 76.0, 760, None), (3, None, None, 300)]
+
+
+def test_upsert_replaces_matching_rows(app, tmp_path):
+    bulk_load_csv(
+        write_csv(tmp_path / "old.csv", ["id,name", "1,Old", "2,Kept"]), Category, "id"
+    )
+
+    loaded = bulk_load_csv(
+        write_csv(tmp_path / "new.csv", ["id,name", "1,New", "3,Added"]),
+        Category,
+        "id",
+        upsert=True,
+    )
+
+    assert loaded == 2
+    assert table_rows(Category) == [(1, "New"), (2, "Kept"), (3, "Added")]
+
+
+def test_bad_row_leaves_table_unchanged(app, tmp_path):
+    csv_file = write_csv(
+        tmp_path / "categories.csv", ["id,name", "1,First", "2,Second", "three,Third"]
+    )
+
+    # The bad row comes after a chunk was already inserted
+    with pytest.raises(ValueError):
+        bulk_load_csv(csv_file, Category, "id", chunk_size=2)
+
+    assert table_rows(Category) == []
@@ -0,0 +1,68 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+import re
+
+from datetime import date
+
+from dateutil.relativedelta import relativedelta
+
+from needs import evaluate_needs
+
+DASHBOARD_PATIENTS = re.compile(r'<a href="/patient_info/(\d+)">')
+
+
+def enter_weights(client, patient_id, weights):
+    for weight_date, weight in weights:
+        response = client.post(
+            "/weight_entry",
+            data={
+                "patient": patient_id,
+                "weight": weight,
+                "weight_date": weight_date.isoformat(),
+            },
+        )
+        assert response.status_code == 302
+
+
+def dashboard_patients(page):
+    return [int(patient_id) for patient_id in DASHBOARD_PATIENTS.findall(page)]
+
+
+def test_dashboard_lists_flagged_patients(client, login, add_patient):
+    _, (losing_id, steady_id) = login()
+    add_patient("Unweighed")
+    today = date.today()
+    month_ago = today - relativedelta(months=1)
+    enter_weights(client, losing_id, [(month_ago, 150), (today, 135)])
+    enter_weights(client, steady_id, [(month_ago, 200), (today, 199)])
+
+    # Another provider's flagged patient is never shown
+    _, (other_id, _) = login("bob")
+    enter_weights(client, other_id, [(month_ago, 150), (today, 120)])
+    login()
+
+    page = client.get("/dashboard").get_data(as_text=True)
+    assert (
+        "1 of 3 patients with a significant weight change, 1 without a weight check."
+        in page
+    )
+    assert dashboard_patients(page) == [losing_id]
+    assert '<td style="color:  red ">-10.000&#37;</td>' in page
+    kcals_low, kcals_high = (column[0] for column in evaluate_needs([135.0])["kcals"])
+    assert f"<td>{kcals_low:.1f} &#8211; {kcals_high:.1f}</td>" in page
+
+    page = client.get("/dashboard?show=all").get_data(as_text=True)
+    assert dashboard_patients(page) == [losing_id, steady_id]
+
+
+def test_dashboard_follows_new_weights(client, login):
+    _, (patient_id, _) = login()
+    today = date.today()
+    enter_weights(client, patient_id, [(today - relativedelta(months=1), 150)])
+    assert dashboard_patients(client.get("/dashboard").get_data(as_text=True)) == []
+
+    enter_weights(client, patient_id, [(today, 130)])
+
+    page = client.get("/dashboard").get_data(as_text=True)
+    assert dashboard_patients(page) == [patient_id]
+    assert "1 of 2 patients with a significant weight change" in page
@@ -0,0 +1,48 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+import pytest
+
+from sqlalchemy import text
+
+from app import create_app
+from extensions import POOL_OPTIONS, SQLITE_PRAGMAS, db
+
+
+@pytest.mark.parametrize("name, value", SQLITE_PRAGMAS)
+def test_connections_apply_sqlite_pragmas(app, name, value):
+    # SQLite reports journal modes in lower case and synchronous levels by number
+    expected = {"WAL": "wal", "NORMAL": 1}.get(value, value)
+
+    assert db.session.execute(text(f"PRAGMA {name}")).scalar() == expected
+
+
+def test_file_database_pool_is_sized(app):
+    pool = db.engine.pool
+
+    assert (pool.size(), pool._max_overflow, pool.timeout()) == (
+        POOL_OPTIONS["pool_size"],
+        POOL_OPTIONS["max_overflow"],
+        POOL_OPTIONS["pool_timeout"],
+    )
+
+
+def test_engine_options_override_pool_options(app):
+    configured = create_app(
+        {
+            "SQLALCHEMY_DATABASE_URI": app.config["SQLALCHEMY_DATABASE_URI"],
+            "SQLALCHEMY_ENGINE_OPTIONS": {"pool_size": 3},
+        }
+    )
+
+    options = configured.config["SQLALCHEMY_ENGINE_OPTIONS"]
+    assert options == {**POOL_OPTIONS, "pool_size": 3}
+    with configured.app_context():
+        assert db.engine.pool.size() == 3
+
+
+def test_memory_database_takes_no_pool_options(app):
+    configured = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://"})
+
+    assert "pool_size" not in configured.config.get("SQLALCHEMY_ENGINE_OPTIONS", {})
+    with configured.app_context():
+        assert db.session.execute(text("SELECT 1")).scalar() == 1
@@ -0,0 +1,140 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+import csv
+import io
+import json
+
+from datetime import date
+
+import pytest
+
+from dateutil.relativedelta import relativedelta
+
+from exports import EXPORT_DATASETS, write_columnar
+from helpers import batch_weight_check
+from needs import NEEDS, evaluate_needs
+
+
+def read_export(response, file_format):
+    """Parse an export into a list of dicts of text values, as CSV would give"""
+    text = response.get_data(as_text=True)
+
+    if file_format == "csv":
+        return list(csv.DictReader(io.StringIO(text)))
+
+    lines = [json.loads(line) for line in text.splitlines()]
+    if file_format == "jsonl":
+        records = lines
+    else:
+        columns = lines[0]["columns"]
+        records = [
+            dict(zip(columns, values))
+            for group in lines[1:]
+            for values in zip(*(group["columns"][column] for column in columns))
+        ]
+    return [
+        {key: "" if value is None else str(value) for key, value in record.items()}
+        for record in records
+    ]
+
+
+@pytest.fixture
+def weights(users, add_weights):
+    """Two weights for each of alice's patients and one for one of bob's"""
+    today = date.today()
+    month_ago = today - relativedelta(months=1)
+    for patient_id, start in zip(users["alice"][1], (150.0, 200.0)):
+        add_weights(patient_id, [(month_ago, start), (today, start * 0.9)])
+    add_weights(users["bob"][1][0], [(today, 175.0)], username="bob")
+    batch_weight_check()
+
+
+@pytest.mark.parametrize("file_format", ["csv", "jsonl", "columnar"])
+def test_weights_export_has_only_own_patients(client, login, weights, file_format):
+    _, patient_ids = login()
+
+    response = client.get(f"/export/weights?format={file_format}")
+
+    assert response.status_code == 200
+    extension = "csv" if file_format == "csv" else "jsonl"
+    assert response.headers["Content-Disposition"] == (
+        f"attachment; filename=weights.{extension}"
+    )
+    records = read_export(response, file_format)
+    assert list(records[0]) == EXPORT_DATASETS["weights"][0]
+    assert [
+        (int(row["patient_id"]), float(row["patient_weight"])) for row in records
+    ] == [
+        (patient_ids[0], 150.0),
+        (patient_ids[0], 135.0),
+        (patient_ids[1], 200.0),
+        (patient_ids[1], 180.0),
+    ]
+
+
+def test_weight_checks_export_flags_significant_changes(client, login, weights):
+    _, (patient_id, _) = login()
+
+    response = client.get(
+        f"/export/weight_checks?format=jsonl&patient_id={patient_id}"
+    )
+
+    (record,) = map(json.loads, response.get_data(as_text=True).splitlines())
+    assert (record["patient_id"], record["current_weight"]) == (patient_id, 135.0)
+    assert (record["one_month"], record["one_month_significant"]) == (-10.0, True)
+    assert (record["three_month"], record["three_month_significant"]) == (0.0, False)
+    assert record["significant"] is True
+
+
+def test_needs_export_estimates_from_latest_weight(client, login, weights):
+    login()
+
+    response = client.get("/export/needs?format=jsonl")
+
+    records = list(map(json.loads, response.get_data(as_text=True).splitlines()))
+    assert [record["current_weight"] for record in records] == [135.0, 180.0]
+    needs = evaluate_needs([135.0, 180.0])
+    for index, record in enumerate(records):
+        for name in NEEDS:
+            low, high = needs[name]
+            assert (record[f"{name}_low"], record[f"{name}_high"]) == pytest.approx(
+                (low[index], high[index])
+            )
+
+
+@pytest.mark.parametrize(
+    "url, status", [("/export/patients", 404), ("/export/weights?format=xml", 400)]
+)
+def test_unknown_export(client, login, url, status):
+    login()
+
+    response = client.get(url)
+
+    assert response.status_code == status
+    assert response.get_json()["error"].startswith("Unknown")
+
+
+def test_columnar_row_groups():
+    rows = [(1, date(2026, 1, 1)), (2, None), (3, "x")]
+
+    lines = list(write_columnar(["a", "b"], rows, row_group_size=2))
+
+    assert [json.loads(line) for line in lines] == [
+        {"columns": ["a", "b"]},
+        {"rows": 2, "columns": {"a": [1, 2], "b": ["2026-01-01", None]}},
+        {"rows": 1, "columns": {"a": [3], "b": ["x"]}},
+    ]
+
+
+def test_export_command(app, users, weights):
+    bob_id, (patient_id, _) = users["bob"]
+
+    result = app.test_cli_runner().invoke(
+        args=["export", "weights", "--provider-id", str(bob_id)]
+    )
+
+    assert result.exit_code == 0
+    records = list(csv.DictReader(io.StringIO(result.output)))
+    assert [(int(row["patient_id"]), row["patient_weight"]) for row in records] == [
+        (patient_id, "175.0")
+    ]
@@ -0,0 +1,58 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+import json
+
+from datetime import date
+
+import pytest
+
+
+@pytest.fixture
+def weighed_patient(login, add_weights):
+    """A patient of the logged-in provider with a current weight"""
+    user_id, patient_ids = login()
+    add_weights(patient_ids[0], [(date(2023, 1, 1), 154.0)])
+    return patient_ids[0]
+
+
+def recommendations_url(patient_id):
+    return f"/api/patients/{patient_id}/formula_recommendations"
+
+
+def test_recommendations_rank_formulas(client, formulas, weighed_patient):
+    response = client.get(recommendations_url(weighed_patient), query_string={"limit": 3})
+
+    assert response.status_code == 200
+    scores = [formula["score"] for formula in response.json["recommendations"]]
+    assert len(scores) == 3
+    assert scores == sorted(scores)
+    # 154 lb is 70 kg, at 25-30 kcal/kg for a general condition
+    assert response.json["needs"]["kcals"] == pytest.approx([1750, 2100])
+
+
+def test_recommendations_of_another_provider(client, users, login, formulas):
+    login("alice")
+
+    response = client.get(recommendations_url(users["bob"][1][0]))
+
+    assert response.status_code == 404
+
+
+@pytest.mark.parametrize(
+    "args, error",
+    [
+        ({"hours": "nan"}, "Hours"),
+        ({"hours": "inf"}, "Hours"),
+        ({"hours": "0"}, "Hours"),
+        ({"limit": "-1"}, "Limit"),
+        ({"limit": "0"}, "Limit"),
+    ],
+)
+def test_recommendations_reject_invalid_arguments(
+    client, formulas, weighed_patient, args, error
+):
+    response = client.get(recommendations_url(weighed_patient), query_string=args)
+
+    assert response.status_code == 400
+    assert response.json["error"].startswith(error)
+    json.loads(response.data, parse_constant=pytest.fail)
@@ -0,0 +1,75 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+import re
+import time
+
+import pytest
+
+from flask import render_template_string
+
+from app import create_app
+
+TOKEN = "metrics-token"
+
+# Time the inner template of the nested route takes to render
+INNER_SECONDS = 0.05
+
+
+@pytest.fixture
+def instrumented(app):
+    """An instrumented app sharing the test database, with a route rendering nested templates"""
+    instrumented = create_app(
+        {
+            "SQLALCHEMY_DATABASE_URI": app.config["SQLALCHEMY_DATABASE_URI"],
+            "INSTRUMENTATION": True,
+            "METRICS_TOKEN": TOKEN,
+        }
+    )
+
+    def inner():
+        time.sleep(INNER_SECONDS)
+        return render_template_string("inner")
+
+    @instrumented.route("/nested")
+    def nested():
+        return render_template_string("outer {{ inner() }}", inner=inner)
+
+    return instrumented
+
+
+def metric(text, name, route):
+    match = re.search(
+        rf'^dietitians_friend_{name}\{{route="{re.escape(route)}",method="GET"\}} (\S+)$',
+        text,
+        re.MULTILINE,
+    )
+    return float(match.group(1))
+
+
+def test_nested_templates_are_timed(instrumented):
+    client = instrumented.test_client()
+
+    assert client.get("/nested").data == b"outer inner"
+
+    text = client.get(
+        "/metrics", headers={"Authorization": f"Bearer {TOKEN}"}
+    ).get_data(as_text=True)
+    assert metric(text, "template_duration_seconds_total", "/nested") >= INNER_SECONDS
+
+
+def test_metrics_require_login_or_token(instrumented):
+    client = instrumented.test_client()
+
+    assert client.get("/metrics").status_code == 401
+    assert (
+        client.get("/metrics", headers={"Authorization": "Bearer wrong"}).status_code
+        == 401
+    )
+    assert (
+        client.get("/metrics", headers={"Authorization": f"Bearer {TOKEN}"}).status_code
+        == 200
+    )
+
+    with client.session_transaction() as session:
+        session["user_id"] = 1
+    assert client.get("/metrics").status_code == 200
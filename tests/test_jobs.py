@@ -0,0 +1,82 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+import time
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from jobs import (
+    FAILED,
+    LEASE_EXPIRED,
+    QUEUED,
+    RUNNING,
+    DatabaseJobStore,
+    MemoryJobStore,
+)
+
+# A lease every running job has outlived by the time it is checked
+EXPIRED = timedelta(0)
+LEASE = timedelta(minutes=10)
+
+
+@pytest.fixture(params=["database", "memory"])
+def store(request, app):
+    return DatabaseJobStore() if request.param == "database" else MemoryJobStore()
+
+
+def claim_later(store, lease):
+    # Let the clock move past the claim's start time, so a zero lease has expired
+    time.sleep(0.01)
+    return store.claim(lease)
+
+
+def test_claim_runs_each_job_once(store):
+    job_id = store.add("weight_check", {"patient_ids": [1]}, None, 3)
+
+    record = store.claim(LEASE)
+
+    assert (record.id, record.status, record.attempts) == (job_id, RUNNING, 1)
+    assert store.claim(LEASE) is None
+
+
+def test_expired_job_with_attempts_left_runs_again(store):
+    job_id = store.add("weight_check", {}, None, 2)
+    store.claim(LEASE)
+
+    record = claim_later(store, EXPIRED)
+
+    assert (record.id, record.status, record.attempts) == (job_id, RUNNING, 2)
+
+
+def test_expired_job_on_last_attempt_fails(store):
+    job_id = store.add("weight_import", {}, None, 1)
+    store.claim(LEASE)
+
+    assert claim_later(store, EXPIRED) is None
+
+    record = store.get(job_id)
+    assert (record.status, record.attempts, record.error) == (FAILED, 1, LEASE_EXPIRED)
+
+
+def test_expired_job_does_not_block_queued_jobs(store):
+    store.add("weight_import", {}, None, 1)
+    store.claim(LEASE)
+    queued_id = store.add("weight_check", {}, None, 3)
+    assert store.get(queued_id).status == QUEUED
+
+    record = claim_later(store, EXPIRED)
+
+    assert record.id == queued_id
+
+
+def test_job_times_are_local(store):
+    """Job times use local time, like every other timestamp in the database"""
+    job_id = store.add("weight_check", {}, None, 3)
+    store.claim(LEASE)
+    store.finish(job_id, {"updated": 1})
+
+    record = store.get(job_id)
+    now = datetime.now()
+    for moment in (record.created, record.started, record.finished):
+        assert abs(moment - now) < timedelta(minutes=1)
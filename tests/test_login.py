@@ -0,0 +1,45 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+import pytest
+
+from auth import Authenticator
+
+
+def test_login(client, users):
+    response = client.post("/login", data={"username": "alice", "password": "Password1!"})
+
+    assert response.status_code == 302
+    with client.session_transaction() as session:
+        assert session["user_id"] == users["alice"][0]
+
+
+def test_login_wrong_password(client, users):
+    response = client.post("/login", data={"username": "alice", "password": "wrong"})
+
+    assert response.status_code == 200
+    assert b"Invalid username and/or password" in response.data
+
+
+@pytest.mark.parametrize(
+    "data, message",
+    [
+        ({"username": "alice"}, b"Must provide password"),
+        ({"password": "Password1!"}, b"Must provide username"),
+        ({"username": "alice", "password": ""}, b"Must provide password"),
+    ],
+)
+def test_login_missing_field(client, users, data, message):
+    response = client.post("/login", data=data)
+
+    assert response.status_code == 200
+    assert message in response.data
+
+
+@pytest.mark.parametrize(
+    "username, password", [(None, "Password1!"), ("alice", None), ("", ""), ("alice", "")]
+)
+def test_authenticate_missing_credentials(app, users, username, password):
+    # Run without workers, so a hash check would fail on None rather than in a worker
+    authenticator = Authenticator(workers=0, rounds=4)
+
+    assert authenticator.authenticate(username, password) is None
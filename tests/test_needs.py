@@ -0,0 +1,128 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+from datetime import date
+
+import pytest
+
+from needs import estimate_needs, evaluate_needs, needs_options
+
+# A patient of 70 kg and 177.8 cm, in the units weights and heights are entered in
+PATIENT = {"weight_lb": 154.0, "age": 40, "height_in": 70.0, "sex": "male"}
+
+
+@pytest.mark.parametrize(
+    "equation, extra, kcals",
+    [
+        ("weight", {}, (1750.0, 2100.0)),
+        # 10 kg + 6.25 cm - 5 years + 5 = 1616.25, times stress factors 1.2 and 1.3
+        ("mifflin_st_jeor", {}, (1939.5, 2101.125)),
+        # 88.362 + 13.397 kg + 4.799 cm - 5.677 years = 1652.3342
+        ("harris_benedict", {}, (1982.80104, 2148.03446)),
+        # 0.96 Mifflin-St Jeor + 31 VE + 167 Tmax - 6212, without stress factors
+        (
+            "penn_state",
+            {"minute_ventilation": 10.0, "max_temp": 38.0},
+            (1995.6, 1995.6),
+        ),
+    ],
+)
+def test_equations(equation, extra, kcals):
+    needs = estimate_needs(equation=equation, **PATIENT, **extra)
+
+    assert needs["kcals"] == pytest.approx(kcals)
+    assert needs["protein_g"] == pytest.approx((84.0, 105.0))
+    assert needs["fluids_ml"] == pytest.approx((2100.0, 2450.0))
+
+
+def test_penn_state_2010_for_older_obese_patients():
+    # 100 kg and 167.64 cm is a BMI of 35.6; Mifflin-St Jeor at 65 years is 1727.75
+    needs = estimate_needs(
+        220.0,
+        equation="penn_state",
+        age=65,
+        height_in=66.0,
+        sex="male",
+        minute_ventilation=10.0,
+        max_temp=38.0,
+    )
+
+    assert needs["kcals"] == pytest.approx((2011.7025, 2011.7025))
+
+
+def test_patients_without_weight_get_no_needs():
+    needs = evaluate_needs(
+        [154.0, None, 220.0],
+        equation="mifflin_st_jeor",
+        ages=[40, 50, 65],
+        heights_in=[70.0, 60.0, 66.0],
+        sexes=["male", "female", "male"],
+    )
+
+    low, high = needs["kcals"]
+    assert low[1] is None and high[1] is None
+    assert low[0] == pytest.approx(1939.5)
+    alone = estimate_needs(
+        220.0, "mifflin_st_jeor", age=65, height_in=66.0, sex="male"
+    )
+    assert low[2] == pytest.approx(alone["kcals"][0])
+
+
+def test_equation_needs_its_inputs():
+    message = "The Mifflin-St Jeor equation needs height, sex"
+    with pytest.raises(ValueError, match=message):
+        estimate_needs(154.0, equation="mifflin_st_jeor", age=40)
+
+
+@pytest.mark.parametrize(
+    "name, label",
+    [
+        ("height_in", "Height"),
+        ("minute_ventilation", "Minute ventilation"),
+        ("max_temp", "Maximum temperature"),
+    ],
+)
+@pytest.mark.parametrize("value", ["inf", "-inf", "nan", "Infinity", "NaN"])
+def test_options_reject_non_finite_values(name, label, value):
+    with pytest.raises(ValueError, match=f"^{label} must be a finite number$"):
+        needs_options({"equation": "penn_state", name: value})
+
+
+@pytest.mark.parametrize(
+    "args, message",
+    [
+        ({"equation": "guess"}, "Unknown equation 'guess'"),
+        ({"condition": "hungry"}, "Unknown condition 'hungry'"),
+        ({"height_in": "tall"}, "Height must be a number"),
+        ({"max_temp": "-1"}, "Maximum temperature must be greater than 0"),
+        ({"sex": "unknown"}, "Sex must be one of female, male"),
+    ],
+)
+def test_options_reject_malformed_values(args, message):
+    with pytest.raises(ValueError, match=message):
+        needs_options(args)
+
+
+def test_patient_page_estimates_needs_by_chosen_equation(client, login, add_weights):
+    _, (patient_id, _) = login()
+    add_weights(patient_id, [(date.today(), PATIENT["weight_lb"])])
+
+    response = client.get(
+        f"/patient_info/{patient_id}?equation=mifflin_st_jeor&sex=male&height_in=70"
+    )
+
+    # Patient 1 is 61, so Mifflin-St Jeor gives 1511.25 before stress factors
+    assert b"<td>Mifflin-St Jeor, General</td>" in response.data
+    assert b"<td>1813.5 &#8211; 1964.6 kcals</td>" in response.data
+
+
+def test_patient_page_falls_back_on_non_finite_values(client, login, add_weights):
+    _, (patient_id, _) = login()
+    add_weights(patient_id, [(date.today(), PATIENT["weight_lb"])])
+
+    response = client.get(
+        f"/patient_info/{patient_id}?equation=mifflin_st_jeor&sex=male&height_in=inf"
+    )
+
+    page = response.get_data(as_text=True)
+    assert "Height must be a finite number. Showing needs by kcal/kg instead." in page
+    assert "<td>1750.0 &#8211; 2100.0 kcals</td>" in page
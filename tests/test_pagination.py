@@ -0,0 +1,83 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+import html
+import re
+
+from datetime import date, timedelta
+
+# Last and first name of each roster row, and the weight date of each history row
+ROSTER_NAMES = re.compile(
+    r'<th scope="row">\d+</td>\s*<td>([^<]*)</td>\s*<td>([^<]*)</td>'
+)
+WEIGHT_DATES = re.compile(r"<td>(\d{4}-\d\d-\d\d)</td>")
+
+
+def walk_pages(client, url):
+    """Follow 'Next page' links from url, returning each page's HTML"""
+    pages = []
+    while url is not None:
+        response = client.get(url)
+        assert response.status_code == 200
+        page = response.get_data(as_text=True)
+        pages.append(page)
+        next_link = re.search(r'href="([^"]*)">Next page', page)
+        url = html.unescape(next_link.group(1)) if next_link else None
+    return pages
+
+
+def test_roster_pages_cover_every_patient_once(client, login, add_patient):
+    login()
+    # Patients sharing a name are ordered by id, across page boundaries
+    for name_last, name_first, bed in [
+        ("Carter", "Ann", "C1"),
+        ("Carter", "Ann", "C2"),
+        ("Adams", "Zoe", "A1"),
+        ("Baker", "Bo", "B1"),
+    ]:
+        add_patient(name_last, name_first, bed=bed)
+
+    pages = walk_pages(client, "/?page_size=2")
+
+    names = [
+        name
+        for page in pages
+        for name in ROSTER_NAMES.findall(page)
+    ]
+    assert len(pages) == 3
+    assert names == [
+        ("Adams", "Zoe"),
+        ("Alice", "Patient 1"),
+        ("Alice", "Patient 2"),
+        ("Baker", "Bo"),
+        ("Carter", "Ann"),
+        ("Carter", "Ann"),
+    ]
+
+
+def test_history_pages_newest_first(client, login, add_weights):
+    user_id, patient_ids = login()
+    start = date(2023, 1, 1)
+    add_weights(
+        patient_ids[0], [(start + timedelta(days=day), 150.0 + day) for day in range(5)]
+    )
+
+    pages = walk_pages(client, "/history?page_size=2")
+
+    dates = [
+        weight_date
+        for page in pages
+        for weight_date in WEIGHT_DATES.findall(page)
+    ]
+    assert len(pages) == 3
+    assert dates == [
+        (start + timedelta(days=day)).isoformat() for day in range(4, -1, -1)
+    ]
+
+
+def test_invalid_cursor_redirects(client, login):
+    login()
+
+    response = client.get("/history?cursor=not-a-cursor")
+
+    assert response.status_code == 302
+    assert b"Invalid page cursor" in client.get(response.location).data
@@ -0,0 +1,29 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+
+def test_patient_info_shows_patient(client, login):
+    user_id, patient_ids = login()
+
+    response = client.get(f"/patient_info/{patient_ids[0]}")
+
+    assert response.status_code == 200
+    assert b"Alice, Patient 1" in response.data
+
+
+def test_patient_info_missing_patient(client, login):
+    login()
+
+    response = client.get("/patient_info/9999")
+
+    assert response.status_code == 302
+    assert b"Patient not found" in client.get(response.location).data
+
+
+def test_patient_info_missing_patient_with_equation(client, login):
+    login()
+
+    response = client.get(
+        "/patient_info/9999?equation=mifflin_st_jeor&sex=female&height_in=64"
+    )
+
+    assert response.status_code == 302
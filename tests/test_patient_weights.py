@@ -0,0 +1,44 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+from datetime import date
+
+
+def test_patient_weights(client, login, add_weights):
+    user_id, patient_ids = login()
+    add_weights(patient_ids[0], [(date(2023, 1, 1), 150.0), (date(2023, 1, 20), 152.0)])
+
+    response = client.get(f"/api/patients/{patient_ids[0]}/weights")
+
+    assert response.status_code == 200
+    assert [weight["patient_weight"] for weight in response.json["weights"]] == [
+        150.0,
+        152.0,
+    ]
+
+
+def test_patient_weights_by_month(client, login, add_weights):
+    user_id, patient_ids = login()
+    add_weights(
+        patient_ids[0],
+        [(date(2023, 1, 1), 150.0), (date(2023, 1, 20), 152.0), (date(2023, 2, 3), 149.0)],
+    )
+
+    response = client.get(
+        f"/api/patients/{patient_ids[0]}/weights?period=month&start=2023-01-01"
+    )
+
+    assert response.status_code == 200
+    assert [
+        (weight["period_start"], weight["count"], weight["mean"])
+        for weight in response.json["weights"]
+    ] == [("2023-01-01", 2, 151.0), ("2023-02-01", 1, 149.0)]
+
+
+def test_patient_weights_of_another_provider(client, login, users, add_weights):
+    other_patient = users["bob"][1][0]
+    add_weights(other_patient, [(date(2023, 1, 1), 180.0)], username="bob")
+    login("alice")
+
+    response = client.get(f"/api/patients/{other_patient}/weights")
+
+    assert response.status_code == 404
@@ -0,0 +1,24 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+from models import Patient
+from query_plans import check_query_plans
+
+
+def test_hot_queries_use_indexes(app):
+    """Every hot route query on a fresh schema finds its rows through an index"""
+    failures = [
+        f"{name}: {'; '.join(scans)}"
+        for name, details, scans in check_query_plans()
+        if scans
+    ]
+
+    assert not failures, "Full scans in hot queries:\n" + "\n".join(failures)
+
+
+def test_full_scan_is_reported(app):
+    # Patients aren't indexed by bed alone
+    [(name, details, scans)] = check_query_plans(
+        {"patients by bed": Patient.query.filter_by(bed="A1")}
+    )
+
+    assert scans and scans[0].startswith("SCAN patients")
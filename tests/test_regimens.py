@@ -0,0 +1,102 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+import json
+
+import pytest
+
+from regimens import MAX_REGIMENS
+
+
+def post_regimens(client, payload):
+    return client.post("/api/tubefeed/regimens", json=payload)
+
+
+def test_regimen_list(client, login, formulas):
+    login()
+    formula = next(iter(formulas))
+
+    response = post_regimens(
+        client, {"regimens": [{"formula_id": formula.id, "rate": 50, "hours": 24}]}
+    )
+
+    assert response.status_code == 200
+    [regimen] = response.json["regimens"]
+    assert regimen["volume_ml"] == 1200
+    assert regimen["kcals"] == pytest.approx(formula.per_ml[0] * 1200)
+
+
+def test_rate_grid(client, login, formulas):
+    login()
+
+    response = post_regimens(
+        client, {"rates": {"start": 10, "stop": 30, "step": 10}, "hours": 20}
+    )
+
+    assert response.status_code == 200
+    rates = [regimen["rate"] for regimen in response.json["regimens"]]
+    assert rates == [10, 20, 30] * len(formulas)
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        {"rates": {"start": 0, "stop": "inf", "step": 1}, "hours": 24},
+        {"rates": {"start": 0, "stop": 100, "step": "nan"}, "hours": 24},
+        {"rates": {"start": "-inf", "stop": 100, "step": 1}, "hours": 24},
+        {"rates": {"start": 0, "stop": 100, "step": 10}, "hours": "inf"},
+        {"rates": [10, "nan"], "hours": 24},
+        {"regimens": [{"formula_id": 1, "rate": "nan", "hours": 24}]},
+        {"regimens": [{"formula_id": 1, "rate": 50, "hours": "infinity"}]},
+    ],
+)
+def test_non_finite_values_are_rejected(client, login, formulas, payload):
+    login()
+
+    response = post_regimens(client, payload)
+
+    assert response.status_code == 400
+    assert "finite number" in response.json["error"]
+
+
+def test_grid_size_is_capped(client, login, formulas):
+    login()
+
+    response = post_regimens(
+        client, {"rates": {"start": 0, "stop": 1000, "step": 1e-9}, "hours": 24}
+    )
+
+    assert response.status_code == 400
+    assert str(MAX_REGIMENS) in response.json["error"]
+
+
+def test_regimen_responses_are_valid_json(client, login, formulas):
+    login()
+
+    response = post_regimens(
+        client, {"rates": {"start": 0, "stop": 100, "step": 50}, "hours": 24}
+    )
+
+    # NaN and Infinity tokens aren't JSON, and would fail a strict parser
+    json.loads(response.data, parse_constant=pytest.fail)
+
+
+@pytest.mark.parametrize(
+    "rate_stop, message",
+    [
+        ("inf", b"Rate stop must be a finite number"),
+        # The form's range check already rejects NaN
+        ("nan", b"Number must be at least 0."),
+    ],
+)
+def test_regimen_page_rejects_non_finite_rates(
+    client, login, formulas, rate_stop, message
+):
+    login()
+
+    response = client.get(
+        "/tubefeed/regimens",
+        query_string={"rate_start": 0, "rate_stop": rate_stop, "rate_step": 5, "time": 24},
+    )
+
+    assert response.status_code == 200
+    assert message in response.data
@@ -0,0 +1,30 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+
+def test_rounds_lists_patients(client, login):
+    user_id, patient_ids = login()
+
+    response = client.get(f"/rounds?ids={patient_ids[1]},{patient_ids[0]}")
+
+    assert response.status_code == 200
+    assert response.data.index(b"Patient 2") < response.data.index(b"Patient 1")
+
+
+def test_rounds_only_lists_own_patients(client, login, users):
+    user_id, patient_ids = login()
+    other_ids = users["bob"][1]
+
+    response = client.get(f"/rounds?ids={patient_ids[0]}&ids={other_ids[0]}")
+
+    assert response.status_code == 200
+    assert b"Alice, Patient 1" in response.data
+    assert b"Bob, Patient 1" not in response.data
+    assert f"No patient with id {other_ids[0]}".encode() in response.data
+
+
+def test_rounds_without_ids(client, login):
+    login()
+
+    response = client.get("/rounds?ids=")
+
+    assert response.status_code == 302
@@ -0,0 +1,56 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+import pytest
+
+
+def search(client, query):
+    response = client.get("/patients/search", query_string={"q": query})
+    assert response.status_code == 200
+    return [patient["name"] for patient in response.json["patients"]]
+
+
+def test_search_by_last_name_prefix(client, login):
+    login()
+
+    assert search(client, "ali") == ["Alice, Patient 1", "Alice, Patient 2"]
+    assert search(client, "BOB") == ["Bob, Patient 1", "Bob, Patient 2"]
+    assert search(client, "carol") == []
+
+
+def test_search_by_last_and_first_name(client, login):
+    login()
+
+    assert search(client, "alice, patient 2") == ["Alice, Patient 2"]
+
+
+def test_search_by_id(client, login, users):
+    login()
+    patient_id = users["bob"][1][0]
+
+    assert search(client, str(patient_id)) == ["Bob, Patient 1"]
+
+
+@pytest.mark.parametrize(
+    "query, names",
+    [
+        (",patient 1", ["Alice, Patient 1", "Bob, Patient 1"]),
+        (", patient", ["Alice, Patient 1", "Alice, Patient 2", "Bob, Patient 1", "Bob, Patient 2"]),
+        (",", []),
+        (" , ", []),
+        ("", []),
+    ],
+)
+def test_search_with_comma_only_or_empty(client, login, query, names):
+    login()
+
+    assert search(client, query) == names
+
+
+def test_search_limit(client, login):
+    login()
+
+    response = client.get("/patients/search", query_string={"q": "a", "page_size": 1})
+
+    assert [patient["name"] for patient in response.json["patients"]] == [
+        "Alice, Patient 1"
+    ]
@@ -0,0 +1,75 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+from datetime import datetime, timedelta
+
+import pytest
+
+from extensions import db
+from models import SessionRecord
+from sessions import SESSION_BACKENDS, init_session
+
+
+@pytest.fixture
+def use_backend(app):
+    """Install a session backend for a test, restoring the configured one afterwards"""
+    config = app.config.copy()
+    interface = app.session_interface
+
+    def use_backend(backend, **settings):
+        app.config.update(SESSION_BACKEND=backend, **settings)
+        return init_session(app)
+
+    yield use_backend
+    app.config.clear()
+    app.config.update(config)
+    app.session_interface = interface
+
+
+def log_in(client, username="alice"):
+    response = client.post("/login", data={"username": username, "password": "Password1!"})
+    assert response.status_code == 302
+
+
+@pytest.mark.parametrize("backend", SESSION_BACKENDS)
+def test_login_is_kept_until_logout(client, users, use_backend, backend):
+    use_backend(backend)
+    log_in(client)
+
+    response = client.get("/")
+    assert response.status_code == 200
+    assert b"Patient 1" in response.data
+
+    client.get("/logout")
+    response = client.get("/")
+    assert response.status_code == 302
+    assert response.location == "/login"
+
+
+def test_database_sessions_expire_in_local_time(client, users, use_backend):
+    use_backend("database", SESSION_PERMANENT=True)
+    log_in(client)
+
+    # Session expiry is kept in local time, like every other time in the database
+    expiry = db.session.scalar(db.select(SessionRecord.expiry))
+    lifetime = client.application.permanent_session_lifetime
+    assert abs(expiry - (datetime.now() + lifetime)) < timedelta(minutes=1)
+
+    db.session.execute(db.update(SessionRecord).values(expiry=datetime.now() - timedelta(seconds=1)))
+    db.session.commit()
+
+    assert client.get("/").status_code == 302
+
+
+def test_memory_sessions_drop_least_recently_used(app, users, use_backend):
+    use_backend("memory", SESSION_MEMORY_SESSIONS=1)
+    first, second = app.test_client(), app.test_client()
+    log_in(first)
+    log_in(second, "bob")
+
+    assert first.get("/").status_code == 302
+    assert second.get("/").status_code == 200
+
+
+def test_unknown_backend(use_backend):
+    with pytest.raises(ValueError, match="Unknown session backend"):
+        use_backend("redis")
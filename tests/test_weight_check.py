@@ -0,0 +1,172 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+import random
+import re
+
+from datetime import date, timedelta
+
+import pytest
+
+from dateutil.relativedelta import relativedelta
+from flask import get_flashed_messages
+
+from extensions import db
+from helpers import (
+    WEIGHT_CHECK_COLUMNS,
+    WEIGHT_CHECK_INTERVALS,
+    batch_weight_check,
+    weight_change,
+    weight_changes,
+)
+from models import MonthlyWeights, WeightCheck
+
+# Random weight histories compared, each from its own seed
+HISTORIES = 200
+
+# Random sequences of weight entries compared, and the entries in each
+ENTRY_SEQUENCES = 30
+ENTRIES = 12
+
+
+def random_history(rng):
+    """Weights on distinct dates over the last 3 years, mostly monthly with some scattered days
+
+    Weights a month apart exercise the exact date lookups of the interval fallback.
+    """
+    today = date.today()
+    monthly = [today - relativedelta(months=months) for months in range(37)]
+    scattered = [today - timedelta(days=rng.randint(0, 3 * 365)) for _ in range(10)]
+    dates = rng.sample(sorted(set(monthly + scattered)), rng.randint(1, 20))
+    return [(weight_date, round(rng.uniform(80, 300), 1)) for weight_date in dates]
+
+
+@pytest.mark.parametrize("seed", range(HISTORIES))
+def test_weight_changes_match_weight_change(app, add_patient, add_weights, seed):
+    """The weight series calculation gives the per-interval queries' changes and messages"""
+    rng = random.Random(seed)
+    patient_id = add_patient("Random")
+    add_weights(patient_id, random_history(rng))
+
+    with app.test_request_context():
+        current_weight, changes = weight_changes(patient_id)
+        messages = get_flashed_messages()
+
+    with app.test_request_context():
+        latest = (
+            MonthlyWeights.query.filter_by(patient_id=patient_id)
+            .order_by(MonthlyWeights.weight_date.desc())
+            .first()
+        )
+        expected = {
+            interval_months: weight_change(
+                patient_id, interval_months, latest, latest.weight_date
+            )
+            for interval_months in WEIGHT_CHECK_INTERVALS
+        }
+        expected_messages = get_flashed_messages()
+
+    assert current_weight == latest.patient_weight
+    assert changes == expected
+    assert messages == expected_messages
+
+
+def test_weight_changes_without_weights(app, users):
+    with app.test_request_context():
+        assert weight_changes(users["alice"][1][0]) == (None, {})
+
+
+def weight_check_values(patient_id):
+    row = db.session.scalars(
+        db.select(WeightCheck).filter_by(patient_id=patient_id)
+    ).one()
+    return {
+        "current_weight": row.current_weight,
+        **{column: getattr(row, column) for column in WEIGHT_CHECK_COLUMNS.values()},
+    }
+
+
+@pytest.mark.parametrize("seed", range(ENTRY_SEQUENCES))
+def test_incremental_weight_check_matches_batch(
+    client, login, add_patient, add_weights, seed
+):
+    """Weights entered one at a time keep the weight check equal to a full recalculation
+
+    Entries come in random date order, so most are back-dated, and from a small pool of
+    dates, so some share a date with an earlier entry. A twin patient given the same weights
+    is recalculated from scratch by batch_weight_check() after every entry.
+    """
+    rng = random.Random(seed)
+    login()
+    patient_id = add_patient("Incremental")
+    twin_id = add_patient("Batch")
+
+    today = date.today()
+    pool = [today - relativedelta(months=months) for months in range(16)] + [
+        today - timedelta(days=rng.randint(0, 480)) for _ in range(4)
+    ]
+
+    for _ in range(ENTRIES):
+        weight_date = rng.choice(pool)
+        weight = round(rng.uniform(80, 300), 1)
+
+        response = client.post(
+            "/weight_entry",
+            data={
+                "patient": patient_id,
+                "weight": weight,
+                "weight_date": weight_date.isoformat(),
+            },
+        )
+        assert response.status_code == 302
+
+        add_weights(twin_id, [(weight_date, weight)])
+        batch_weight_check(patient_ids=[twin_id])
+
+        assert weight_check_values(patient_id) == weight_check_values(twin_id)
+
+
+def test_weight_check_batch_route_checks_own_patients(
+    app, client, login, users, add_weights
+):
+    _, (first_id, second_id) = login()
+    bob_patient_id = users["bob"][1][0]
+    today = date.today()
+    add_weights(first_id, [(today - relativedelta(months=1), 150.0), (today, 135.0)])
+    add_weights(second_id, [(today, 200.0)])
+    add_weights(bob_patient_id, [(today, 180.0)], username="bob")
+
+    response = client.post("/weight_check/batch")
+    assert response.status_code == 302
+
+    # The checks run as a background job, run here as no job workers are started
+    assert app.extensions["jobs"].run_next()
+    page = client.get("/").get_data(as_text=True)
+    job_id = int(re.search(r"\(job (\d+)\)", page).group(1))
+
+    job = client.get(f"/jobs/{job_id}").get_json()
+    assert (job["status"], job["result"]["updated"]) == ("succeeded", 2)
+
+    assert weight_check_values(first_id) == {
+        "current_weight": 135.0,
+        "one_month": -10.0,
+        "three_month": 0.0,
+        "six_month": 0.0,
+        "twelve_month": 0.0,
+    }
+    assert weight_check_values(second_id)["current_weight"] == 200.0
+    checked = db.session.scalars(db.select(WeightCheck.patient_id)).all()
+    assert bob_patient_id not in checked
+
+
+def test_weight_check_all_command(app, users, add_weights):
+    bob_id, (bob_patient_id, _) = users["bob"]
+    add_weights(users["alice"][1][0], [(date.today(), 120.0)])
+    add_weights(bob_patient_id, [(date.today(), 180.0)], username="bob")
+
+    result = app.test_cli_runner().invoke(
+        args=["weight-check-all", "--provider-id", str(bob_id)]
+    )
+
+    assert result.exit_code == 0
+    assert result.output.startswith("Updated 1 weight checks in ")
+    assert db.session.scalars(db.select(WeightCheck.patient_id)).all() == [bob_patient_id]
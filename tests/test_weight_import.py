@@ -0,0 +1,151 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+import io
+import json
+import os
+
+from datetime import date
+
+from extensions import db
+from models import MonthlyWeights, WeightCheck
+from weight_import import import_weights
+
+
+def imported_weights():
+    return db.session.execute(
+        db.select(
+            MonthlyWeights.patient_id,
+            MonthlyWeights.patient_weight,
+            MonthlyWeights.weight_date,
+            MonthlyWeights.user_id,
+        ).order_by(MonthlyWeights.id)
+    ).all()
+
+
+def test_weight_import_route_reports_every_row(
+    app, client, login, users, tmp_path, monkeypatch
+):
+    # Keep the saved upload out of the app's instance folder
+    monkeypatch.setattr(app, "instance_path", str(tmp_path))
+    user_id, (first_id, second_id) = login()
+    bob_patient_id = users["bob"][1][0]
+    upload = "\n".join(
+        [
+            "patient_id,name_last,name_first,bed,weight,weight_date",
+            f"{first_id},,,,150.5,2026-01-01",
+            ",alice, patient 2 ,,160,2026-02-01",
+            ",,,B1,170,2026-03-01",
+            f"{first_id},,,,abc,2026-01-01",
+            ",,,z9,150,2026-01-01",
+            f"{second_id},,,,150,01/02/2026",
+        ]
+    )
+
+    response = client.post(
+        "/weight_import",
+        data={"file": (io.BytesIO(upload.encode()), "weights.csv")},
+        headers={"Accept": "application/json"},
+    )
+    assert response.status_code == 202
+    job_id = response.get_json()["job_id"]
+
+    # The import runs as a background job, run here as no job workers are started
+    assert app.extensions["jobs"].run_next()
+
+    job = client.get(response.get_json()["status_url"]).get_json()
+    assert job["id"] == job_id
+    report = job["result"]
+    assert (report["rows"], report["imported"], report["rejected"]) == (6, 3, 3)
+    assert report["errors"] == [
+        {"line": 5, "error": "Weight must be a number"},
+        {"line": 6, "error": "No patient in bed z9"},
+        {"line": 7, "error": "Weight date must be formatted YYYY-MM-DD"},
+    ]
+    assert imported_weights() == [
+        (first_id, 150.5, date(2026, 1, 1), user_id),
+        (second_id, 160.0, date(2026, 2, 1), user_id),
+        (bob_patient_id, 170.0, date(2026, 3, 1), user_id),
+    ]
+
+    # Weight checks of every patient given a weight are brought up to date
+    checks = db.session.execute(
+        db.select(WeightCheck.patient_id, WeightCheck.current_weight)
+    ).all()
+    assert sorted(checks) == sorted(
+        [(first_id, 150.5), (second_id, 160.0), (bob_patient_id, 170.0)]
+    )
+
+    # The saved upload is removed once imported
+    assert os.listdir(tmp_path / "imports") == []
+
+
+def test_weight_import_route_rejects_other_formats(client, login):
+    login()
+
+    response = client.post(
+        "/weight_import", data={"file": (io.BytesIO(b"weight"), "weights.xlsx")}
+    )
+
+    assert b"Files must be CSV (.csv) or JSON lines (.jsonl)" in response.data
+    assert imported_weights() == []
+
+
+def test_import_resolves_shared_names_by_bed(app, tmp_path, users, add_patient):
+    first_id = add_patient("Same", "Name", bed="x1")
+    second_id = add_patient("Same", "Name", bed="x2")
+    path = tmp_path / "weights.jsonl"
+    path.write_text(
+        "\n".join(
+            [
+                json.dumps(
+                    {
+                        "name_last": "Same",
+                        "name_first": "Name",
+                        "weight": 150,
+                        "weight_date": "2026-01-01",
+                    }
+                ),
+                json.dumps(
+                    {
+                        "name_last": "Same",
+                        "name_first": "Name",
+                        "bed": "X2",
+                        "weight": 151,
+                        "weight_date": "2026-01-02",
+                    }
+                ),
+                "",
+                "[1, 2]",
+                json.dumps(
+                    {"patient_id": first_id, "weight": 152, "weight_date": "2026-01-03"}
+                ),
+            ]
+        )
+    )
+
+    report = import_weights(str(path), users["alice"][0], batch_size=1)
+
+    assert (report["rows"], report["imported"], report["patients"]) == (4, 2, 2)
+    assert report["errors"] == [
+        {"line": 1, "error": "More than one patient named Same, Name"},
+        {"line": 4, "error": "Line is not a JSON object"},
+    ]
+    assert [row.patient_id for row in imported_weights()] == [second_id, first_id]
+
+
+def test_import_weights_command(app, tmp_path, users):
+    user_id, (patient_id, _) = users["bob"]
+    path = tmp_path / "weights.csv"
+    path.write_text(
+        "patient_id,weight,weight_date\n"
+        f"{patient_id},180,2026-01-01\n"
+        "0,180,2026-01-01\n"
+    )
+
+    result = app.test_cli_runner().invoke(
+        args=["import-weights", str(path), "--user-id", str(user_id)]
+    )
+
+    assert result.exit_code == 0
+    assert "No patient with id 0" in result.output
+    assert imported_weights() == [(patient_id, 180.0, date(2026, 1, 1), user_id)]
@@ -0,0 +1,279 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+"""Bulk weight import from scale exports
+
+Weight files are CSV (with a header row) or JSON lines, one weight per row with the
+columns weight, weight_date, and either patient_id, or name_last and name_first (plus bed
+if names are shared), or bed alone. Rows stream through a generator pipeline: read,
+validate against the same rules as the weight form, resolve the patient in an in-memory
+index, and insert in batches of BATCH_SIZE rows, each in its own transaction. Memory use
+depends on the number of patients and the batch size, not the length of the file.
+"""
+
+import csv
+import json
+import logging
+import math
+import os
+import time
+
+from datetime import datetime
+from itertools import islice
+
+from extensions import db
+from forms import WEIGHT_DATE_FORMAT, WEIGHT_MIN
+from helpers import batch_weight_check
+from models import MonthlyWeights, Patient
+
+logger = logging.getLogger(__name__)
+
+# Weight file formats, by file extension
+IMPORT_FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl"}
+
+# Rows inserted per transaction
+BATCH_SIZE = 5000
+
+# Patients whose weight checks are recalculated together after an import
+WEIGHT_CHECK_PATIENTS = 200
+
+# Row errors listed in an import report; any more are only counted
+MAX_ERRORS = 1000
+
+# Marks a name or bed shared by more than one patient in the patient index
+AMBIGUOUS = object()
+
+
+class PatientIndex:
+    """Patient ids keyed by id, name, name and bed, and bed, built in one query
+
+    Names are matched without regard to case or surrounding spaces. A name or bed shared
+    by several patients can't identify a patient on its own.
+    """
+
+    __slots__ = ("ids", "names", "names_beds", "beds")
+
+    def __init__(self, rows):
+        self.ids = set()
+        self.names = {}
+        self.names_beds = {}
+        self.beds = {}
+
+        for row in rows:
+            self.ids.add(row.id)
+            name = name_key(row.name_last, row.name_first)
+            bed = bed_key(row.bed)
+            for keys, key in (
+                (self.names, name),
+                (self.names_beds, name + (bed,)),
+                (self.beds, bed),
+            ):
+                keys[key] = AMBIGUOUS if key in keys else row.id
+
+    @classmethod
+    def load(cls):
+        """Build an index of every patient"""
+        return cls(
+            db.session.execute(
+                db.select(Patient.id, Patient.name_last, Patient.name_first, Patient.bed)
+            )
+        )
+
+    def resolve(self, record):
+        """Return the patient id a record refers to, raising ValueError if there isn't exactly one"""
+        patient_id = field(record, "patient_id")
+        if patient_id:
+            try:
+                patient_id = int(patient_id)
+            except ValueError:
+                raise ValueError("Patient id must be a whole number")
+            if patient_id not in self.ids:
+                raise ValueError(f"No patient with id {patient_id}")
+            return patient_id
+
+        name_last = field(record, "name_last")
+        name_first = field(record, "name_first")
+        bed = field(record, "bed")
+
+        if name_last and name_first:
+            name = name_key(name_last, name_first)
+            patient_id = self.names.get(name)
+            if patient_id is AMBIGUOUS and bed:
+                patient_id = self.names_beds.get(name + (bed_key(bed),))
+            description = f"named {name_last}, {name_first}"
+        elif bed:
+            patient_id = self.beds.get(bed_key(bed))
+            description = f"in bed {bed}"
+        else:
+            raise ValueError("Row needs patient_id, name_last and name_first, or bed")
+
+        if patient_id is None:
+            raise ValueError(f"No patient {description}")
+        if patient_id is AMBIGUOUS:
+            raise ValueError(f"More than one patient {description}")
+        return patient_id
+
+
+def name_key(name_last, name_first):
+    return ((name_last or "").strip().lower(), (name_first or "").strip().lower())
+
+
+def bed_key(bed):
+    return (bed or "").strip().lower()
+
+
+def field(record, name):
+    """Return a record's value for a column as a stripped string, or "" if missing"""
+    value = record.get(name)
+    return "" if value is None else str(value).strip()
+
+
+def import_format(path, file_format=None):
+    """Return the format of a weight or census file from file_format or the file's extension"""
+    if file_format is None:
+        file_format = IMPORT_FORMATS.get(os.path.splitext(path)[1].lower())
+    if file_format not in IMPORT_FORMATS.values():
+        raise ValueError("Files must be CSV (.csv) or JSON lines (.jsonl)")
+    return file_format
+
+
+def read_records(file, file_format):
+    """Stream (line number, record) pairs from an open weight file
+
+    Records are dicts, or None for JSON lines that aren't a JSON object.
+    """
+    if file_format == "csv":
+        # Line 1 is the header
+        for line_number, record in enumerate(csv.DictReader(file), start=2):
+            yield line_number, record
+    else:
+        for line_number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            yield line_number, record if isinstance(record, dict) else None
+
+
+def validate_records(records, patients):
+    """Stream (line number, weight values, error) from records, with either values or an error
+
+    Applies the weight form's rules: a weight of at least WEIGHT_MIN and a weight date
+    formatted as WEIGHT_DATE_FORMAT, for a patient found in the patient index.
+    """
+    for line_number, record in records:
+        if record is None:
+            yield line_number, None, "Line is not a JSON object"
+            continue
+
+        try:
+            patient_id = patients.resolve(record)
+
+            try:
+                weight = float(field(record, "weight"))
+            except ValueError:
+                raise ValueError("Weight must be a number")
+            if not math.isfinite(weight) or weight < WEIGHT_MIN:
+                raise ValueError(f"Weight must be at least {WEIGHT_MIN}")
+
+            try:
+                weight_date = datetime.strptime(
+                    field(record, "weight_date"), WEIGHT_DATE_FORMAT
+                ).date()
+            except ValueError:
+                raise ValueError("Weight date must be formatted YYYY-MM-DD")
+        except ValueError as e:
+            yield line_number, None, str(e)
+        else:
+            yield line_number, (patient_id, weight, weight_date), None
+
+
+def import_weights(
+    path,
+    user_id,
+    file_format=None,
+    patients=None,
+    batch_size=BATCH_SIZE,
+    max_errors=MAX_ERRORS,
+):
+    """Import every valid row of a weight file, entered by user_id, and report on every row
+
+    Valid rows are inserted in batches of batch_size, each committed on its own, so rows
+    already imported stay imported if a later batch fails. Weight checks of every patient
+    given a weight are then recalculated. Returns a report with counts of rows read,
+    imported, and rejected, and the line and reason of up to max_errors rejected rows.
+    """
+    file_format = import_format(path, file_format)
+    if patients is None:
+        patients = PatientIndex.load()
+
+    report = {
+        "rows": 0,
+        "imported": 0,
+        "rejected": 0,
+        "patients": 0,
+        "errors": [],
+        "errors_truncated": False,
+    }
+    updated_patients = set()
+    timestamp = datetime.now()
+    start = time.perf_counter()
+
+    def valid_rows(results):
+        for line_number, values, error in results:
+            report["rows"] += 1
+            if error is None:
+                yield values
+                continue
+
+            report["rejected"] += 1
+            if len(report["errors"]) < max_errors:
+                report["errors"].append({"line": line_number, "error": error})
+            else:
+                report["errors_truncated"] = True
+
+    with open(path, newline="", encoding="utf-8-sig") as file:
+        rows = valid_rows(validate_records(read_records(file, file_format), patients))
+
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+
+            with db.engine.begin() as connection:
+                connection.execute(
+                    db.insert(MonthlyWeights),
+                    [
+                        {
+                            "user_id": user_id,
+                            "patient_id": patient_id,
+                            "patient_weight": weight,
+                            "weight_date": weight_date,
+                            "timestamp": timestamp,
+                        }
+                        for patient_id, weight, weight_date in batch
+                    ],
+                )
+            report["imported"] += len(batch)
+            updated_patients.update(patient_id for patient_id, _, _ in batch)
+
+    # Bring the weight checks of every patient given a weight up to date, a few hundred
+    # patients at a time, so their weights needn't all be in memory at once
+    patient_ids = sorted(updated_patients)
+    for index in range(0, len(patient_ids), WEIGHT_CHECK_PATIENTS):
+        batch_weight_check(patient_ids=patient_ids[index : index + WEIGHT_CHECK_PATIENTS])
+    report["patients"] = len(patient_ids)
+
+    elapsed = time.perf_counter() - start
+    report["seconds"] = round(elapsed, 3)
+    logger.info(
+        "Imported %d of %d weight rows from %s in %.2fs (%.0f rows/sec)",
+        report["imported"],
+        report["rows"],
+        path,
+        elapsed,
+        report["rows"] / max(elapsed, 1e-9),
+    )
+
+    return report
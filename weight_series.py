@@ -0,0 +1,326 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+import threading
+
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, namedtuple
+from datetime import date, datetime, timedelta
+
+from extensions import db
+from models import MonthlyWeights
+
+# Number of patients whose series are kept in memory per process
+CACHE_SIZE = 1024
+
+# Timestamps are stored as whole microseconds since the epoch, with a sentinel for missing ones
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+NO_TIMESTAMP = -(2**63)
+
+# Columns read from monthly_weights into a series
+SERIES_COLUMNS = (
+    MonthlyWeights.id,
+    MonthlyWeights.user_id,
+    MonthlyWeights.patient_id,
+    MonthlyWeights.weight_date,
+    MonthlyWeights.patient_weight,
+    MonthlyWeights.timestamp,
+)
+
+# Row of a weight series, with the same field names as MonthlyWeights for use in templates
+WeightRow = namedtuple(
+    "WeightRow",
+    ["id", "user_id", "patient_id", "weight_date", "patient_weight", "timestamp"],
+)
+
+# Aggregate of the weights in one week or month
+WeightAggregate = namedtuple(
+    "WeightAggregate", ["period_start", "count", "mean", "min", "max"]
+)
+
+
+def versions_query(patient_ids):
+    """Select the entry count and highest entry id of each patient with weights"""
+    return (
+        db.select(
+            MonthlyWeights.patient_id,
+            db.func.count(MonthlyWeights.id).label("entries"),
+            db.func.max(MonthlyWeights.id).label("last_id"),
+        )
+        .filter(MonthlyWeights.patient_id.in_(patient_ids))
+        .group_by(MonthlyWeights.patient_id)
+    )
+
+
+def series_rows_query(patient_ids, since=None):
+    """Select the series rows of patients, only those with ids above since if given"""
+    query = db.select(*SERIES_COLUMNS).filter(
+        MonthlyWeights.patient_id.in_(patient_ids)
+    )
+
+    # Adding 0 to the id keeps SQLite on the patient index, not scanning ids above since
+    if since is not None:
+        query = query.filter(MonthlyWeights.id + 0 > since)
+
+    return query.order_by(MonthlyWeights.weight_date.asc(), MonthlyWeights.id.asc())
+
+
+class WeightSeries:
+    """Columnar weight history of one patient, ordered by weight date and then entry id
+
+    Dates are stored as ordinal ints and weights as doubles, so every weight check and
+    percent change matches the values computed from the database.
+    """
+
+    __slots__ = (
+        "patient_id",
+        "ids",
+        "user_ids",
+        "dates",
+        "weights",
+        "timestamps",
+        "last_id",
+    )
+
+    def __init__(self, patient_id):
+        self.patient_id = patient_id
+        self.ids = array("q")
+        self.user_ids = array("q")
+        self.dates = array("l")
+        self.weights = array("d")
+        self.timestamps = array("q")
+
+        # Highest entry id in the series, so later reads only fetch newer rows
+        self.last_id = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def append(self, rows):
+        """Add weight rows, keeping the series ordered by weight date and then id
+
+        Rows must arrive in date order, or in id order, for entries sharing a date to stay
+        ordered by id. New weights are usually the latest and are simply appended.
+        """
+        for row in rows:
+            ordinal = row.weight_date.toordinal()
+
+            # Back-dated entries are slotted in after any weights from the same day
+            index = bisect_right(self.dates, ordinal)
+
+            self.ids.insert(index, row.id)
+            self.user_ids.insert(index, row.user_id)
+            self.dates.insert(index, ordinal)
+            self.weights.insert(index, row.patient_weight)
+            self.timestamps.insert(
+                index,
+                NO_TIMESTAMP
+                if row.timestamp is None
+                else (row.timestamp - EPOCH) // MICROSECOND,
+            )
+            self.last_id = max(self.last_id, row.id)
+
+    def copy(self):
+        """Return a copy of the series that can be extended without affecting this one"""
+        copied = WeightSeries(self.patient_id)
+        copied.ids = self.ids[:]
+        copied.user_ids = self.user_ids[:]
+        copied.dates = self.dates[:]
+        copied.weights = self.weights[:]
+        copied.timestamps = self.timestamps[:]
+        copied.last_id = self.last_id
+        return copied
+
+    def latest(self):
+        """Return the most recent weight row, or None"""
+        if not self.ids:
+            return None
+        return self.row(len(self.ids) - 1)
+
+    def row(self, index):
+        """Return the weight row at index"""
+        timestamp = self.timestamps[index]
+        return WeightRow(
+            self.ids[index],
+            self.user_ids[index],
+            self.patient_id,
+            date.fromordinal(self.dates[index]),
+            self.weights[index],
+            None if timestamp == NO_TIMESTAMP else EPOCH + timestamp * MICROSECOND,
+        )
+
+    def entered_by(self, moment, skip=None):
+        """Return whether every weight, except the one at index skip, has an entry timestamp no later than moment"""
+        moment = (moment - EPOCH) // MICROSECOND
+        return all(
+            NO_TIMESTAMP < timestamp <= moment
+            for index, timestamp in enumerate(self.timestamps)
+            if index != skip
+        )
+
+    def bounds(self, start=None, end=None):
+        """Return the index range of weights dated from start to end inclusive"""
+        low = 0 if start is None else bisect_left(self.dates, start.toordinal())
+        high = (
+            len(self.dates) if end is None else bisect_right(self.dates, end.toordinal())
+        )
+        return low, high
+
+    def rows(self, start=None, end=None, descending=False):
+        """Return weight rows dated from start to end inclusive"""
+        low, high = self.bounds(start, end)
+        indexes = range(high - 1, low - 1, -1) if descending else range(low, high)
+        return [self.row(index) for index in indexes]
+
+    def recent(self, count):
+        """Return the count most recent weight rows, newest first"""
+        return [
+            self.row(index)
+            for index in range(len(self.ids) - 1, max(len(self.ids) - count, 0) - 1, -1)
+        ]
+
+    def downsample(self, period="month", start=None, end=None):
+        """Aggregate weights dated from start to end inclusive by week (starting Monday) or month"""
+        if period == "week":
+            # Ordinal 1 (0001-01-01) is a Monday
+            def period_start(ordinal):
+                return date.fromordinal(ordinal - (ordinal - 1) % 7)
+
+        elif period == "month":
+
+            def period_start(ordinal):
+                return date.fromordinal(ordinal).replace(day=1)
+
+        else:
+            raise ValueError("Period must be 'week' or 'month'")
+
+        low, high = self.bounds(start, end)
+
+        aggregates = []
+        current = None
+        for index in range(low, high):
+            bucket = period_start(self.dates[index])
+            weight = self.weights[index]
+
+            if bucket != current:
+                if current is not None:
+                    aggregates.append(
+                        WeightAggregate(current, count, total / count, lowest, highest)
+                    )
+                current, count, total, lowest, highest = bucket, 0, 0.0, weight, weight
+
+            count += 1
+            total += weight
+            lowest = min(lowest, weight)
+            highest = max(highest, weight)
+
+        if current is not None:
+            aggregates.append(
+                WeightAggregate(current, count, total / count, lowest, highest)
+            )
+
+        return aggregates
+
+
+class WeightSeriesStore:
+    """Per-patient weight series cached in memory and kept current from the monthly_weights table
+
+    The table stays the source of truth. Each read checks the patient's entry count and
+    highest id with one indexed query, fetches only rows added since the cached copy was
+    built, and reloads the series if rows were changed in any other way.
+    """
+
+    def __init__(self, cache_size=CACHE_SIZE):
+        self.cache_size = cache_size
+        self._series = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, patient_id):
+        """Return the current weight series of one patient"""
+        return self.get_many([patient_id])[patient_id]
+
+    def get_many(self, patient_ids):
+        """Return current weight series for many patients, keyed by patient id
+
+        Takes one query when every cached series is current, and one more to fetch new rows.
+        """
+        patient_ids = list(dict.fromkeys(patient_ids))
+        if not patient_ids:
+            return {}
+
+        # Entry count and highest entry id of each patient with weights
+        versions = {
+            row.patient_id: (row.entries, row.last_id)
+            for row in db.session.execute(versions_query(patient_ids))
+        }
+
+        with self._lock:
+            series = {}
+            stale = []
+            for patient_id in patient_ids:
+                cached = self._series.get(patient_id)
+                count, last_id = versions.get(patient_id, (0, 0))
+
+                # Entries were removed, so the cached series can't be extended
+                if cached is None or last_id < cached.last_id or count < len(cached):
+                    cached = WeightSeries(patient_id)
+
+                series[patient_id] = cached
+                if (len(cached), cached.last_id) != (count, last_id):
+                    stale.append(patient_id)
+
+        if stale:
+            self._refresh(series, stale, versions)
+
+        with self._lock:
+            for patient_id, patient_series in series.items():
+                self._series[patient_id] = patient_series
+                self._series.move_to_end(patient_id)
+            while len(self._series) > self.cache_size:
+                self._series.popitem(last=False)
+
+        return series
+
+    def _refresh(self, series, stale, versions):
+        """Fetch rows newer than each stale series in one query, rebuilding any that still disagree"""
+        since = min(series[patient_id].last_id for patient_id in stale)
+        rows = db.session.execute(series_rows_query(stale, since)).all()
+
+        # Work on copies, so readers of cached series never see a partial update
+        updated = {patient_id: series[patient_id].copy() for patient_id in stale}
+        for row in rows:
+            patient_series = updated[row.patient_id]
+            if row.id > series[row.patient_id].last_id:
+                patient_series.append([row])
+
+        rebuild = []
+        for patient_id, patient_series in updated.items():
+            count, last_id = versions.get(patient_id, (0, 0))
+
+            # Any other difference means entries were removed since the series was cached
+            if (len(patient_series), patient_series.last_id) == (count, last_id):
+                series[patient_id] = patient_series
+            else:
+                rebuild.append(patient_id)
+
+        if rebuild:
+            # Entries were removed, or added while refreshing, so reload in full
+            rows = db.session.execute(series_rows_query(rebuild)).all()
+
+            for patient_id in rebuild:
+                series[patient_id] = WeightSeries(patient_id)
+            for row in rows:
+                series[row.patient_id].append([row])
+
+    def invalidate(self, patient_id=None):
+        """Drop the cached series of one patient, or of every patient"""
+        with self._lock:
+            if patient_id is None:
+                self._series.clear()
+            else:
+                self._series.pop(patient_id, None)
+
+
+# Weight series shared by every request in this process
+weight_series = WeightSeriesStore()
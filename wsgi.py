@@ -0,0 +1,13 @@
+# Copyright (C) 2023 Anthony Ryan Shannon/Ars Artis Softworks
+
+"""Entry point for production WSGI servers
+
+Run several worker processes with, e.g.:
+
+    gunicorn --workers 4 --threads 4 --bind 0.0.0.0:8000 wsgi:app
+
+Every worker must share FLASK_SECRET_KEY and use a shared session backend
+(FLASK_SESSION_BACKEND=database or cookie). See README.md.
+"""
+
+from app import app